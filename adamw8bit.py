@@ -0,0 +1,223 @@
+"""
+AdamW with the two moment tensors stored in 8 bits, block-wise quantized with dynamic
+scales (after Dettmers et al. 2021, "8-bit Optimizers via Block-wise Quantization").
+
+torch.optim.AdamW keeps exp_avg and exp_avg_sq in fp32, 8 bytes per parameter. Here every
+block of BLOCK_SIZE values of a moment is stored as uint8 indices into a 256 entry code
+plus one fp32 absmax per block, so ~2 bytes per parameter for both moments together.
+The code is log-spaced (signed for exp_avg, unsigned for exp_avg_sq), which keeps the
+relative error about the same for the small and the large values of a block, unlike a
+linear int8 grid that would round most of exp_avg_sq to zero.
+
+The update itself is plain vectorized torch (it runs on CPU as well as GPU): a chunk of
+blocks is dequantized to fp32, updated exactly like AdamW, and quantized back, so the fp32
+temporaries never exceed CHUNK_SIZE values per moment. Tensors smaller than
+MIN_8BIT_SIZE (biases, layernorms) keep fp32 moments, they are a rounding error in memory.
+The state is all tensors in optimizer.state (the step count is an int in each param group),
+so state_dict()/load_state_dict() work as usual.
+
+python train_gpt2.py --optimizer adamw8bit
+
+Loss parity against fp32 AdamW on a small GPT, and a state_dict round trip:
+
+python adamw8bit.py
+"""
+
+import math
+import torch
+
+# -----------------------------------------------------------------------------
+BLOCK_SIZE = 2048 # values per absmax scale
+CHUNK_SIZE = BLOCK_SIZE * 512 # values dequantized at a time in step()
+MIN_8BIT_SIZE = 4096 # smaller tensors keep fp32 moments
+
+def dynamic_code(signed):
+    """256 values in [-1, 1] (signed) or [0, 1], zero plus log-spaced magnitudes"""
+    if signed:
+        # a single zero, the positive side gets the one extra entry (its smallest magnitude)
+        magnitudes = torch.logspace(-5, 0, 128, dtype=torch.float64)
+        code = torch.cat([-magnitudes[1:], torch.zeros(1, dtype=torch.float64), magnitudes])
+    else:
+        code = torch.cat([torch.zeros(1, dtype=torch.float64), torch.logspace(-7, 0, 255, dtype=torch.float64)])
+    code, _ = torch.sort(code)
+    return code.float()
+
+def quantize(x, code, midpoints):
+    """fp32 (num_blocks, BLOCK_SIZE) -> uint8 indices into code and the fp32 absmax per block"""
+    absmax = x.abs().amax(dim=1, keepdim=True).clamp_(min=1e-30)
+    indices = torch.bucketize(x / absmax, midpoints) # the nearest entry of code
+    return indices.to(torch.uint8), absmax.squeeze(1)
+
+def dequantize(indices, absmax, code):
+    return code[indices.long()] * absmax.unsqueeze(1)
+
+class AdamW8bit(torch.optim.Optimizer):
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+        self.codes = {} # device -> (signed code, its midpoints, unsigned code, its midpoints)
+
+    def get_codes(self, device):
+        if device not in self.codes:
+            signed, unsigned = dynamic_code(True).to(device), dynamic_code(False).to(device)
+            midpoints = lambda code: (code[1:] + code[:-1]) / 2
+            self.codes[device] = (signed, midpoints(signed), unsigned, midpoints(unsigned))
+        return self.codes[device]
+
+    def init_state(self, p):
+        state = self.state[p]
+        if p.numel() < MIN_8BIT_SIZE:
+            state['exp_avg'] = torch.zeros_like(p, dtype=torch.float32, memory_format=torch.preserve_format)
+            state['exp_avg_sq'] = torch.zeros_like(p, dtype=torch.float32, memory_format=torch.preserve_format)
+            return
+        num_blocks = math.ceil(p.numel() / BLOCK_SIZE)
+        signed, _, unsigned, _ = self.get_codes(p.device)
+        # the index of 0.0 in the codes, so the moments start at exactly zero
+        state['exp_avg_q'] = torch.full((num_blocks, BLOCK_SIZE), int((signed == 0).nonzero()[0]), dtype=torch.uint8, device=p.device)
+        state['exp_avg_sq_q'] = torch.full((num_blocks, BLOCK_SIZE), int((unsigned == 0).nonzero()[0]), dtype=torch.uint8, device=p.device)
+        state['exp_avg_absmax'] = torch.zeros(num_blocks, dtype=torch.float32, device=p.device)
+        state['exp_avg_sq_absmax'] = torch.zeros(num_blocks, dtype=torch.float32, device=p.device)
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        # Optimizer.load_state_dict casts all state tensors to the dtype of their param,
+        # which would silently turn the uint8 codes into fp32 (4x the memory)
+        for state in self.state.values():
+            for key, value in state.items():
+                if key.endswith('_q'):
+                    state[key] = value.to(torch.uint8)
+                elif torch.is_tensor(value) and value.is_floating_point():
+                    state[key] = value.float()
+        for group in self.param_groups:
+            if 'step' not in group: # a state_dict from before the step count moved to the groups
+                group['step'] = max((int(self.state[p]['step']) for p in group['params'] if 'step' in self.state[p]), default=0)
+            for p in group['params']:
+                self.state[p].pop('step', None)
+
+    @staticmethod
+    def adamw_update(p, grad, exp_avg, exp_avg_sq, lr, beta1, beta2, eps, step):
+        # the same math as torch.optim.AdamW (weight decay is applied to p before)
+        exp_avg.lerp_(grad, 1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2 = 1 - beta2 ** step
+        denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+        p.addcdiv_(exp_avg, denom, value=-lr / bias_correction1)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            lr, (beta1, beta2), eps, weight_decay = group['lr'], group['betas'], group['eps'], group['weight_decay']
+            # one python int per group for the bias corrections, no per-parameter .item()
+            group['step'] = step = group.get('step', 0) + 1
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    self.init_state(p)
+                p.mul_(1 - lr * weight_decay)
+                if 'exp_avg' in state:
+                    self.adamw_update(p, p.grad.float(), state['exp_avg'], state['exp_avg_sq'], lr, beta1, beta2, eps, step)
+                    continue
+                signed, signed_mid, unsigned, unsigned_mid = self.get_codes(p.device)
+                # pad the flattened parameter to whole blocks, work on a chunk of blocks at a time
+                num_blocks = state['exp_avg_q'].size(0)
+                p_flat, grad_flat = p.view(-1), p.grad.view(-1)
+                blocks_per_chunk = CHUNK_SIZE // BLOCK_SIZE
+                for b0 in range(0, num_blocks, blocks_per_chunk):
+                    b1 = min(num_blocks, b0 + blocks_per_chunk)
+                    i0, i1 = b0 * BLOCK_SIZE, min(p.numel(), b1 * BLOCK_SIZE)
+                    exp_avg = dequantize(state['exp_avg_q'][b0:b1], state['exp_avg_absmax'][b0:b1], signed)
+                    exp_avg_sq = dequantize(state['exp_avg_sq_q'][b0:b1], state['exp_avg_sq_absmax'][b0:b1], unsigned)
+                    grad = torch.zeros_like(exp_avg)
+                    grad.view(-1)[:i1 - i0] = grad_flat[i0:i1]
+                    param = torch.zeros_like(exp_avg)
+                    param.view(-1)[:i1 - i0] = p_flat[i0:i1]
+                    self.adamw_update(param, grad, exp_avg, exp_avg_sq, lr, beta1, beta2, eps, step)
+                    p_flat[i0:i1] = param.view(-1)[:i1 - i0].to(p.dtype)
+                    state['exp_avg_q'][b0:b1], state['exp_avg_absmax'][b0:b1] = quantize(exp_avg, signed, signed_mid)
+                    state['exp_avg_sq_q'][b0:b1], state['exp_avg_sq_absmax'][b0:b1] = quantize(exp_avg_sq, unsigned, unsigned_mid)
+        return loss
+
+def state_bytes(optimizer):
+    """Bytes held by the optimizer state tensors"""
+    return sum(t.numel() * t.element_size() for s in optimizer.state.values() for t in s.values() if torch.is_tensor(t))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    # trains the same small GPT from the same init on the same data with fp32 AdamW and
+    # AdamW8bit and compares the loss curves, then checks that a state_dict round trip
+    # continues the 8-bit run exactly
+    import io
+    import argparse
+    from train_gpt2 import GPT, GPTConfig
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=200, help="optimization steps per optimizer")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="allowed relative difference of the final loss (mean of the last 10 steps)")
+    args = parser.parse_args()
+
+    config = GPTConfig(block_size=64, vocab_size=512, n_layer=2, n_head=4, n_embd=64)
+    B, T = 8, 32
+    # a synthetic token stream from a Markov chain with a low-rank transition matrix
+    g = torch.Generator().manual_seed(0)
+    U, V = torch.randn(config.vocab_size, 8, generator=g), torch.randn(config.vocab_size, 8, generator=g)
+    transitions = torch.softmax(U @ V.T, dim=-1)
+    data = torch.zeros(1 << 16, dtype=torch.long)
+    for i in range(1, len(data)):
+        data[i] = torch.multinomial(transitions[data[i - 1]], 1, generator=g)
+
+    def make(name):
+        torch.manual_seed(1337)
+        model = GPT(config)
+        groups = [{'params': [p for p in model.parameters() if p.dim() >= 2], 'weight_decay': 0.1},
+                  {'params': [p for p in model.parameters() if p.dim() < 2], 'weight_decay': 0.0}]
+        opt_cls = AdamW8bit if name == "adamw8bit" else torch.optim.AdamW
+        return model, opt_cls(groups, lr=6e-4, betas=(0.9, 0.95), eps=1e-8) # the settings of configure_optimizers
+
+    def train(model, optimizer, steps, start=0):
+        losses = []
+        for step in range(start, start + steps):
+            offset = step * B * T % (len(data) - B * T - 1)
+            buf = data[offset:offset + B * T + 1]
+            _, loss = model(buf[:-1].view(B, T), buf[1:].view(B, T))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        return losses
+
+    final = {}
+    for name in ("adamw", "adamw8bit"):
+        model, optimizer = make(name)
+        losses = train(model, optimizer, args.steps)
+        final[name] = sum(losses[-10:]) / 10
+        num_params = sum(p.numel() for p in model.parameters())
+        print(f"{name:10s} | final loss {final[name]:.4f} | optimizer state {state_bytes(optimizer) / num_params:.2f} bytes/param")
+    diff = abs(final["adamw8bit"] - final["adamw"]) / final["adamw"]
+    print(f"relative difference of the final loss: {diff:.2e}")
+    assert diff < args.tolerance, "AdamW8bit diverged from fp32 AdamW"
+
+    # checkpoint round trip: 10 steps, save, 10 more steps vs load into a fresh optimizer, 10 steps
+    model, optimizer = make("adamw8bit")
+    train(model, optimizer, 10)
+    num_params = sum(p.numel() for p in model.parameters())
+    bytes_per_param = state_bytes(optimizer) / num_params
+    buffer = io.BytesIO()
+    torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict()}, buffer)
+    expected = train(model, optimizer, 10, start=10)
+    buffer.seek(0)
+    checkpoint = torch.load(buffer)
+    model, optimizer = make("adamw8bit")
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    assert state_bytes(optimizer) / num_params == bytes_per_param, "loading the state_dict changed the size of the state"
+    assert train(model, optimizer, 10, start=10) == expected, "resuming from the state_dict changed the run"
+    print("state_dict round trip OK")
+    print("OK")
@@ -0,0 +1,405 @@
+"""
+CPU benchmark suite for the hot paths of the repo: startup, data preparation, data
+loading, the model forward/backward, generation and eval scoring.
+
+Everything runs on synthetic data (random documents and token shards written to a
+temporary directory) and tiny GPTConfigs, so it needs neither the datasets nor a
+GPU. Every benchmark returns throughput metrics (higher is better) or *_seconds latencies
+and *_bytes memory (lower is better), the results are written to a JSON file, and can be compared
+against a stored baseline:
+
+python bench.py                                   # run everything, write bench_results.json
+python bench.py --only gpt_fwd_bwd,generate       # run a subset
+python bench.py --save_baseline                   # store the results as bench_baseline.json
+python bench.py --baseline bench_baseline.json --threshold 0.10
+    # exits non-zero if any metric dropped by more than 10% against the baseline
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import platform
+import contextlib
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+# -----------------------------------------------------------------------------
+BENCHMARKS = {}
+
+def benchmark(name):
+    """Decorator that registers a benchmark, a function returning {metric: value}"""
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+def measure(fn, warmup=1, iters=5, setup=None):
+    """Median wall time of fn() in seconds, setup() runs untimed before every call"""
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+    times = []
+    for _ in range(iters):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times))
+
+@contextlib.contextmanager
+def quiet():
+    """DataLoaderLite and friends dprint a lot, keep that out of the benchmark output"""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def random_docs(num_docs, words_per_doc, seed=0):
+    rng = random.Random(seed)
+    words = ["the", "model", "language", "token", "shard", "batch", "learning", "rate", "attention",
+             "layer", "gradient", "tensor", "sequence", "data", "loss", "train", "val", "eval"]
+    return [" ".join(rng.choice(words) for _ in range(words_per_doc)) + "." for _ in range(num_docs)]
+
+def write_synthetic_shards(data_root, num_shards, shard_tokens, seed=0):
+    rng = np.random.default_rng(seed)
+    for split in ("train", "val"):
+        for i in range(num_shards):
+            tokens = rng.integers(0, 50257, size=shard_tokens, dtype=np.uint16)
+            np.save(os.path.join(data_root, f"edufineweb_{split}_{i:06d}.npy"), tokens)
+
+def tiny_config(**kwargs):
+    from train_gpt2 import GPTConfig
+    args = dict(block_size=256, vocab_size=50304, n_layer=2, n_head=4, n_embd=128)
+    args.update(kwargs)
+    return GPTConfig(**args)
+
+# -----------------------------------------------------------------------------
+# startup
+
+STARTUP_SCRIPT = """
+import time, json
+t0 = time.perf_counter()
+import torch
+t1 = time.perf_counter()
+from train_gpt2 import GPT, GPTConfig
+t2 = time.perf_counter()
+model = GPT(GPTConfig(block_size=256, vocab_size=50304, n_layer=2, n_head=4, n_embd=128))
+with torch.no_grad():
+    model(torch.zeros((1, 16), dtype=torch.long))
+t3 = time.perf_counter()
+print(json.dumps({"import_torch": t1 - t0, "import_train_gpt2": t2 - t1, "first_forward": t3 - t0}))
+"""
+
+@benchmark("startup")
+def bench_startup(args):
+    import subprocess
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(max(1, args.iters // 2)):
+        out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=repo_dir, capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    # import-time report: the slowest modules pulled in by `import train_gpt2`, torch itself excluded
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import torch; import train_gpt2"], cwd=repo_dir, capture_output=True, text=True, check=True)
+    report = []
+    seen_torch = False
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if name.strip() == "torch":
+            seen_torch = True # what follows was pulled in by train_gpt2 (printed last, at indent 0)
+        elif seen_torch and len(name) - len(name.lstrip()) <= 3:
+            report.append((int(cumulative_us), name.strip()))
+    for cumulative_us, name in sorted(report, reverse=True)[:10]:
+        print(f"  import {name:30s} {cumulative_us / 1000:8.1f}ms")
+    median = lambda k: float(np.median([r[k] for r in runs]))
+    return {"import_train_gpt2_seconds": median("import_train_gpt2"), "time_to_first_forward_seconds": median("first_forward")}
+
+# -----------------------------------------------------------------------------
+# data preparation
+
+@benchmark("fineweb_tokenize")
+def bench_fineweb_tokenize(args):
+    from fineweb import tokenize
+    docs = random_docs(200, 500)
+    num_tokens = sum(len(tokenize(d)) for d in docs)
+    dt = measure(lambda: [tokenize(d) for d in docs], iters=args.iters)
+    return {"docs_per_sec": len(docs) / dt, "tokens_per_sec": num_tokens / dt}
+
+@benchmark("fineweb_shards")
+def bench_fineweb_shards(args):
+    from fineweb import tokenize, process_and_write_shards
+    docs = random_docs(2000, 500)
+    num_tokens = sum(len(tokenize(d)) for d in docs)
+    with tempfile.TemporaryDirectory() as out_dir:
+        def run():
+            with quiet(), contextlib.redirect_stderr(io.StringIO()):
+                process_and_write_shards(docs, split="train", out_dir=out_dir, shard_size=200_000)
+        dt = measure(run, warmup=0, iters=max(1, args.iters // 2))
+    return {"tokens_per_sec": num_tokens / dt}
+
+# -----------------------------------------------------------------------------
+# data loading
+
+@benchmark("dataloader")
+def bench_dataloader(args):
+    from train_gpt2 import DataLoaderLite, load_tokens
+    B, T = 8, 256
+    shard_tokens = 200_000
+    with tempfile.TemporaryDirectory() as data_root:
+        write_synthetic_shards(data_root, num_shards=4, shard_tokens=shard_tokens)
+        with quiet():
+            loader = DataLoaderLite(B=B, T=T, process_rank=0, num_processes=1, split="train", data_root=data_root)
+            # enough batches to cross a few shard boundaries
+            num_batches = 4 * (shard_tokens // (B * T))
+            dt = measure(lambda: [loader.next_batch() for _ in range(num_batches)], iters=args.iters)
+            # a single shard switch: park the loader half a batch before the end of the first
+            # shard, so the timed next_batch loads the next one and concatenates the tail onto it
+            def to_shard_end():
+                loader.current_shard = 0
+                loader.tokens = load_tokens(loader.shards[0])
+                loader.current_position = len(loader.tokens) - B * T // 2
+                loader.buffer_offset = 0
+            dt_switch = measure(loader.next_batch, iters=args.iters, setup=to_shard_end)
+    return {"batches_per_sec": num_batches / dt, "tokens_per_sec": num_batches * B * T / dt,
+            "shard_switches_per_sec": 1.0 / dt_switch}
+
+# -----------------------------------------------------------------------------
+# model
+
+@benchmark("gpt_fwd_bwd")
+def bench_gpt_fwd_bwd(args):
+    from train_gpt2 import GPT
+    torch.manual_seed(1337)
+    model = GPT(tiny_config())
+    results = {}
+    for B, T in [(4, 64), (4, 256), (16, 64), (16, 256)]:
+        x = torch.randint(0, 50257, (B, T))
+        y = torch.randint(0, 50257, (B, T))
+        def step():
+            model.zero_grad(set_to_none=True)
+            logits, loss = model(x, y)
+            loss.backward()
+        dt = measure(step, iters=args.iters)
+        results[f"B{B}_T{T}_tokens_per_sec"] = B * T / dt
+    return results
+
+@benchmark("generate")
+def bench_generate(args):
+    from train_gpt2 import GPT
+    torch.manual_seed(1337)
+    model = GPT(tiny_config())
+    model.eval()
+    num_return_sequences, prompt_len, max_length = 4, 8, 64
+    @torch.no_grad()
+    def generate():
+        xgen = torch.randint(0, 50257, (num_return_sequences, prompt_len))
+        while xgen.size(1) < max_length:
+            logits, _ = model(xgen)
+            probs = torch.softmax(logits[:, -1, :], dim=-1)
+            topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
+            ix = torch.multinomial(topk_probs, 1)
+            xgen = torch.cat((xgen, torch.gather(topk_indices, -1, ix)), dim=1)
+    dt = measure(generate, iters=args.iters)
+    return {"tokens_per_sec": num_return_sequences * (max_length - prompt_len) / dt}
+
+GQA_SHAPE = dict(B=8, T=512, n_layer=2, n_head=8, n_embd=256) # decode: a 448 token prompt, 64 new tokens
+GQA_PROMPT = 448
+
+def gqa_model(n_kv_head):
+    from train_gpt2 import GPT
+    torch.manual_seed(1337)
+    g = GQA_SHAPE
+    model = GPT(tiny_config(block_size=g["T"], n_layer=g["n_layer"], n_head=g["n_head"], n_embd=g["n_embd"], n_kv_head=n_kv_head))
+    return model.eval()
+
+@torch.no_grad()
+def forward_blocks(model, idx):
+    """The forward up to the last block, the (B, T, vocab) logits would dwarf the K/V in the memory numbers"""
+    x = model.transformer.wte(idx) + model.transformer.wpe(torch.arange(idx.size(1)))
+    for block in model.transformer.h:
+        x = block(x)
+    return x
+
+@torch.no_grad()
+def decode_with_kv_cache(model, idx, num_tokens, chunk=64):
+    """
+    Greedy decoding with a preallocated (B, nkvh, T, hs) K/V cache per layer, returns the new
+    tokens. Attention always reads the whole cache with a mask over the positions not written
+    yet (a slice of it would be strided, and SDPA would copy it every step). The prompt goes in
+    chunks of `chunk` tokens through the same path as the new tokens, so the activations of a
+    long prompt don't hide the size of the cache.
+    """
+    B, T = idx.size()
+    attn0 = model.transformer.h[0].attn
+    nh, nkvh, C = attn0.n_head, attn0.n_kv_head, attn0.n_embd
+    hs, rep = C // nh, nh // nkvh
+    max_len = T + num_tokens
+    caches = [torch.zeros(2, B, nkvh, max_len, hs) for _ in model.transformer.h]
+    out, pos = [], 0
+    while len(out) < num_tokens:
+        x_idx = idx[:, pos:pos + chunk] if pos < T else idx[:, -1:]
+        Tc = x_idx.size(1)
+        x = model.transformer.wte(x_idx) + model.transformer.wpe(torch.arange(pos, pos + Tc))
+        # the rep query heads of a group attend to their one K/V head, so the cache is never copied
+        mask = (torch.arange(Tc)[:, None] + pos >= torch.arange(max_len)[None]).repeat(rep, 1)
+        for block, cache in zip(model.transformer.h, caches):
+            attn = block.attn
+            q, k, v = attn.c_attn(block.ln_1(x)).split([C, attn.kv_dim, attn.kv_dim], dim=2)
+            cache[0, :, :, pos:pos + Tc] = k.view(B, Tc, nkvh, hs).transpose(1, 2)
+            cache[1, :, :, pos:pos + Tc] = v.view(B, Tc, nkvh, hs).transpose(1, 2)
+            q = q.view(B, Tc, nkvh, rep, hs).permute(0, 2, 3, 1, 4).reshape(B, nkvh, rep * Tc, hs)
+            y = F.scaled_dot_product_attention(q, cache[0], cache[1], attn_mask=mask)
+            y = y.view(B, nkvh, rep, Tc, hs).permute(0, 3, 1, 2, 4).reshape(B, Tc, C)
+            x = x + attn.c_proj(y)
+            x = x + block.mlp(block.ln_2(x))
+        pos += Tc
+        if pos >= T: # the whole prompt is in the cache, sample from the last position
+            idx = model.lm_head(model.transformer.ln_f(x[:, -1])).argmax(dim=-1, keepdim=True)
+            out.append(idx)
+    return torch.cat(out, dim=1)
+
+def peak_memory_bytes(kind, n_kv_head):
+    """
+    Peak memory of one forward (kind="forward") or one cached decode (kind="decode") above
+    what the model and inputs already hold, measured in a fresh process: the peak RSS
+    (VmHWM, reset through /proc/self/clear_refs) minus the RSS before the call. On CUDA it
+    would be torch.cuda.max_memory_allocated, this suite is CPU only.
+    """
+    model = gqa_model(n_kv_head)
+    g = GQA_SHAPE
+    idx = torch.randint(0, 50257, (g["B"], g["T"] if kind == "forward" else GQA_PROMPT))
+    fn = (lambda: forward_blocks(model, idx)) if kind == "forward" else (lambda: decode_with_kv_cache(model, idx, g["T"] - GQA_PROMPT))
+    read_kb = lambda key: next(int(l.split()[1]) for l in open("/proc/self/status") if l.startswith(key))
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5") # resets VmHWM to the current RSS
+    rss_before = read_kb("VmRSS:")
+    fn()
+    return (read_kb("VmHWM:") - rss_before) * 1024
+
+@benchmark("gqa_attention")
+def bench_gqa_attention(args):
+    # multi-head vs grouped-query vs multi-query attention: forward and cached decode throughput,
+    # their measured peak memory, next to the K/V cache size from the formula, and the attention parameters
+    import subprocess
+    g = GQA_SHAPE
+    B, T, n_layer, n_head, n_embd = g["B"], g["T"], g["n_layer"], g["n_head"], g["n_embd"]
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name, n_kv_head in [("mha", n_head), ("gqa2", 2), ("mqa", 1)]:
+        model = gqa_model(n_kv_head)
+        x = torch.randint(0, 50257, (B, T))
+        dt = measure(lambda: forward_blocks(model, x), iters=args.iters)
+        results[f"{name}_tokens_per_sec"] = B * T / dt
+        prompt = x[:, :GQA_PROMPT]
+        dt = measure(lambda: decode_with_kv_cache(model, prompt, T - GQA_PROMPT), iters=args.iters)
+        results[f"{name}_decode_tokens_per_sec"] = B * (T - GQA_PROMPT) / dt
+        for kind in ("forward", "decode"):
+            # in a fresh process, so memory freed by earlier runs can't hide the peak, and with a fixed
+            # mmap threshold: glibc then returns every freed tensor to the OS, without it the RSS
+            # peak depends on its heap history and varies by 2-4x from run to run
+            env = dict(os.environ, MALLOC_MMAP_THRESHOLD_="65536")
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--peak_memory", f"{kind}:{n_kv_head}"],
+                                 cwd=repo_dir, env=env, capture_output=True, text=True, check=True)
+            results[f"{name}_{kind}_peak_bytes"] = float(out.stdout.strip().splitlines()[-1])
+        # the formula: k and v, fp32, every layer
+        results[f"{name}_formula_kv_bytes_per_token"] = 2 * n_layer * n_kv_head * (n_embd // n_head) * 4
+        results[f"{name}_formula_kv_cache_bytes"] = results[f"{name}_formula_kv_bytes_per_token"] * B * T
+        results[f"{name}_attn_param_bytes"] = sum(p.numel() * 4 for n, p in model.named_parameters() if ".attn." in n)
+    return results
+
+# -----------------------------------------------------------------------------
+# eval
+
+@benchmark("hellaswag_scoring")
+def bench_hellaswag_scoring(args):
+    from train_gpt2 import GPT
+    from eval_harness import TASKS, evaluate_tasks
+    rng = random.Random(0)
+    contexts = random_docs(40, 20, seed=1)
+    examples = [([(ctx, " " + e) for e in random_docs(4, 8, seed=i + 2)], rng.randrange(4)) for i, ctx in enumerate(contexts)]
+    TASKS["synthetic_hellaswag"] = lambda: iter(examples)
+    torch.manual_seed(1337)
+    model = GPT(tiny_config())
+    model.eval()
+    dt = measure(lambda: evaluate_tasks(model, ["synthetic_hellaswag"], "cpu"), iters=args.iters)
+    return {"examples_per_sec": len(examples) / dt}
+
+# -----------------------------------------------------------------------------
+
+def compare(results, baseline, threshold):
+    """Returns the list of (benchmark, metric, baseline, current) that regressed by more than threshold"""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            if base is None:
+                continue
+            change = value / base - 1.0
+            # throughputs should go up, *_seconds and *_bytes metrics should go down
+            lower_is_better = metric.endswith("_seconds") or metric.endswith("_bytes") or metric.endswith("_bytes_per_token")
+            regressed = change > threshold if lower_is_better else change < -threshold
+            flag = "REGRESSION" if regressed else ""
+            print(f"{name:20s} {metric:30s} {base:14.4f} -> {value:14.4f} ({change:+.1%}) {flag}")
+            if regressed:
+                regressions.append((name, metric, base, value))
+    return regressions
+
+def main(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    results = {}
+    for name in names:
+        t0 = time.time()
+        results[name] = BENCHMARKS[name](args)
+        metrics = " | ".join(f"{k}: {v:.2f}" for k, v in results[name].items())
+        print(f"{name} ({time.time() - t0:.1f}s): {metrics}", flush=True)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.output}")
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote baseline {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", type=str, default=None, help=f"comma separated subset of {','.join(BENCHMARKS)}")
+    parser.add_argument("--iters", type=int, default=5, help="timed iterations per measurement, the median is reported")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads")
+    parser.add_argument("--output", type=str, default="bench_results.json", help="where to write the results")
+    parser.add_argument("--baseline", type=str, default="bench_baseline.json", help="baseline to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative drop that counts as a regression")
+    parser.add_argument("--save_baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--peak_memory", type=str, default=None, help=argparse.SUPPRESS) # kind:n_kv_head, one gqa_attention measurement
+    args = parser.parse_args()
+    if args.peak_memory is not None:
+        kind, n_kv_head = args.peak_memory.split(":")
+        print(peak_memory_bytes(kind, int(n_kv_head)))
+    else:
+        main(args)
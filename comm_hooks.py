@@ -0,0 +1,168 @@
+"""
+Communication hooks for the DDP gradient all-reduce, with per-step accounting of the
+time and bytes spent on it.
+
+- allreduce: the default, fp32 gradients (the same as no hook, but measured)
+- fp16 / bf16: gradients are cast to 16 bits for the all-reduce and back, half the bytes
+- powersgd: rank-r PowerSGD (Vogels et al. 2019) with error feedback and warm start.
+  Every 2D gradient of shape (n, m) is sent as two matrices P (n, r) and Q (m, r), the
+  part of the gradient the approximation missed is carried over to the next step. The
+  first start_iter steps use plain all-reduce, biases and layernorms always do.
+
+The bucket size (DDP's bucket_cap_mb) sets how many gradients are all-reduced together:
+bigger buckets mean fewer, larger messages, smaller ones start communicating earlier in
+the backward pass.
+
+torchrun --nproc_per_node=8 train_gpt2.py --comm_hook powersgd --powersgd_rank 4 --bucket_cap_mb 50
+
+comm time is measured from launching a bucket's all-reduce until it completes, so it
+includes the part that overlaps with the rest of the backward pass.
+
+Loss parity of every hook against the uncompressed all-reduce, on CPU with gloo:
+
+torchrun --standalone --nproc_per_node=2 comm_hooks.py
+"""
+
+import time
+import threading
+import torch
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+# -----------------------------------------------------------------------------
+COMM_HOOKS = ("allreduce", "fp16", "bf16", "powersgd")
+
+class CommStats:
+    """Accumulates the comm time and bytes of the hooks, read and reset once per step"""
+
+    def __init__(self):
+        self.lock = threading.Lock() # the futures complete on the comm threads
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def add(self, seconds, nbytes):
+        with self.lock:
+            self.seconds += seconds
+            self.bytes += nbytes
+
+    def reset(self):
+        """Returns (seconds, bytes) since the last reset"""
+        with self.lock:
+            seconds, nbytes = self.seconds, self.bytes
+            self.seconds, self.bytes = 0.0, 0
+        return seconds, nbytes
+
+def _allreduce_bytes(element_size):
+    def bucket_bytes(state, bucket):
+        return bucket.buffer().numel() * element_size
+    return bucket_bytes
+
+def _powersgd_bytes(state, bucket):
+    if state.iter < state.start_powerSGD_iter:
+        return bucket.buffer().numel() * bucket.buffer().element_size()
+    nbytes = 0
+    for grad in bucket.gradients():
+        element_size = grad.element_size()
+        if grad.dim() <= 1:
+            nbytes += grad.numel() * element_size
+            continue
+        n = grad.shape[0]
+        m = grad.numel() // n
+        compress, uncompressed, compressed = powerSGD_hook._should_compress(n, m, state.matrix_approximation_rank, state.min_compression_rate)
+        nbytes += (compressed if compress else uncompressed) * element_size
+    return nbytes
+
+def _timed(hook, bytes_fn, stats):
+    def timed_hook(state, bucket):
+        nbytes = bytes_fn(state, bucket)
+        t0 = time.perf_counter()
+        def done(fut):
+            stats.add(time.perf_counter() - t0, nbytes)
+            return fut.value()
+        return hook(state, bucket).then(done)
+    return timed_hook
+
+def register_comm_hook(ddp_model, name, process_group=None, powersgd_rank=4, start_iter=10):
+    """Registers the named hook on a DDP model, returns the CommStats it reports to"""
+    assert name in COMM_HOOKS, f"unknown comm hook {name}, choose from {COMM_HOOKS}"
+    stats = CommStats()
+    if name == "powersgd":
+        state = powerSGD_hook.PowerSGDState(process_group=process_group, matrix_approximation_rank=powersgd_rank,
+                                            start_powerSGD_iter=start_iter, use_error_feedback=True, warm_start=True)
+        hook = _timed(powerSGD_hook.powerSGD_hook, _powersgd_bytes, stats)
+    else:
+        state = process_group
+        hook, element_size = {
+            "allreduce": (default_hooks.allreduce_hook, 4),
+            "fp16": (default_hooks.fp16_compress_hook, 2),
+            "bf16": (default_hooks.bf16_compress_hook, 2),
+        }[name]
+        hook = _timed(hook, _allreduce_bytes(element_size), stats)
+    ddp_model.register_comm_hook(state, hook)
+    return stats
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    # trains the same small GPT from the same init on the same data with every hook and
+    # compares the loss curves against the uncompressed all-reduce
+    import argparse
+    from torch.nn.parallel import DistributedDataParallel as DDP
+    from train_gpt2 import GPT, GPTConfig
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=100, help="optimization steps per hook")
+    parser.add_argument("--powersgd_rank", type=int, default=4, help="rank of the PowerSGD approximation")
+    parser.add_argument("--bucket_cap_mb", type=float, default=1.0, help="DDP bucket size")
+    parser.add_argument("--start_iter", type=int, default=20, help="steps of plain all-reduce before PowerSGD starts")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="allowed relative difference of the final loss (mean of the last 10 steps)")
+    args = parser.parse_args()
+
+    dist.init_process_group(backend="gloo")
+    rank = dist.get_rank()
+    torch.set_num_threads(1)
+    config = GPTConfig(block_size=64, vocab_size=512, n_layer=2, n_head=4, n_embd=64)
+    B, T = 8, 32
+    # a synthetic token stream from a Markov chain with a low-rank transition matrix, which
+    # (like natural text, unlike e.g. a fixed permutation) has a low-rank structure to learn
+    g = torch.Generator().manual_seed(0)
+    U, V = torch.randn(config.vocab_size, 8, generator=g), torch.randn(config.vocab_size, 8, generator=g)
+    transitions = torch.softmax(U @ V.T, dim=-1)
+    data = torch.zeros(1 << 16, dtype=torch.long)
+    for i in range(1, len(data)):
+        data[i] = torch.multinomial(transitions[data[i - 1]], 1, generator=g)
+
+    losses = {}
+    for name in COMM_HOOKS:
+        torch.manual_seed(1337)
+        model = DDP(GPT(config), bucket_cap_mb=args.bucket_cap_mb)
+        stats = register_comm_hook(model, name, powersgd_rank=args.powersgd_rank, start_iter=args.start_iter)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=6e-4) # max_lr of train_gpt2.py
+        losses[name] = []
+        comm_seconds, comm_bytes = 0.0, 0
+        for step in range(args.steps):
+            offset = (step * dist.get_world_size() + rank) * B * T % (len(data) - B * T - 1)
+            buf = data[offset:offset + B * T + 1]
+            x, y = buf[:-1].view(B, T), buf[1:].view(B, T)
+            _, loss = model(x, y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            loss = loss.detach().clone()
+            dist.all_reduce(loss, op=dist.ReduceOp.AVG)
+            losses[name].append(loss.item())
+            seconds, nbytes = stats.reset()
+            if step >= args.start_iter: # after the PowerSGD warmup
+                comm_seconds += seconds
+                comm_bytes += nbytes
+        steps = args.steps - args.start_iter
+        if rank == 0:
+            print(f"{name:10s} | final loss {sum(losses[name][-10:]) / 10:.4f} | {comm_bytes / steps / 1e6:.3f} MB/step | {comm_seconds / steps * 1000:.2f} ms comm/step")
+
+    if rank == 0:
+        final = {name: sum(l[-10:]) / 10 for name, l in losses.items()}
+        for name in COMM_HOOKS:
+            diff = abs(final[name] - final["allreduce"]) / final["allreduce"]
+            print(f"{name:10s} | relative difference of the final loss vs allreduce: {diff:.2e}")
+            assert diff < args.tolerance, f"{name} diverged from the uncompressed all-reduce"
+        print("OK")
+    dist.destroy_process_group()
@@ -0,0 +1,34 @@
+"""
+Converts a multi-head attention checkpoint to grouped-query (or, with --n_kv_head 1,
+multi-query) attention by mean-pooling the key and value heads of every group, see
+GPT.pool_kv_heads. The converted model is a starting point for a short fine-tune, not
+a drop-in replacement: pooling changes what every query head attends with.
+
+python convert_gqa.py log/model_19072.pt --n_kv_head 4 --out log/model_19072_gqa4.pt
+python convert_gqa.py gpt2 --n_kv_head 1 --out log/gpt2_mqa.pt     # from the pretrained weights
+"""
+
+import time
+import argparse
+import torch
+from train_gpt2 import GPT, load_checkpoint
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint", type=str, help="a log/model_*.pt checkpoint, or gpt2/gpt2-medium/... for the pretrained weights")
+    parser.add_argument("--n_kv_head", type=int, required=True, help="number of key/value heads after the conversion")
+    parser.add_argument("--out", type=str, required=True, help="where to write the converted checkpoint")
+    args = parser.parse_args()
+
+    if args.checkpoint.startswith("gpt2"):
+        model = GPT.from_pretrained(args.checkpoint)
+        checkpoint = {'model': model.state_dict(), 'config': model.config, 'step': 0}
+    else:
+        checkpoint = load_checkpoint(args.checkpoint)
+    state_dict = {k.removeprefix('_orig_mod.'): v for k, v in checkpoint['model'].items()}
+    t0 = time.time()
+    state_dict, config = GPT.pool_kv_heads(state_dict, checkpoint['config'], args.n_kv_head)
+    checkpoint = dict(checkpoint, model=state_dict, config=config)
+    GPT.from_checkpoint(checkpoint) # make sure the result loads
+    torch.save(checkpoint, args.out)
+    print(f"pooled {config.n_head} heads into {config.n_kv_head} kv heads in {time.time() - t0:.2f}s, wrote {args.out}")
@@ -0,0 +1,232 @@
+"""
+Exact and near-duplicate removal for the fineweb pipeline, run before tokenization.
+
+For every document, in order:
+1. exact document dedup: a 64-bit hash of the stripped text
+2. near-duplicate dedup: MinHash over word 5-gram shingles, banded for LSH. A document
+   is dropped when any of its bands matches a band of a document we already kept
+   (NUM_BANDS x ROWS_PER_BAND = 16 x 8 catches pairs above roughly 0.7 Jaccard similarity)
+3. exact line dedup: every line of at least MIN_LINE_CHARS characters that was already
+   seen anywhere in the corpus is removed (repeated headers, licenses, boilerplate)
+
+The hashing and MinHash signatures are computed in a worker pool; the keep/drop decisions
+are made in order in the main process. All three sets of seen fingerprints live in Bloom
+filters of a fixed size, so memory is bounded no matter how large the corpus is, at the
+price of a small false positive rate (a unique document is very occasionally dropped).
+
+The filters are saved as a fingerprint index (together with the list of input files that
+went into it), so a later incremental run only hashes the new files and dedups them
+against everything that came before:
+
+python fineweb.py --source 2 --dedup
+python dedup.py edu_fineweb10B/dedup_index.npz   # inspect an index
+"""
+
+import os
+import json
+import zlib
+import hashlib
+import numpy as np
+
+# -----------------------------------------------------------------------------
+NUM_PERM = 128 # MinHash permutations
+NUM_BANDS = 16 # LSH bands of NUM_PERM // NUM_BANDS rows each
+SHINGLE_WORDS = 5
+MIN_LINE_CHARS = 30 # shorter lines (blank lines, "Chapter 1", ...) are never removed
+MINHASH_SEED = 1337
+MERSENNE_PRIME = (1 << 31) - 1 # a * x + b stays below 2**63 for 32-bit shingle hashes
+INDEX_SPLIT = {"docs": 0.125, "lines": 0.5, "bands": 0.375} # share of the index memory per filter
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8) # set bits of every byte value
+
+_rng = np.random.default_rng(MINHASH_SEED)
+PERM_A = _rng.integers(1, MERSENNE_PRIME, size=(NUM_PERM, 1), dtype=np.uint64)
+PERM_B = _rng.integers(0, MERSENNE_PRIME, size=(NUM_PERM, 1), dtype=np.uint64)
+
+def hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+def minhash_signature(text):
+    """(NUM_PERM,) MinHash signature of the word shingles of text, None for an empty text"""
+    words = text.lower().split()
+    if not words:
+        return None
+    n = max(1, len(words) - SHINGLE_WORDS + 1)
+    shingles = {zlib.crc32(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8")) for i in range(n)}
+    x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))[None, :]
+    return ((PERM_A * x + PERM_B) % MERSENNE_PRIME).min(axis=1)
+
+def band_keys(signature):
+    """One 64-bit key per LSH band, the band index is mixed in so bands never collide"""
+    rows = signature.reshape(NUM_BANDS, -1)
+    return np.array([hash64(f"{b}:" + rows[b].tobytes().hex()) for b in range(NUM_BANDS)], dtype=np.uint64)
+
+def fingerprint(doc):
+    """
+    Runs in a worker process. Returns the text with its document hash, the hashes of its
+    lines (0 for lines too short to dedup) and the LSH band keys (None for empty texts).
+    """
+    text = doc["text"] if isinstance(doc, dict) else doc
+    lines = text.split("\n")
+    line_hashes = np.array([hash64(l.strip()) if len(l.strip()) >= MIN_LINE_CHARS else 0 for l in lines], dtype=np.uint64)
+    signature = minhash_signature(text)
+    bands = band_keys(signature) if signature is not None else None
+    return text, hash64(text.strip()), line_hashes, bands
+
+_enc = None
+
+def count_tokens(text):
+    global _enc
+    if _enc is None:
+        import tiktoken
+        _enc = tiktoken.get_encoding("gpt2")
+    return len(_enc.encode_ordinary(text))
+
+# -----------------------------------------------------------------------------
+
+class BloomFilter:
+
+    def __init__(self, num_bits, num_hashes=7, bits=None):
+        assert num_bits & (num_bits - 1) == 0, "num_bits must be a power of 2"
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else np.zeros(num_bits // 8, dtype=np.uint8)
+
+    def _positions(self, keys):
+        # double hashing: position i is h1 + i * h2, uint64 arithmetic wraps around
+        keys = np.asarray(keys, dtype=np.uint64)
+        h2 = (keys >> np.uint64(32)) | np.uint64(1)
+        i = np.arange(self.num_hashes, dtype=np.uint64)
+        return (keys[:, None] + i[None, :] * h2[:, None]) & np.uint64(self.num_bits - 1)
+
+    def contains(self, keys):
+        pos = self._positions(keys)
+        hits = (self.bits[pos >> np.uint64(3)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1
+        return hits.all(axis=1)
+
+    def add(self, keys):
+        pos = self._positions(keys).ravel()
+        np.bitwise_or.at(self.bits, pos >> np.uint64(3), (1 << (pos & np.uint64(7))).astype(np.uint8))
+
+    def fill_ratio(self, chunk_bytes=1 << 24):
+        # popcount through a lookup table a chunk at a time, unpackbits would need 8x the filter in memory
+        set_bits = sum(int(POPCOUNT[self.bits[i:i + chunk_bytes]].sum(dtype=np.int64)) for i in range(0, len(self.bits), chunk_bytes))
+        return set_bits / self.num_bits
+
+class FingerprintIndex:
+    """The seen documents, lines and LSH bands, plus the input files already processed"""
+
+    def __init__(self, memory_mb=1024):
+        total_bits = memory_mb * 8 * 1024 * 1024
+        # round every filter down to a power of 2 bits
+        self.filters = {name: BloomFilter(1 << int(np.log2(total_bits * share))) for name, share in INDEX_SPLIT.items()}
+        self.files = {} # path -> [size, mtime]
+
+    def file_is_indexed(self, path):
+        st = os.stat(path)
+        return self.files.get(path) == [st.st_size, st.st_mtime]
+
+    def add_file(self, path):
+        st = os.stat(path)
+        self.files[path] = [st.st_size, st.st_mtime]
+
+    def save(self, path):
+        meta = {"num_perm": NUM_PERM, "num_bands": NUM_BANDS, "shingle_words": SHINGLE_WORDS,
+                "min_line_chars": MIN_LINE_CHARS, "seed": MINHASH_SEED, "files": self.files,
+                "num_hashes": {name: f.num_hashes for name, f in self.filters.items()}}
+        # write then rename, so an interrupted save never leaves a corrupt index behind. savez
+        # streams into the open file, without a copy of the filters in memory
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **{name: filt.bits for name, filt in self.filters.items()})
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        meta = json.loads(str(data["meta"]))
+        assert (meta["num_perm"], meta["num_bands"], meta["shingle_words"], meta["min_line_chars"], meta["seed"]) == \
+            (NUM_PERM, NUM_BANDS, SHINGLE_WORDS, MIN_LINE_CHARS, MINHASH_SEED), f"{path} was built with different dedup settings"
+        index = cls.__new__(cls)
+        index.filters = {name: BloomFilter(len(data[name]) * 8, meta["num_hashes"][name], bits=data[name].copy()) for name in INDEX_SPLIT}
+        index.files = meta["files"]
+        return index
+
+# -----------------------------------------------------------------------------
+
+class Deduplicator:
+
+    def __init__(self, index, nprocs=None):
+        self.index = index
+        self.nprocs = nprocs or max(1, os.cpu_count() // 2)
+        self.stats = {"docs": 0, "docs_kept": 0, "docs_exact": 0, "docs_near": 0, "lines_removed": 0, "tokens_removed": 0}
+
+    def dedup_document(self, text, doc_hash, line_hashes, bands):
+        """Returns the text to keep (None to drop the document) and the text that was removed"""
+        docs, lines, band_filter = self.index.filters["docs"], self.index.filters["lines"], self.index.filters["bands"]
+        self.stats["docs"] += 1
+        doc_key = np.array([doc_hash], dtype=np.uint64)
+        if docs.contains(doc_key)[0]:
+            self.stats["docs_exact"] += 1
+            return None, text
+        if bands is not None and band_filter.contains(bands).any():
+            self.stats["docs_near"] += 1
+            return None, text
+        docs.add(doc_key)
+        if bands is not None:
+            band_filter.add(bands)
+        # drop lines seen before, in earlier documents or earlier in this one
+        dedupable = line_hashes != 0
+        seen = np.zeros(len(line_hashes), dtype=bool)
+        if dedupable.any():
+            seen[dedupable] = lines.contains(line_hashes[dedupable])
+            _, first = np.unique(line_hashes, return_index=True)
+            repeated = np.ones(len(line_hashes), dtype=bool)
+            repeated[first] = False
+            seen |= repeated & dedupable
+            lines.add(line_hashes[dedupable & ~seen])
+        if not seen.any():
+            self.stats["docs_kept"] += 1
+            return text, ""
+        text_lines = text.split("\n")
+        self.stats["lines_removed"] += int(seen.sum())
+        self.stats["docs_kept"] += 1
+        kept = "\n".join(l for l, s in zip(text_lines, seen) if not s)
+        removed = "\n".join(l for l, s in zip(text_lines, seen) if s)
+        return kept, removed
+
+    def filter(self, data_iterator):
+        """
+        Yields the deduplicated texts of data_iterator, counting the tokens removed on the side.
+        It runs its own Pool, so consume it from the main thread (not as the input of another pool.imap).
+        """
+        import multiprocessing as mp
+        pending = []
+        with mp.Pool(self.nprocs) as pool:
+            for text, doc_hash, line_hashes, bands in pool.imap(fingerprint, data_iterator, chunksize=16):
+                kept, removed = self.dedup_document(text, doc_hash, line_hashes, bands)
+                if removed:
+                    pending.append(pool.apply_async(count_tokens, (removed,)))
+                    if len(pending) >= 1024:
+                        self.stats["tokens_removed"] += sum(r.get() for r in pending)
+                        pending = []
+                if kept is not None:
+                    yield kept
+            self.stats["tokens_removed"] += sum(r.get() for r in pending)
+
+    def report(self, tokens_kept=None):
+        s = self.stats
+        msg = (f"dedup: {s['docs']} documents | {s['docs_exact']} exact duplicates | {s['docs_near']} near duplicates | "
+               f"{s['lines_removed']} duplicate lines | {s['tokens_removed']} tokens removed")
+        if tokens_kept is not None:
+            total = tokens_kept + s["tokens_removed"]
+            msg += f" ({s['tokens_removed'] / max(1, total):.2%} of {total})"
+        print(msg)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="a dedup_index.npz fingerprint index")
+    args = parser.parse_args()
+    index = FingerprintIndex.load(args.path)
+    for name, f in index.filters.items():
+        print(f"{name}: {f.num_bits / 8 / 1024**2:.0f}MB, {f.fill_ratio():.2%} of bits set")
+    print(f"{len(index.files)} input files indexed")
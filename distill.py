@@ -0,0 +1,164 @@
+"""
+Distillation from a pretrained GPT-2 (or any of our checkpoints) into a smaller student,
+without the teacher in the training loop.
+
+1) an offline pass runs the teacher over the token shards once and stores, for every
+   position of a shard, the top-k next-token logits of the teacher in two side files
+   aligned with the shard: <shard>.indices.npy (uint16, N x k) and <shard>.logits.npy
+   (fp16, N x k), written and later read as memory maps. k=32 costs 128 bytes per token
+   next to the 2 of the token itself, so they go in their own directory.
+
+python distill.py --teacher gpt2 --data_root edu_fineweb10B --out_dir edu_fineweb10B_gpt2_top32 --top_k 32
+torchrun --standalone --nproc_per_node=8 distill.py --teacher gpt2-xl ...   # shards split over the ranks
+
+2) training reads the side files alongside the DataLoaderLite batches and adds a KL term
+   between the teacher's top-k distribution (renormalized over the k tokens) and the
+   student, mixed with the usual cross-entropy:
+
+python train_gpt2.py --n_layer 6 --teacher_dir edu_fineweb10B_gpt2_top32 --distill_alpha 0.5 --distill_temperature 1.0
+
+The teacher sees every shard in fixed windows of --seq_len tokens starting at the shard
+start, so the logits of a position are conditioned on the 1 to seq_len tokens since the
+start of its window. The student's batches are cut at other offsets (they depend on B, T,
+the world size and the tail carried over between shards), so a position's context generally
+differs between the two: early in a teacher window the teacher saw less than the student,
+early in a student row the student sees less than the teacher did.
+"""
+
+import os
+import time
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+VOCAB = 50257 # the real GPT-2 vocab, our models pad it to 50304
+
+# -----------------------------------------------------------------------------
+
+def side_files(teacher_dir, shard):
+    name = os.path.basename(shard).removesuffix(".npy")
+    return os.path.join(teacher_dir, f"{name}.indices.npy"), os.path.join(teacher_dir, f"{name}.logits.npy")
+
+class TeacherTopK:
+    """Reads the top-k side files of a list of shards as one stream, like DataLoaderLite reads the shards"""
+
+    def __init__(self, teacher_dir, shards):
+        self.files = [side_files(teacher_dir, shard) for shard in shards]
+        for indices_file, logits_file in self.files:
+            assert os.path.exists(indices_file) and os.path.exists(logits_file), f"missing teacher logits {indices_file}, run distill.py first"
+        self.maps = [None] * len(self.files) # opened on first use
+        # shard lengths from the headers, to map stream offsets to (shard, position)
+        self.lengths = [len(np.load(shard, mmap_mode="r")) for shard in shards]
+        self.starts = np.concatenate([[0], np.cumsum(self.lengths)])
+        self.top_k = self.shard(0)[0].shape[1]
+
+    def shard(self, i):
+        if self.maps[i] is None:
+            indices_file, logits_file = self.files[i]
+            self.maps[i] = (np.load(indices_file, mmap_mode="r"), np.load(logits_file, mmap_mode="r"))
+            assert len(self.maps[i][0]) == self.lengths[i], f"{indices_file} is not aligned with its shard"
+        return self.maps[i]
+
+    def read(self, offset, n):
+        """(indices, logits) of n positions starting at offset of the stream of all shards, wrapping around"""
+        offset %= int(self.starts[-1])
+        shard = int(np.searchsorted(self.starts, offset, side="right")) - 1
+        position = offset - int(self.starts[shard])
+        indices, logits = [], []
+        while n > 0:
+            shard_indices, shard_logits = self.shard(shard)
+            indices.append(shard_indices[position:position + n])
+            logits.append(shard_logits[position:position + n])
+            n -= len(indices[-1])
+            shard, position = (shard + 1) % len(self.files), 0
+        indices = torch.from_numpy(np.concatenate(indices).astype(np.int64))
+        logits = torch.from_numpy(np.concatenate(logits).astype(np.float32))
+        return indices, logits
+
+def distill_loss(logits, teacher_indices, teacher_logits, temperature=1.0):
+    """KL(teacher || student) over the teacher's top-k tokens, averaged over positions
+
+    logits: (B, T, V) student logits, teacher_indices/teacher_logits: (B, T, k)
+    The teacher distribution is the softmax of its k logits (the mass outside the top-k is
+    dropped), the student's is its full softmax at those k tokens. Scaled by temperature**2
+    so the gradient magnitude does not depend on the temperature (Hinton et al. 2015).
+    """
+    teacher_logprobs = F.log_softmax(teacher_logits.float() / temperature, dim=-1)
+    # only the k teacher tokens of the student's log-softmax are used: gather their logits and
+    # normalize with one logsumexp instead of materializing another full (B, T, V) log-softmax
+    logits = logits.float() if temperature == 1.0 else logits.float() / temperature
+    student_logprobs = logits.gather(-1, teacher_indices) - torch.logsumexp(logits, dim=-1, keepdim=True)
+    kl = (teacher_logprobs.exp() * (teacher_logprobs - student_logprobs)).sum(-1)
+    return kl.mean() * temperature ** 2
+
+@torch.no_grad()
+def write_teacher_topk(model, shard, teacher_dir, top_k, seq_len, batch_size, device, autocast_dtype=None):
+    """Runs the teacher over one shard and writes its side files, returns the number of positions"""
+    indices_file, logits_file = side_files(teacher_dir, shard)
+    tokens = np.load(shard, mmap_mode="r")
+    n = len(tokens)
+    # write to temporary names first, so an interrupted pass never leaves a truncated pair behind
+    indices_out = np.lib.format.open_memmap(indices_file + ".tmp", mode="w+", dtype=np.uint16, shape=(n, top_k))
+    logits_out = np.lib.format.open_memmap(logits_file + ".tmp", mode="w+", dtype=np.float16, shape=(n, top_k))
+    for start in range(0, n, batch_size * seq_len):
+        end = min(n, start + batch_size * seq_len)
+        # windows start at multiples of seq_len from the shard start, not where the student's rows do
+        windows = [torch.from_numpy(tokens[i:min(end, i + seq_len)].astype(np.int64)) for i in range(start, end, seq_len)]
+        # the last window of a shard can be short, pad it and drop the padding afterwards
+        lengths = [len(w) for w in windows]
+        x = torch.zeros((len(windows), max(lengths)), dtype=torch.long)
+        for i, w in enumerate(windows):
+            x[i, :len(w)] = w
+        x = x.to(device)
+        with torch.autocast(device_type="cuda" if str(device).startswith("cuda") else "cpu", dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            logits, _ = model(x)
+        values, indices = torch.topk(logits[..., :VOCAB].float(), top_k, dim=-1)
+        values, indices = values.cpu(), indices.cpu()
+        offset = start
+        for i, length in enumerate(lengths):
+            indices_out[offset:offset + length] = indices[i, :length].numpy().astype(np.uint16)
+            logits_out[offset:offset + length] = values[i, :length].numpy().astype(np.float16)
+            offset += length
+    indices_out.flush()
+    logits_out.flush()
+    del indices_out, logits_out
+    os.replace(indices_file + ".tmp", indices_file)
+    os.replace(logits_file + ".tmp", logits_file)
+    return n
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--teacher", type=str, default="gpt2", help="gpt2/gpt2-medium/... or a log/model_*.pt checkpoint")
+    parser.add_argument("--data_root", type=str, default="edu_fineweb10B", help="directory with the token shards")
+    parser.add_argument("--out_dir", type=str, required=True, help="where to write the side files")
+    parser.add_argument("--split", type=str, default="train", help="train, val or all")
+    parser.add_argument("--top_k", type=int, default=32, help="logits kept per position")
+    parser.add_argument("--seq_len", type=int, default=1024, help="context window of the teacher")
+    parser.add_argument("--batch_size", type=int, default=8, help="windows per teacher forward")
+    parser.add_argument("-d", "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="the device to use")
+    args = parser.parse_args()
+
+    from train_gpt2 import GPT, load_checkpoint, get_best_float_config
+    # with torchrun every rank takes every world_size-th shard, no communication needed
+    rank, world_size = int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+    device = f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}" if args.device == "cuda" and world_size > 1 else args.device
+    model = GPT.from_pretrained(args.teacher) if args.teacher.startswith("gpt2") else GPT.from_checkpoint(load_checkpoint(args.teacher))
+    model.to(device)
+    model.eval()
+    assert args.seq_len <= model.config.block_size, f"the teacher's context is only {model.config.block_size} tokens"
+    dtype = get_best_float_config() if str(device).startswith("cuda") else None
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    shards = sorted(s for s in os.listdir(args.data_root) if s.endswith(".npy") and (args.split == "all" or args.split in s))
+    for shard in shards[rank::world_size]:
+        shard = os.path.join(args.data_root, shard)
+        if all(os.path.exists(f) for f in side_files(args.out_dir, shard)):
+            print(f"rank {rank}: {shard} already done, skipping", flush=True)
+            continue
+        t0 = time.time()
+        n = write_teacher_topk(model, shard, args.out_dir, args.top_k, args.seq_len, args.batch_size, device, dtype)
+        dt = time.time() - t0
+        print(f"rank {rank}: {shard} | {n:,} positions in {dt:.1f}s | {n / dt:,.0f} tok/sec", flush=True)
@@ -0,0 +1,140 @@
+"""
+Elastic, fault-tolerant training with torchrun.
+
+A failed worker or a node joining/leaving makes the torchrun agents tear down all the
+workers and start them again with the new membership (up to --max_restarts times). The
+workers then continue from the last resume checkpoint, which train_gpt2.py writes so that
+it does not depend on the number of ranks:
+
+- log_dir/latest.pt holds the weights, the optimizer state (replicated under DDP), the
+  tokens seen and the global batch size, written every --checkpoint_every steps through a
+  temporary file, so a worker killed mid-write never leaves a torn checkpoint
+- the data position is the offset of the whole world into the stream of all shards, on
+  resume it is re-partitioned over the current ranks, so no tokens are lost or repeated
+- grad_accum_steps is recomputed from --total_batch_size and the current world size,
+  so the global batch (and with it the loss curve) stays the same. The step sizes of the
+  seq-len and batch warmup do depend on the world size, so during the warmup a run can
+  only resume with the world size it had (train_gpt2.py asserts this)
+- metrics.bin is cut back to the checkpoint step, so the steps run again are logged once
+
+torchrun --nnodes=1:4 --nproc_per_node=8 --max_restarts=10 --rdzv_backend=c10d --rdzv_endpoint=$HEAD_NODE:29400 \\
+    train_gpt2.py --resume --checkpoint_every 100 --total_batch_size 524288
+
+A check with local CPU processes: a reference run with 2 ranks, and an elastic run that
+starts with 2 ranks, gets one of them killed (torchrun restarts both), loses a rank (the
+job is stopped and relaunched with 1) and gains three (relaunched with 4). The loss of
+every step and the final data position have to match the reference:
+
+python elastic.py
+"""
+
+import os
+import sys
+import time
+import signal
+import tempfile
+import subprocess
+import numpy as np
+from train_gpt2 import load_checkpoint
+
+# -----------------------------------------------------------------------------
+
+def launch(nproc, log_dir, common_args, max_restarts=0):
+    """Starts torchrun in its own process group, the output goes to log_dir.out"""
+    cmd = [sys.executable, "-m", "torch.distributed.run", "--standalone", f"--nproc_per_node={nproc}", f"--max_restarts={max_restarts}",
+           "train_gpt2.py", "--log_dir", log_dir] + common_args
+    with open(log_dir + ".out", "a") as out:
+        return subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+
+def latest_step(log_dir):
+    """The step of log_dir/latest.pt, -1 if there is none yet"""
+    path = os.path.join(log_dir, "latest.pt")
+    try:
+        return load_checkpoint(path)['step']
+    except (FileNotFoundError, EOFError, RuntimeError):
+        return -1
+
+def wait_for_step(proc, log_dir, step, timeout=600):
+    t0 = time.time()
+    while latest_step(log_dir) < step:
+        assert proc.poll() is None, f"the run exited (code {proc.returncode}) before step {step}"
+        if time.time() - t0 > timeout:
+            stop(proc)
+            raise AssertionError(f"no checkpoint of step {step} after {timeout}s")
+        time.sleep(0.05)
+
+def children(pid):
+    return [int(child) for child in subprocess.run(["pgrep", "-P", str(pid)], capture_output=True, text=True).stdout.split()]
+
+def stop(proc):
+    """Stops a whole torchrun job, as if its node went away"""
+    # workers of a restarted group are not always in the agent's process group, kill the whole tree
+    pids, i = [proc.pid], 0
+    while i < len(pids):
+        pids += children(pids[i])
+        i += 1
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    proc.wait()
+
+def train_losses(log_dir):
+    """{step: loss}, checking that the steps run again after a resume were logged only once"""
+    from metrics import read_metrics, KINDS
+    m = read_metrics(os.path.join(log_dir, "metrics.bin"))
+    train = m[m['kind'] == KINDS.index("train")]
+    assert (np.diff(train['step']) == 1).all(), f"the train records of {log_dir} are not one per step in order"
+    return {int(r['step']): float(r['value']) for r in train}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=40, help="optimization steps of the run")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="allowed relative difference of the loss of a step")
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # synthetic shards with a shard boundary every few steps
+        data_root = os.path.join(tmp, "data")
+        os.makedirs(data_root)
+        rng = np.random.default_rng(0)
+        for split, num_shards in [("train", 3), ("val", 1)]:
+            for i in range(num_shards):
+                np.save(os.path.join(data_root, f"edufineweb_{split}_{i:06d}.npy"), rng.integers(0, 50257, 5000 + 111 * i, dtype=np.uint16))
+        # 256 tokens per step: grad_accum_steps is 4, 2 and 1 with 1, 2 and 4 ranks
+        common_args = ["--data_root", data_root, "--n_layer", "2", "--n_head", "2", "--n_embd", "64", "--micro_batch_size", "2",
+                       "--seq_len", "32", "--total_batch_size", "256", "--max_steps", str(args.steps), "--checkpoint_every", "2", "--resume"]
+
+        reference_dir = os.path.join(tmp, "reference")
+        print("reference run, 2 ranks", flush=True)
+        assert launch(2, reference_dir, common_args).wait() == 0, "the reference run failed"
+
+        elastic_dir = os.path.join(tmp, "elastic")
+        print("elastic run, 2 ranks", flush=True)
+        proc = launch(2, elastic_dir, common_args, max_restarts=3)
+        wait_for_step(proc, elastic_dir, args.steps // 4)
+        worker = children(proc.pid)[0]
+        os.kill(worker, signal.SIGKILL)
+        print(f"  killed worker {worker} after step {latest_step(elastic_dir)}, torchrun restarts the group", flush=True)
+        wait_for_step(proc, elastic_dir, args.steps // 2)
+        stop(proc)
+        print(f"  stopped the job after step {latest_step(elastic_dir)}, relaunching with 1 rank", flush=True)
+        proc = launch(1, elastic_dir, common_args)
+        wait_for_step(proc, elastic_dir, 3 * args.steps // 4)
+        stop(proc)
+        print(f"  stopped the job after step {latest_step(elastic_dir)}, relaunching with 4 ranks", flush=True)
+        assert launch(4, elastic_dir, common_args).wait() == 0, "the elastic run failed"
+
+        reference, elastic = train_losses(reference_dir), train_losses(elastic_dir)
+        assert sorted(reference) == sorted(elastic) == list(range(args.steps)), "steps are missing"
+        worst = max(abs(elastic[s] - reference[s]) / reference[s] for s in reference)
+        print(f"max relative difference of the loss of a step: {worst:.2e}")
+        assert worst < args.tolerance, "the elastic run diverged from the reference"
+        final = [load_checkpoint(os.path.join(d, "latest.pt")) for d in (reference_dir, elastic_dir)]
+        assert final[0]['tokens_seen'] == final[1]['tokens_seen'], "the runs saw a different number of tokens"
+        assert final[0]['train_loader'] == final[1]['train_loader'], "the runs ended at a different data position"
+        print(f"both runs saw {final[0]['tokens_seen']:,} tokens and ended at {final[0]['train_loader']}")
+        print("OK")
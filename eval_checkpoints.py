@@ -0,0 +1,124 @@
+"""
+Scores our own log/model_*.pt checkpoints on CPU with several worker processes.
+
+The examples of the requested tasks (see eval_harness.py) are sharded across N
+worker processes, each capped at a few torch threads so the workers don't fight
+over the cores, and the per-shard counters are summed at the end. Given a directory
+instead of a file, every model_*.pt in it is scored in step order, and checkpoints
+that already have results in the results file are skipped, so the sweep can be
+rerun as training writes new checkpoints.
+
+python eval_checkpoints.py log/model_19072.pt --workers 8 --threads_per_worker 2
+python eval_checkpoints.py log --tasks hellaswag,mytask=data/mytask.jsonl --workers 16
+"""
+
+import os
+import glob
+import json
+import time
+import argparse
+import multiprocessing as mp
+
+# -----------------------------------------------------------------------------
+COUNTERS = ('num_total', 'num_correct', 'num_correct_norm', 'num_tokens', 'seconds')
+
+def init_worker(threads_per_worker):
+    import torch
+    torch.set_num_threads(threads_per_worker)
+    torch.set_num_interop_threads(1)
+
+def score_shard(checkpoint_path, tasks, rank, world_size, limit):
+    """Runs in a worker process: scores every world_size-th example, offset rank"""
+    import torch
+    from train_gpt2 import GPT, load_checkpoint
+    from eval_harness import evaluate_tasks, resolve_tasks
+    task_names = resolve_tasks(tasks)
+    model = GPT.from_checkpoint(load_checkpoint(checkpoint_path))
+    model.eval()
+    return evaluate_tasks(model, task_names, "cpu", rank=rank, world_size=world_size, limit=limit)
+
+def merge_stats(shard_stats):
+    merged = {}
+    for stats in shard_stats:
+        for task, s in stats.items():
+            m = merged.setdefault(task, {k: 0 for k in COUNTERS})
+            for k in COUNTERS:
+                m[k] += s[k]
+    return merged
+
+def load_results(results_file):
+    results = []
+    if os.path.exists(results_file):
+        with open(results_file, "r") as f:
+            results = [json.loads(line) for line in f if line.strip()]
+    return results
+
+def already_scored(results, checkpoint_path, task_names):
+    """A checkpoint counts as scored if the same file (by name and mtime) has results for all tasks"""
+    name, mtime = os.path.basename(checkpoint_path), os.path.getmtime(checkpoint_path)
+    for r in results:
+        if r['checkpoint'] == name and r['mtime'] == mtime and all(t in r['tasks'] for t in task_names):
+            return True
+    return False
+
+def evaluate_checkpoint(pool, checkpoint_path, tasks, workers, limit=None):
+    t0 = time.time()
+    args = [(checkpoint_path, tasks, rank, workers, limit) for rank in range(workers)]
+    stats = merge_stats(pool.starmap(score_shard, args))
+    wall = time.time() - t0
+    for task, s in stats.items():
+        num_total = max(1, s['num_total'])
+        # seconds is summed over the workers, which ran side by side
+        throughput = s['num_total'] / max(s['seconds'] / workers, 1e-9)
+        print(f"{os.path.basename(checkpoint_path)} {task}: {s['num_total']} examples | acc: {s['num_correct']/num_total:.4f} | "
+              f"acc_norm: {s['num_correct_norm']/num_total:.4f} | {throughput:.2f} examples/sec on {workers} workers")
+    print(f"{os.path.basename(checkpoint_path)}: {wall:.1f}s wall time including model loading")
+    return stats, wall
+
+def main(args):
+    from eval_harness import resolve_tasks
+    task_names = resolve_tasks(args.tasks)
+    if "hellaswag" in task_names:
+        # download once up front rather than racing in every worker
+        from hellaswag import download
+        download("val")
+
+    if os.path.isdir(args.path):
+        checkpoints = sorted(glob.glob(os.path.join(args.path, "model_*.pt")))
+        results_file = args.results_file or os.path.join(args.path, "eval_results.jsonl")
+    else:
+        checkpoints = [args.path]
+        results_file = args.results_file or os.path.join(os.path.dirname(args.path) or ".", "eval_results.jsonl")
+    results = load_results(results_file)
+    todo = [c for c in checkpoints if args.force or not already_scored(results, c, task_names)]
+    print(f"{len(checkpoints)} checkpoints, {len(checkpoints) - len(todo)} already scored, {len(todo)} to go")
+    if not todo:
+        return
+
+    # cap the math library threads of the workers before they start
+    os.environ["OMP_NUM_THREADS"] = str(args.threads_per_worker)
+    os.environ["MKL_NUM_THREADS"] = str(args.threads_per_worker)
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(args.workers, initializer=init_worker, initargs=(args.threads_per_worker,)) as pool:
+        for checkpoint_path in todo:
+            stats, wall = evaluate_checkpoint(pool, checkpoint_path, args.tasks, args.workers, args.limit)
+            record = {
+                'checkpoint': os.path.basename(checkpoint_path),
+                'mtime': os.path.getmtime(checkpoint_path),
+                'tasks': stats,
+                'wall_seconds': wall,
+                'workers': args.workers,
+            }
+            with open(results_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="a model_*.pt checkpoint or a directory of them")
+    parser.add_argument("--tasks", type=str, default="hellaswag", help="comma separated tasks, name=path.jsonl for local files")
+    parser.add_argument("--workers", type=int, default=max(1, os.cpu_count() // 2), help="number of worker processes")
+    parser.add_argument("--threads_per_worker", type=int, default=2, help="torch threads per worker process")
+    parser.add_argument("--limit", type=int, default=None, help="only score the first N examples of each task")
+    parser.add_argument("--results_file", type=str, default=None, help="defaults to eval_results.jsonl next to the checkpoints")
+    parser.add_argument("--force", action="store_true", help="rescore checkpoints that already have results")
+    main(parser.parse_args())
@@ -0,0 +1,230 @@
+"""
+A small batched log-likelihood eval harness for multiple-choice tasks.
+
+Every task is a generator registered in TASKS that yields examples of the form
+(choices, label), where choices is a list of (context, continuation) string pairs
+and label is the index of the correct choice. The engine then:
+
+- tokenizes everything through a cache (HellaSwag repeats every context 4 times)
+- flattens all choices of all tasks into one list of rows and sorts them by length,
+  so each batch is padded to roughly the same length (length bucketing)
+- runs the model once per batch and reduces the loss over the continuation tokens
+  only (masked loss reduction)
+- scatters the row losses back to their examples and tasks
+
+so several tasks are scored in one pass over the model. Like hellaswag.py we report
+acc (lowest summed loss) and acc_norm (lowest mean loss per continuation token).
+
+Besides hellaswag, any local JSONL file with lines like
+{"context": "...", "choices": ["...", "..."], "label": 1}
+can be scored by passing name=path/to/file.jsonl as a task.
+
+python eval_harness.py --tasks hellaswag,mytask=data/mytask.jsonl -m gpt2
+python eval_harness.py --tasks hellaswag --checkpoint log/model_19072.pt -d cpu
+"""
+
+import json
+import time
+import functools
+import torch
+from torch.nn import functional as F
+
+# -----------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    """The GPT-2 tokenizer, created on first use so importing this file stays cheap"""
+    import tiktoken
+    return tiktoken.get_encoding("gpt2")
+
+TASKS = {}
+
+def register_task(name):
+    """Decorator that registers a task generator under name"""
+    def decorator(fn):
+        TASKS[name] = fn
+        return fn
+    return decorator
+
+@register_task("hellaswag")
+def hellaswag_task():
+    from hellaswag import iterate_examples
+    for example in iterate_examples("val"):
+        # note: prepending " " because GPT-2 tokenizer
+        yield [(example["ctx"], " " + end) for end in example["endings"]], example["label"]
+
+def register_jsonl_task(name, path):
+    """Registers a local multiple-choice JSONL file as a task"""
+    def jsonl_task():
+        with open(path, "r") as f:
+            for line in f:
+                example = json.loads(line)
+                yield [(example["context"], " " + choice) for choice in example["choices"]], example["label"]
+    TASKS[name] = jsonl_task
+
+def resolve_tasks(spec):
+    """Parses a comma separated task list, registering any name=path.jsonl entries on the way"""
+    names = []
+    for item in spec.split(","):
+        if "=" in item:
+            name, path = item.split("=", 1)
+            register_jsonl_task(name, path)
+            item = name
+        assert item in TASKS, f"unknown task {item}, known tasks: {sorted(TASKS)}"
+        names.append(item)
+    return names
+
+@functools.lru_cache(maxsize=1 << 16)
+def encode(text):
+    return tuple(get_encoding().encode(text))
+
+# -----------------------------------------------------------------------------
+
+def completion_losses(tokens, mask, logits):
+    """
+    Given (B, T) tokens, (B, T) mask that is 1 over the completion region and the
+    (B, T, V) logits, returns the summed and the mean autoregressive loss over the
+    completion region of each row.
+    """
+    # evaluate the autoregressive loss at all positions
+    shift_logits = (logits[..., :-1, :]).contiguous().float()
+    shift_tokens = (tokens[..., 1:]).contiguous()
+    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
+    flat_shift_tokens = shift_tokens.view(-1)
+    shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
+    shift_losses = shift_losses.view(tokens.size(0), -1)
+    # now get the average loss just for the completion region (where mask == 1), in each row
+    shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
+    masked_shift_losses = shift_losses * shift_mask
+    # sum and divide by the number of 1s in the mask
+    sum_loss = masked_shift_losses.sum(dim=1)
+    avg_loss = sum_loss / shift_mask.sum(dim=1)
+    return sum_loss, avg_loss
+
+def forward_logits(model, tokens):
+    """Works for both our GPT, which returns (logits, loss), and huggingface models"""
+    out = model(tokens)
+    return out[0] if isinstance(out, tuple) else out.logits
+
+def build_requests(task_names, rank=0, world_size=1, limit=None, block_size=1024):
+    """
+    Tokenizes the examples of all tasks (this rank's shard of them) into rows.
+    Returns the rows as (task, example, choice, tokens, num_ctx) tuples and the
+    per-task lists of (num_choices, label) of each example.
+    """
+    rows = []
+    examples = {}
+    for task in task_names:
+        examples[task] = []
+        for i, (choices, label) in enumerate(TASKS[task]()):
+            if limit is not None and i >= limit:
+                break
+            if i % world_size != rank:
+                continue
+            ex = len(examples[task])
+            examples[task].append((len(choices), label))
+            for c, (context, continuation) in enumerate(choices):
+                ctx_tokens, end_tokens = encode(context), encode(continuation)
+                tokens = ctx_tokens + end_tokens
+                # crop from the left if the row does not fit in the context window
+                crop = max(0, len(tokens) - block_size)
+                rows.append((task, ex, c, tokens[crop:], max(1, len(ctx_tokens) - crop)))
+    return rows, examples
+
+def iterate_batches(rows, max_batch_tokens=4096, max_batch_rows=64):
+    """Sorts rows by length and groups them into padded (tokens, mask) batches"""
+    order = sorted(range(len(rows)), key=lambda i: len(rows[i][3]), reverse=True)
+    start = 0
+    while start < len(order):
+        max_len = len(rows[order[start]][3])
+        # longest row first, so the batch is padded to max_len
+        num_rows = max(1, min(max_batch_rows, max_batch_tokens // max_len))
+        batch = order[start:start + num_rows]
+        tokens = torch.zeros((len(batch), max_len), dtype=torch.long)
+        mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+        for i, r in enumerate(batch):
+            row_tokens, num_ctx = rows[r][3], rows[r][4]
+            tokens[i, :len(row_tokens)] = torch.tensor(row_tokens)
+            mask[i, num_ctx:len(row_tokens)] = 1
+        yield batch, tokens, mask
+        start += num_rows
+
+@torch.no_grad()
+def evaluate_tasks(model, task_names, device, autocast_dtype=None, rank=0, world_size=1, limit=None,
+                   max_batch_tokens=4096, max_batch_rows=64):
+    """
+    Scores all task_names in one pass over the model. With world_size > 1 only every
+    world_size-th example (offset rank) is scored, so the returned counters can be
+    summed across processes. Returns {task: {num_total, num_correct, num_correct_norm,
+    num_tokens, seconds}}; seconds is the forward time attributed by token count.
+    """
+    device_type = "cuda" if str(device).startswith("cuda") else "cpu"
+    block_size = model.config.block_size if hasattr(model, "config") and hasattr(model.config, "block_size") else 1024
+    rows, examples = build_requests(task_names, rank, world_size, limit, block_size)
+    sum_losses = torch.zeros(len(rows))
+    avg_losses = torch.zeros(len(rows))
+    stats = {task: {'num_total': 0, 'num_correct': 0, 'num_correct_norm': 0, 'num_tokens': 0, 'seconds': 0.0} for task in task_names}
+
+    for batch, tokens, mask in iterate_batches(rows, max_batch_tokens, max_batch_rows):
+        t0 = time.time()
+        tokens, mask = tokens.to(device), mask.to(device)
+        if autocast_dtype is not None:
+            with torch.autocast(device_type=device_type, dtype=autocast_dtype):
+                logits = forward_logits(model, tokens)
+        else:
+            logits = forward_logits(model, tokens)
+        sum_loss, avg_loss = completion_losses(tokens, mask, logits)
+        sum_losses[batch] = sum_loss.cpu()
+        avg_losses[batch] = avg_loss.cpu()
+        dt = time.time() - t0
+        # attribute the batch time to the tasks by their share of the tokens
+        batch_tokens = sum(len(rows[r][3]) for r in batch)
+        for r in batch:
+            task = rows[r][0]
+            stats[task]['num_tokens'] += len(rows[r][3])
+            stats[task]['seconds'] += dt * len(rows[r][3]) / batch_tokens
+
+    score_examples(stats, task_names, examples, sum_losses, avg_losses)
+    return stats
+
+def score_examples(stats, task_names, examples, sum_losses, avg_losses):
+    """Gathers the row losses back into examples and counts the correct predictions into stats"""
+    # rows of an example are contiguous
+    r = 0
+    for task in task_names:
+        for num_choices, label in examples[task]:
+            pred = sum_losses[r:r + num_choices].argmin().item()
+            pred_norm = avg_losses[r:r + num_choices].argmin().item()
+            stats[task]['num_total'] += 1
+            stats[task]['num_correct'] += int(pred == label)
+            stats[task]['num_correct_norm'] += int(pred_norm == label)
+            r += num_choices
+
+def print_stats(stats):
+    for task, s in stats.items():
+        num_total = max(1, s['num_total'])
+        throughput = s['num_total'] / s['seconds'] if s['seconds'] > 0 else 0.0
+        print(f"{task}: {s['num_total']} examples | acc: {s['num_correct']/num_total:.4f} | acc_norm: {s['num_correct_norm']/num_total:.4f} | "
+              f"{throughput:.2f} examples/sec | {s['num_tokens']/max(s['seconds'], 1e-9):.0f} tok/sec")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=str, default="hellaswag", help="comma separated tasks, name=path.jsonl for local files")
+    parser.add_argument("-m", "--model_type", type=str, default="gpt2", help="pretrained GPT-2 to use if no checkpoint is given")
+    parser.add_argument("--checkpoint", type=str, default=None, help="a log/model_*.pt checkpoint to evaluate")
+    parser.add_argument("-d", "--device", type=str, default="cuda", help="the device to use")
+    parser.add_argument("--limit", type=int, default=None, help="only score the first N examples of each task")
+    parser.add_argument("--max_batch_tokens", type=int, default=4096, help="padded tokens per forward pass")
+    args = parser.parse_args()
+
+    from train_gpt2 import GPT, load_checkpoint
+    task_names = resolve_tasks(args.tasks)
+    if args.checkpoint is not None:
+        model = GPT.from_checkpoint(load_checkpoint(args.checkpoint))
+    else:
+        model = GPT.from_pretrained(args.model_type)
+    model.to(args.device)
+    model.eval()
+    stats = evaluate_tasks(model, task_names, args.device, limit=args.limit, max_batch_tokens=args.max_batch_tokens)
+    print_stats(stats)
@@ -0,0 +1,227 @@
+"""
+Out-of-process evaluation of training snapshots.
+
+With async_eval = True in train_gpt2.py the master rank no longer stops every 250
+steps to run validation loss, HellaSwag and sampling. Instead it copies the weights
+to host memory, writes them to log/snapshots/snapshot_XXXXX.pt from a background
+thread, and carries on training. This worker (launched by the trainer, or by hand on
+another box that sees the same directory) picks the snapshots up in step order,
+evaluates them and appends the results to the run's metrics file (see metrics.py):
+
+- val loss over a fixed, pre-materialized set of val batches (so every step is
+  scored on exactly the same tokens)
+- HellaSwag acc_norm
+- a few samples from "Hello, I'm a language model,"
+
+Snapshots flagged as checkpoints are also written out as log/model_XXXXX.pt, in the
+same format the inline path uses. Snapshots are deleted once evaluated.
+
+run by hand:
+python eval_worker.py --snapshot_dir log/snapshots --metrics_file log/metrics.bin --B 64 --T 1024 --num_threads 16 --data_root edu_fineweb10B
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+import threading
+import subprocess
+from dataclasses import asdict
+import torch
+from torch.nn import functional as F
+from train_gpt2 import GPT, DataLoaderLite, load_checkpoint, get_best_float_config, dprint
+from eval_harness import evaluate_tasks, get_encoding
+from metrics import MetricsWriter
+
+# -----------------------------------------------------------------------------
+DONE_FILE = "DONE" # written by the trainer once the last snapshot has been published
+VAL_SET_FILE = "val_fixed.pt"
+
+def publish_snapshot(model, step, snapshot_dir, checkpoint=False, pending=None):
+    """
+    Copies the weights of the (raw, unwrapped) model to host memory and writes them to
+    snapshot_dir from a background thread. Returns the thread, which should be passed
+    back in as `pending` for the next snapshot so that only one write is in flight.
+    """
+    if pending is not None:
+        pending.join()
+    os.makedirs(snapshot_dir, exist_ok=True)
+    # copy on the training thread so the snapshot is consistent, but copy tied weights only once
+    copies = {}
+    state_dict = {}
+    for k, v in model.state_dict().items():
+        if v.data_ptr() not in copies:
+            copies[v.data_ptr()] = v.detach().to("cpu", copy=True)
+        state_dict[k] = copies[v.data_ptr()]
+    snapshot = {
+        'model': state_dict,
+        'config': asdict(model.config),
+        'step': step,
+        'checkpoint': checkpoint,
+    }
+    path = os.path.join(snapshot_dir, f"snapshot_{step:05d}.pt")
+    def write():
+        torch.save(snapshot, path + ".tmp")
+        os.replace(path + ".tmp", path) # atomic publish, the worker never sees a partial file
+    thread = threading.Thread(target=write)
+    thread.start()
+    return thread
+
+def finish_snapshots(snapshot_dir, pending=None):
+    """Tells the worker that no more snapshots are coming, so it exits once it has drained the directory"""
+    if pending is not None:
+        pending.join()
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(os.path.join(snapshot_dir, DONE_FILE), "w") as f:
+        pass
+
+def launch_eval_worker(snapshot_dir, metrics_file, B, T, val_batches, data_root="edu_fineweb10B", data_mixture=None, device="cpu", num_threads=None):
+    """Starts the worker as a separate process, detached from the torchrun environment of the trainer"""
+    # a stale DONE file from a previous run would make the worker exit immediately
+    if os.path.exists(os.path.join(snapshot_dir, DONE_FILE)):
+        os.remove(os.path.join(snapshot_dir, DONE_FILE))
+    env = {k: v for k, v in os.environ.items() if k not in {"RANK", "LOCAL_RANK", "WORLD_SIZE", "LOCAL_WORLD_SIZE", "MASTER_ADDR", "MASTER_PORT"}}
+    cmd = [sys.executable, os.path.abspath(__file__),
+           "--snapshot_dir", snapshot_dir, "--metrics_file", metrics_file,
+           "--B", str(B), "--T", str(T), "--val_batches", str(val_batches), "--device", device, "--data_root", data_root]
+    if data_mixture is not None:
+        cmd += ["--data_mixture", data_mixture]
+    if num_threads is not None:
+        cmd += ["--num_threads", str(num_threads)]
+    return subprocess.Popen(cmd, env=env)
+
+# -----------------------------------------------------------------------------
+# worker side
+
+def materialize_val_set(path, B, T, val_batches, data_root="edu_fineweb10B", data_mixture=None):
+    """Reads the first val_batches (B, T) batches of the val split once and caches them in path"""
+    source = data_mixture if data_mixture is not None else data_root # the same val data as the trainer's inline path
+    if os.path.exists(path):
+        val_set = torch.load(path)
+        if val_set['x'].shape == (val_batches, B, T) and val_set.get('source') == source:
+            return val_set
+    if data_mixture is not None:
+        from mixture import MixtureDataLoader, parse_mixture
+        val_loader = MixtureDataLoader(B=B, T=T, process_rank=0, num_processes=1, split="val", sources=parse_mixture(data_mixture))
+    else:
+        val_loader = DataLoaderLite(B=B, T=T, process_rank=0, num_processes=1, split="val", data_root=data_root)
+    xs, ys = [], []
+    for _ in range(val_batches):
+        x, y = val_loader.next_batch()
+        xs.append(x)
+        ys.append(y)
+    val_set = {'x': torch.stack(xs), 'y': torch.stack(ys), 'source': source}
+    torch.save(val_set, path)
+    return val_set
+
+@torch.no_grad()
+def eval_val_loss(model, val_set, device, device_type, batch_size):
+    best_dtype = get_best_float_config()
+    loss_accum = 0.0
+    num_batches = val_set['x'].size(0)
+    for x, y in zip(val_set['x'], val_set['y']):
+        # split each training-sized batch into rows the eval device can hold
+        batch_loss = 0.0
+        for i in range(0, x.size(0), batch_size):
+            xb, yb = x[i:i+batch_size].to(device), y[i:i+batch_size].to(device)
+            with torch.autocast(device_type=device_type, dtype=best_dtype):
+                logits, loss = model(xb, yb)
+            batch_loss += loss.item() * xb.size(0)
+        loss_accum += batch_loss / x.size(0) / num_batches
+    return loss_accum
+
+@torch.no_grad()
+def generate_samples(model, device, device_type, num_return_sequences=4, max_length=32):
+    enc = get_encoding()
+    best_dtype = get_best_float_config()
+    tokens = enc.encode("Hello, I'm a language model,")
+    tokens = torch.tensor(tokens, dtype=torch.long)
+    tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)
+    xgen = tokens.to(device)
+    sample_rng = torch.Generator(device=device)
+    sample_rng.manual_seed(42)
+    while xgen.size(1) < max_length:
+        with torch.autocast(device_type=device_type, dtype=best_dtype):
+            logits, loss = model(xgen)
+        logits = logits[:, -1, :]
+        probs = F.softmax(logits, dim=-1)
+        topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
+        ix = torch.multinomial(topk_probs, 1, generator=sample_rng)
+        xcol = torch.gather(topk_indices, -1, ix)
+        xgen = torch.cat((xgen, xcol), dim=1)
+    return [enc.decode(xgen[i, :max_length].tolist()) for i in range(num_return_sequences)]
+
+def evaluate_snapshot(path, metrics, val_set, device, batch_size):
+    device_type = "cuda" if device.startswith("cuda") else "cpu"
+    snapshot = load_checkpoint(path)
+    step = snapshot['step']
+    model = GPT.from_checkpoint(snapshot)
+    model.to(device)
+    model.eval()
+    t0 = time.time()
+
+    val_loss = eval_val_loss(model, val_set, device, device_type, batch_size)
+    dprint(f"[eval worker] step {step} validation loss: {val_loss:.4f}")
+    metrics.log(step, "val", val_loss)
+
+    stats = evaluate_tasks(model, ["hellaswag"], device, autocast_dtype=get_best_float_config())
+    num_correct_norm, num_total = stats["hellaswag"]["num_correct_norm"], stats["hellaswag"]["num_total"]
+    acc_norm = num_correct_norm / num_total
+    dprint(f"[eval worker] step {step} HellaSwag accuracy: {num_correct_norm}/{num_total}={acc_norm:.4f}")
+    metrics.log(step, "hella", acc_norm)
+    metrics.flush()
+
+    # step 0 is noise, same as the inline path
+    if step > 0:
+        for i, decoded in enumerate(generate_samples(model, device, device_type)):
+            dprint(f"[eval worker] step {step} sample {i}: {decoded}")
+
+    if snapshot['checkpoint']:
+        checkpoint_path = os.path.join(os.path.dirname(metrics.path), f"model_{step:05d}.pt")
+        checkpoint = {
+            'model': model.state_dict(),
+            'config': model.config,
+            'step': step,
+            'val_loss': val_loss,
+        }
+        torch.save(checkpoint, checkpoint_path)
+        dprint(f"[eval worker] checkpoint saved to {checkpoint_path}")
+    dprint(f"[eval worker] step {step} evaluated in {time.time() - t0:.1f}s")
+
+def run_worker(snapshot_dir, metrics_file, B, T, val_batches, data_root="edu_fineweb10B", data_mixture=None, device="cpu", batch_size=None, poll_interval=5.0):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    metrics = MetricsWriter(metrics_file)
+    val_set = materialize_val_set(os.path.join(snapshot_dir, VAL_SET_FILE), B, T, val_batches, data_root, data_mixture)
+    batch_size = batch_size or B
+    while True:
+        # check for DONE before listing, so a snapshot published just before it is never missed
+        done = os.path.exists(os.path.join(snapshot_dir, DONE_FILE))
+        snapshots = sorted(glob.glob(os.path.join(snapshot_dir, "snapshot_*.pt")))
+        if not snapshots:
+            if done:
+                break
+            time.sleep(poll_interval)
+            continue
+        evaluate_snapshot(snapshots[0], metrics, val_set, device, batch_size)
+        os.remove(snapshots[0])
+    metrics.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--snapshot_dir", type=str, default="log/snapshots", help="directory the trainer publishes snapshots to")
+    parser.add_argument("--metrics_file", type=str, default="log/metrics.bin", help="metrics file to append results to")
+    parser.add_argument("--B", type=int, required=True, help="micro batch size of the val batches (match the trainer)")
+    parser.add_argument("--T", type=int, required=True, help="sequence length of the val batches (match the trainer)")
+    parser.add_argument("--val_batches", type=int, default=20, help="number of val batches in the fixed val set")
+    parser.add_argument("--data_root", type=str, default="edu_fineweb10B", help="directory with the val token shards (match the trainer)")
+    parser.add_argument("--data_mixture", type=str, default=None, help="dir:weight,... to take the val set from instead of --data_root (match the trainer)")
+    parser.add_argument("--batch_size", type=int, default=None, help="rows per forward pass, defaults to B")
+    parser.add_argument("-d", "--device", type=str, default="cpu", help="the device to use")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch intra-op threads for this worker")
+    parser.add_argument("--poll_interval", type=float, default=5.0, help="seconds between snapshot directory scans")
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    run_worker(args.snapshot_dir, args.metrics_file, args.B, args.T, args.val_batches, data_root=args.data_root,
+               data_mixture=args.data_mixture, device=args.device, batch_size=args.batch_size, poll_interval=args.poll_interval)
@@ -0,0 +1,95 @@
+"""
+Exports a checkpoint to a self-contained inference artifact: a torch.export program (.pt2)
+or a TorchScript module (.ts) with its weights and the model config, in one file. Loading
+it needs only torch (see runtime.py), not train_gpt2.py, the pickled GPTConfig or the
+training code. On CPU the .pt2 loader pulls in the torch.export deserializer, which
+dominates its cold start; TorchScript loads much faster but is deprecated in torch.
+
+The exported program is the inference half of GPT.forward: it returns the logits of the
+last position only, over the real 50257 tokens of the vocab. Q, K and V stay fused in
+one c_attn matmul per layer, and the tied embedding is stored once (without the padding
+rows of the vocab) and used both for the token lookup and as the classifier. Batch size
+and sequence length are dynamic, up to --max_batch and the block size.
+
+python export.py log/model_19072.pt --out log/model_19072.pt2
+python export.py gpt2 --out log/gpt2.pt2                          # the pretrained weights
+python export.py log/model_19072.pt --out log/model_19072.ts --format torchscript
+python runtime.py log/model_19072.pt2 --bench log/model_19072.pt  # vs the same forward run eagerly
+"""
+
+import json
+import time
+import argparse
+import dataclasses
+import torch
+import torch.nn as nn
+
+VOCAB = 50257 # the real GPT-2 vocab, our models pad it to 50304
+
+class InferenceGPT(nn.Module):
+    """GPT.forward for generation: (B, T) token ids -> (B, VOCAB) logits of the last position"""
+
+    def __init__(self, model, vocab_size=VOCAB):
+        super().__init__()
+        # the one copy of the tied embedding, cropped to the real vocab
+        self.wte = nn.Parameter(model.transformer.wte.weight.detach()[:vocab_size].clone())
+        self.wpe = model.transformer.wpe
+        self.h = model.transformer.h
+        self.ln_f = model.transformer.ln_f
+
+    def forward(self, idx):
+        T = idx.size(1)
+        pos = torch.arange(0, T, dtype=torch.long, device=idx.device)
+        x = nn.functional.embedding(idx, self.wte) + self.wpe(pos)
+        for block in self.h:
+            x = block(x)
+        # only the last position is needed to sample the next token
+        x = self.ln_f(x[:, -1, :])
+        return x @ self.wte.T
+
+def export_model(model, max_batch=64):
+    """torch.export of InferenceGPT(model) with dynamic batch size and sequence length"""
+    model.eval()
+    wrapper = InferenceGPT(model).eval()
+    batch = torch.export.Dim("batch", min=1, max=max_batch)
+    seq = torch.export.Dim("seq", min=1, max=model.config.block_size)
+    example = torch.zeros((2, 16), dtype=torch.long)
+    with torch.no_grad():
+        return torch.export.export(wrapper, (example,), dynamic_shapes=({0: batch, 1: seq},))
+
+def trace_model(model):
+    """TorchScript trace of InferenceGPT(model), the sizes stay dynamic in the traced graph"""
+    model.eval()
+    wrapper = InferenceGPT(model).eval()
+    with torch.no_grad():
+        return torch.jit.trace(wrapper, torch.zeros((2, 16), dtype=torch.long))
+
+def save_artifact(program, config, path):
+    meta = json.dumps(dict(dataclasses.asdict(config), vocab=VOCAB, format="nanogpt-export-1"))
+    if isinstance(program, torch.jit.ScriptModule):
+        torch.jit.save(program, path, _extra_files={"config.json": meta})
+    else:
+        torch.export.save(program, path, extra_files={"config.json": meta})
+
+if __name__ == "__main__":
+    from train_gpt2 import GPT, load_checkpoint
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint", type=str, help="a log/model_*.pt checkpoint, or gpt2/gpt2-medium/... for the pretrained weights")
+    parser.add_argument("--out", type=str, required=True, help="where to write the artifact, .pt2 for torch.export or .ts for TorchScript")
+    parser.add_argument("--format", type=str, default="export", choices=["export", "torchscript"], help="torch.export program or TorchScript module")
+    parser.add_argument("--max_batch", type=int, default=64, help="largest batch size a torch.export artifact accepts")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    model = GPT.from_pretrained(args.checkpoint) if args.checkpoint.startswith("gpt2") else GPT.from_checkpoint(load_checkpoint(args.checkpoint))
+    program = export_model(model, args.max_batch) if args.format == "export" else trace_model(model)
+    save_artifact(program, model.config, args.out)
+    # the artifact has to reproduce the eager logits
+    x = torch.randint(0, VOCAB, (2, min(64, model.config.block_size)))
+    with torch.no_grad():
+        expected = model(x)[0][:, -1, :VOCAB]
+        forward = program if args.format == "torchscript" else program.module()
+        diff = (forward(x) - expected).abs().max().item()
+    state_dict = program.state_dict() if args.format == "torchscript" else program.state_dict
+    num_params = sum(p.numel() for p in state_dict.values())
+    print(f"exported {num_params:,} parameters to {args.out} in {time.time() - t0:.2f}s, max abs logit difference vs eager {diff:.2e}")
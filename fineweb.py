@@ -2,12 +2,12 @@ import os
 import multiprocessing as mp
 import numpy as np
 import tiktoken
-from datasets import load_dataset
 from tqdm import tqdm
 import argparse
 import sys
 import glob
 import random
+import itertools
 
 # ------------------------------------------
 local_dir = "edu_fineweb10B"
@@ -15,17 +15,20 @@ remote_name = "sample-10BT"
 shard_size = int(1e8)  # 100M tokens per shard, total of 100 shards
 RANDOM_SEED = 42  # Set a fixed random seed for reproducibility
 LINES_PER_DOCUMENT = 1000  # Number of lines to group into one document
+DOCS_PER_BATCH = 1024  # documents pulled from the input at a time by the main process
 
-# Create the cache and local directory if it doesn't exist yet
+# The local directory is created when shards are first written
 DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), local_dir)
-os.makedirs(DATA_CACHE_DIR, exist_ok=True)
 
-# Init the tokenizer
-enc = tiktoken.get_encoding("gpt2")
-eot = enc._special_tokens['<|endoftext|>']  # end of text token
+# Init the tokenizer lazily (once per worker process), so importing this file is cheap
+enc = None
+eot = 50256  # end of text token, enc._special_tokens['<|endoftext|>']
 
 def tokenize(doc):
     # Tokenizes a single document and returns a numpy array of uint16 tokens
+    global enc
+    if enc is None:
+        enc = tiktoken.get_encoding("gpt2")
     tokens = enc.encode_ordinary(doc["text"] if isinstance(doc, dict) else doc)
     tokens.append(eot)  # Add the <|endoftext|> token at the end of the document
     tokens_np = np.array(tokens)
@@ -36,18 +39,47 @@ def tokenize(doc):
 def write_datafile(filename, tokens_np):
     np.save(filename, tokens_np)
 
+def batched(iterator, n):
+    iterator = iter(iterator)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
 
 
 
-def process_data(source):
+
+def process_data(source, dedup=False, dedup_index=None, dedup_index_mb=1024, out_dir=DATA_CACHE_DIR):
+    # optional dedup stage in front of tokenization, see dedup.py
+    deduper = None
+    if dedup:
+        from dedup import FingerprintIndex, Deduplicator
+        dedup_index = dedup_index or os.path.join(out_dir, "dedup_index.npz")
+        # only the train_data/ files of source 2 are tracked in the index, a rerun of the HuggingFace
+        # dataset against its own index would drop every document as a duplicate
+        assert source == 2 or not os.path.exists(dedup_index), \
+            f"{dedup_index} exists, incremental dedup runs are only supported with --source 2: delete it or use another --dedup_index / --out_dir"
+        if os.path.exists(dedup_index):
+            index = FingerprintIndex.load(dedup_index)
+            print(f"Loaded fingerprint index {dedup_index} ({len(index.files)} files already indexed)")
+        else:
+            index = FingerprintIndex(memory_mb=dedup_index_mb)
+        deduper = Deduplicator(index)
+    maybe_dedup = deduper.filter if deduper is not None else (lambda docs: docs)
+
+    tokens_kept = 0
     if source == 1:
         # Download the dataset
+        from datasets import load_dataset
         fw = load_dataset("HuggingFaceFW/fineweb-edu", name=remote_name, split="train")
         data_iterator = fw
-        process_and_write_shards(data_iterator)
+        tokens_kept += process_and_write_shards(maybe_dedup(data_iterator), out_dir=out_dir)
     elif source == 2:
         # Load all files in train_data/
         files = glob.glob("train_data/*")
+        if deduper is not None:
+            # incremental run: files already in the index were processed (and their shards written) before
+            new_files = [f for f in files if not deduper.index.file_is_indexed(f)]
+            print(f"{len(files) - len(new_files)} of {len(files)} files already processed, skipping them")
+            files = new_files
         all_lines = []
         for file in files:
             try:
@@ -74,25 +106,46 @@ def process_data(source):
         train_docs = ['\n'.join(train_lines[i:i+LINES_PER_DOCUMENT]) for i in range(0, len(train_lines), LINES_PER_DOCUMENT)]
         val_docs = ['\n'.join(val_lines[i:i+LINES_PER_DOCUMENT]) for i in range(0, len(val_lines), LINES_PER_DOCUMENT)]
         
+        # when appending to an earlier run, continue the shard numbering instead of overwriting
+        next_shard = lambda split: len(glob.glob(os.path.join(out_dir, f"edufineweb_{split}_*.npy"))) if deduper is not None else 0
+
         # Process train data
-        process_and_write_shards(train_docs, split="train")
+        tokens_kept += process_and_write_shards(maybe_dedup(train_docs), split="train", out_dir=out_dir, shard_index=next_shard("train"))
         
         # Process validation data
-        process_and_write_shards(val_docs, split="val")
+        tokens_kept += process_and_write_shards(maybe_dedup(val_docs), split="val", out_dir=out_dir, shard_index=next_shard("val"))
+        if deduper is not None:
+            for file in files:
+                deduper.index.add_file(file)
     else:
         raise ValueError("Invalid source specified")
 
+    if deduper is not None:
+        deduper.report(tokens_kept)
+        deduper.index.save(dedup_index)
+        print(f"Saved fingerprint index to {dedup_index}")
+
 
 
-def process_and_write_shards(data_iterator, split=None):
+def process_and_write_shards(data_iterator, split=None, out_dir=DATA_CACHE_DIR, shard_size=shard_size, shard_index=0):
+    # Returns the total number of tokens written
+    os.makedirs(out_dir, exist_ok=True)
     nprocs = max(1, os.cpu_count()//2)
+    total_tokens = 0
+    # the input is pulled in batches here in the main process, not by the feeder thread of
+    # pool.imap: with --dedup it is a generator that runs its own Pool, and forking that from
+    # a helper thread can deadlock and swallows its errors. The first batch is pulled before
+    # our Pool exists, so the dedup Pool is started first.
+    batches = batched(data_iterator, DOCS_PER_BATCH)
+    first_batch = next(batches, [])
     with mp.Pool(nprocs) as pool:
-        shard_index = 0
         # Preallocate buffer to hold current shard
         all_tokens_np = np.empty((shard_size,), dtype=np.uint16)
         token_count = 0
         progress_bar = None
-        for tokens in pool.imap(tokenize, data_iterator, chunksize=16):
+        all_tokens = (tokens for batch in itertools.chain([first_batch], batches) for tokens in pool.imap(tokenize, batch, chunksize=16))
+        for tokens in all_tokens:
+            total_tokens += len(tokens)
             # Is there enough space in the current shard for the new tokens?
             if token_count + len(tokens) < shard_size:
                 # Simply append tokens to current shard
@@ -105,7 +158,7 @@ def process_and_write_shards(data_iterator, split=None):
             else:
                 # Write the current shard and start a new one
                 current_split = split if split else ("val" if shard_index == 0 else "train")
-                filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{current_split}_{shard_index:06d}")
+                filename = os.path.join(out_dir, f"edufineweb_{current_split}_{shard_index:06d}")
                 # Split the document into whatever fits in this shard; the remainder goes to next one
                 remainder = shard_size - token_count
                 progress_bar.update(remainder)
@@ -119,13 +172,22 @@ def process_and_write_shards(data_iterator, split=None):
         # Write any remaining tokens as the last shard
         if token_count != 0:
             current_split = split if split else ("val" if shard_index == 0 else "train")
-            filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{current_split}_{shard_index:06d}")
+            filename = os.path.join(out_dir, f"edufineweb_{current_split}_{shard_index:06d}")
             write_datafile(filename, all_tokens_np[:token_count])
+    return total_tokens
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Process FineWeb-Edu dataset")
     parser.add_argument("--source", type=int, choices=[1, 2],
                         help="1: Use HuggingFace dataset, 2: Load files from train_data/")
+    parser.add_argument("--dedup", action="store_true",
+                        help="remove exact and near-duplicate documents and duplicate lines before tokenizing")
+    parser.add_argument("--dedup_index", type=str, default=None,
+                        help="fingerprint index to load and update (--source 2 only), defaults to dedup_index.npz in --out_dir")
+    parser.add_argument("--dedup_index_mb", type=int, default=1024,
+                        help="memory of a new fingerprint index, fixes the false positive rate")
+    parser.add_argument("--out_dir", type=str, default=DATA_CACHE_DIR,
+                        help="where to write the shards, e.g. a separate directory per source for mixture.py")
     
     if len(sys.argv) == 1:
         parser.print_help()
@@ -135,4 +197,4 @@ def parse_args():
 
 if __name__ == "__main__":
     args = parse_args()
-    process_data(args.source)
\ No newline at end of file
+    process_data(args.source, dedup=args.dedup, dedup_index=args.dedup_index, dedup_index_mb=args.dedup_index_mb, out_dir=args.out_dir)
\ No newline at end of file
@@ -27,13 +27,10 @@ The validation set of HellaSwag has a total of 10,042 examples.
 
 import os
 import json
-import requests
-import tiktoken
-from tqdm import tqdm
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from transformers import GPT2LMHeadModel
+from eval_harness import completion_losses, get_encoding
 
 # -----------------------------------------------------------------------------
 DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), "hellaswag")
@@ -41,6 +38,8 @@ DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), "hellaswag")
 def download_file(url: str, fname: str, chunk_size=1024):
     print("dewi hellaswag: download_file")
     """Helper function to download a file from a given url"""
+    import requests
+    from tqdm import tqdm
     resp = requests.get(url, stream=True)
     total = int(resp.headers.get("content-length", 0))
     with open(fname, "wb") as file, tqdm(
@@ -60,8 +59,6 @@ hellaswags = {
     "test": "https://raw.githubusercontent.com/rowanz/hellaswag/master/data/hellaswag_test.jsonl",
 }
 
-enc = tiktoken.get_encoding("gpt2")
-
 def download(split):
     """Downloads HellaSwag DATA_CACHE_DIR"""
     os.makedirs(DATA_CACHE_DIR, exist_ok=True)
@@ -90,6 +87,7 @@ def render_example(example):
     }
 
     # gather up all the tokens
+    enc = get_encoding()
     ctx_tokens = enc.encode(ctx)
     data["ctx_tokens"] = ctx_tokens
     tok_rows = []
@@ -121,6 +119,7 @@ def iterate_examples(split):
 @torch.no_grad()
 def evaluate(model_type, device):
     print("dewi hellaswag: evaluate")
+    from transformers import GPT2LMHeadModel
     torch.set_float32_matmul_precision('high') # use tf32
     model = GPT2LMHeadModel.from_pretrained(model_type)
     model.to(device)
@@ -136,19 +135,7 @@ def evaluate(model_type, device):
 
         # get the logits
         logits = model(tokens).logits
-        # evaluate the autoregressive loss at all positions
-        shift_logits = (logits[..., :-1, :]).contiguous()
-        shift_tokens = (tokens[..., 1:]).contiguous()
-        flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
-        flat_shift_tokens = shift_tokens.view(-1)
-        shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
-        shift_losses = shift_losses.view(tokens.size(0), -1)
-        # now get the average loss just for the completion region (where mask == 1), in each row
-        shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
-        masked_shift_losses = shift_losses * shift_mask
-        # sum and divide by the number of 1s in the mask
-        sum_loss = masked_shift_losses.sum(dim=1)
-        avg_loss = sum_loss / shift_mask.sum(dim=1)
+        sum_loss, avg_loss = completion_losses(tokens, mask, logits)
         # now we have a loss for each of the 4 completions
         # the one with the lowest loss should be the most likely
         pred = sum_loss.argmin().item()
@@ -173,6 +160,6 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", "--model_type", type=str, default="gpt2", help="the model type to use")
-    parser.add_argument("-d", "--device", type=str, default="cuda", help="the device to use")
+    parser.add_argument("-d", "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="the device to use")
     args = parser.parse_args()
     evaluate(args.model_type, args.device)
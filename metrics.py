@@ -0,0 +1,178 @@
+"""
+Buffered, structured training metrics.
+
+Instead of opening log/log.txt and appending a line of text every step, the training
+loop (and the eval worker) hand typed records to a MetricsWriter. Records sit in an
+in-memory buffer and a background thread appends them in batches to a compact binary
+file of fixed-width records (see RECORD_DTYPE, 49 bytes per record). Values may be
+passed as tensors (e.g. loss_accum): they are only converted to Python floats on the
+flush thread, so logging never forces a device sync on the training thread.
+
+Reading is a single np.fromfile, so even a million-step run loads instantly as columns:
+
+from metrics import read_metrics, KINDS
+m = read_metrics("log/metrics.bin")          # structured array, one row per record
+train = m[m['kind'] == KINDS.index('train')]
+plt.plot(train['tokens'], train['value'])
+
+The old text format is still available as an export:
+
+python metrics.py log/metrics.bin --export log/log.txt
+
+To compare how many tokens two runs (e.g. with and without the batch warmup of
+train_gpt2.py) needed to reach a val loss:
+
+python metrics.py log_fixed/metrics.bin log_warmup/metrics.bin --target_loss 3.5
+"""
+
+import os
+import time
+import math
+import threading
+import numpy as np
+
+# -----------------------------------------------------------------------------
+KINDS = ("train", "val", "hella", "kl")
+
+RECORD_DTYPE = np.dtype([
+    ('step', '<i8'),
+    ('kind', 'u1'), # index into KINDS
+    ('value', '<f4'), # loss for train/val, acc_norm for hella, distillation KL for kl
+    ('tokens', '<i8'), # tokens processed so far
+    ('tokens_per_sec', '<f4'),
+    ('lr', '<f4'),
+    ('grad_norm', '<f4'),
+    ('dt', '<f4'), # step time in seconds
+    ('comm_seconds', '<f4'), # time in the DDP gradient all-reduce, see comm_hooks.py
+    ('comm_bytes', '<i8'), # bytes the all-reduce moved
+])
+
+def _to_float(x):
+    return float(x.item()) if hasattr(x, "item") else float(x)
+
+class MetricsWriter:
+
+    def __init__(self, path, truncate=False, flush_every=256, flush_interval=10.0):
+        """
+        Appends records to path. A batch is written once flush_every records are
+        buffered or flush_interval seconds have passed, whichever comes first.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if truncate:
+            open(path, "wb").close()
+        # unbuffered O_APPEND: every flush is a single write of whole records at the end of
+        # the file, so several processes (trainer and eval worker) can append to the same file
+        self.f = open(path, "ab", buffering=0)
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, step, kind, value, tokens=0, tokens_per_sec=math.nan, lr=math.nan, grad_norm=math.nan, dt=math.nan,
+            comm_seconds=math.nan, comm_bytes=0):
+        record = (step, KINDS.index(kind), value, tokens, tokens_per_sec, lr, grad_norm, dt, comm_seconds, comm_bytes)
+        with self.lock:
+            self.buffer.append(record)
+            full = len(self.buffer) >= self.flush_every
+        if full:
+            self.wakeup.set()
+
+    def flush(self):
+        """Writes everything buffered so far, blocking until it is on disk"""
+        with self.write_lock: # keeps batches in order when close() and the thread race
+            with self.lock:
+                records, self.buffer = self.buffer, []
+            if not records:
+                return
+            rows = [(step, kind, _to_float(value), tokens, _to_float(tps), _to_float(lr), _to_float(norm), _to_float(dt), comm_seconds, comm_bytes)
+                    for step, kind, value, tokens, tps, lr, norm, dt, comm_seconds, comm_bytes in records]
+            self.f.write(np.array(rows, dtype=RECORD_DTYPE).tobytes())
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.f.close()
+
+# -----------------------------------------------------------------------------
+
+def read_metrics(path):
+    """Loads all records as a structured numpy array, ignoring a partially written tail"""
+    data = np.fromfile(path, dtype=np.uint8)
+    n = len(data) // RECORD_DTYPE.itemsize
+    return data[:n * RECORD_DTYPE.itemsize].view(RECORD_DTYPE)
+
+def metrics_by_kind(path):
+    """{kind: structured array of its records sorted by step}"""
+    m = read_metrics(path)
+    out = {}
+    for i, kind in enumerate(KINDS):
+        rows = m[m['kind'] == i]
+        out[kind] = rows[np.argsort(rows['step'], kind='stable')]
+    return out
+
+def tokens_to_target(path, target_loss, kind="val"):
+    """(tokens, step) of the first record of kind with a value <= target_loss, None if never reached"""
+    rows = metrics_by_kind(path)[kind]
+    hits = np.nonzero(rows['value'] <= target_loss)[0]
+    if len(hits) == 0:
+        return None
+    return int(rows['tokens'][hits[0]]), int(rows['step'][hits[0]])
+
+def truncate_metrics(path, last_step):
+    """
+    Drops the records of the steps after last_step, e.g. on resuming from the checkpoint of
+    that step, whose later steps are run (and logged) again. Returns the number dropped.
+    """
+    if not os.path.exists(path):
+        return 0
+    m = read_metrics(path)
+    keep = m[m['step'] <= last_step]
+    with open(path + ".tmp", "wb") as f:
+        f.write(keep.tobytes())
+    os.replace(path + ".tmp", path)
+    return len(m) - len(keep)
+
+def export_text(path, out_path):
+    """Writes the records in the original log.txt format: "{step} {kind} {value}" per line"""
+    m = read_metrics(path)
+    with open(out_path, "w") as f:
+        for step, kind, value in zip(m['step'], m['kind'], m['value']):
+            kind = KINDS[kind]
+            f.write(f"{step} {kind} {value:.6f}\n" if kind == "train" else f"{step} {kind} {value:.4f}\n")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", type=str, nargs="+", help="one or more metrics.bin files")
+    parser.add_argument("--export", type=str, default=None, help="write the records of the (single) file as a log.txt style text file")
+    parser.add_argument("--target_loss", type=float, default=None, help="report the tokens every run needed to reach this val loss")
+    args = parser.parse_args()
+    for path in args.paths:
+        t0 = time.time()
+        by_kind = metrics_by_kind(path)
+        print(f"{path}: loaded {sum(len(v) for v in by_kind.values())} records in {(time.time() - t0)*1000:.1f}ms")
+        for kind, rows in by_kind.items():
+            if len(rows):
+                print(f"  {kind}: {len(rows)} records, steps {rows['step'][0]}..{rows['step'][-1]}, last value {rows['value'][-1]:.4f}")
+        if args.target_loss is not None:
+            hit = tokens_to_target(path, args.target_loss)
+            reached = f"{hit[0]:,} tokens (step {hit[1]})" if hit is not None else "never"
+            print(f"  val loss <= {args.target_loss} reached after: {reached}")
+    if args.export is not None:
+        assert len(args.paths) == 1, "--export takes a single metrics file"
+        export_text(args.paths[0], args.export)
+        print(f"wrote {args.export}")
@@ -0,0 +1,152 @@
+"""
+A data loader that mixes several directories of token shards (as written by fineweb.py)
+with sampling weights, without re-sharding them into one pile.
+
+Every row of a batch is drawn from one source, picked at random with the source weights.
+The picks are a function of (seed, batch index) only, so every rank computes the same
+picks for the whole world's batch and reads just its own rows, no communication needed.
+Each source is read sequentially: the rows drawn from it take the next T tokens of its
+stream, in order, across its shards (and around again after the last one). Shards are
+memory-mapped and only the rows a rank actually uses are read from disk.
+
+The state (batch index and the cursor of every source) is keyed by directory, so a run
+can resume with different weights, or with sources added or removed: the sources keep
+their place and new ones start from their beginning.
+
+python train_gpt2.py --data_mixture edu_fineweb10B:0.8,books:0.2
+python mixture.py edu_fineweb10B:0.8,books:0.2      # print the realized mixture of a few batches
+"""
+
+import os
+import numpy as np
+import torch
+
+# -----------------------------------------------------------------------------
+
+def parse_mixture(spec):
+    """'dir_a:0.8,dir_b:0.2' -> [('dir_a', 0.8), ('dir_b', 0.2)], a missing weight means 1"""
+    sources = []
+    for part in spec.split(","):
+        root, sep, weight = part.strip().rpartition(":")
+        if not sep:
+            root, weight = weight, "1"
+        sources.append((root, float(weight)))
+    return sources
+
+class ShardStream:
+    """The concatenated token shards of one directory, memory-mapped, read at a cursor"""
+
+    def __init__(self, data_root, split):
+        shards = sorted(s for s in os.listdir(data_root) if split in s)
+        assert len(shards) > 0, f"no shards found for split {split} in {data_root}"
+        self.data_root = data_root
+        self.shards = [os.path.join(data_root, s) for s in shards]
+        self.arrays = [None] * len(self.shards) # opened on first use
+        self.current_shard = 0
+        self.current_position = 0
+
+    def shard(self, i):
+        if self.arrays[i] is None:
+            self.arrays[i] = np.load(self.shards[i], mmap_mode="r")
+        return self.arrays[i]
+
+    def read(self, offset, n):
+        """n tokens starting offset tokens past the cursor, the cursor does not move"""
+        shard, position = self.current_shard, self.current_position + offset
+        while position >= len(self.shard(shard)):
+            position -= len(self.shard(shard))
+            shard = (shard + 1) % len(self.shards)
+        pieces = []
+        while n > 0:
+            piece = self.shard(shard)[position:position + n]
+            pieces.append(piece)
+            n -= len(piece)
+            shard, position = (shard + 1) % len(self.shards), 0
+        return np.concatenate(pieces) if len(pieces) > 1 else pieces[0]
+
+    def advance(self, n):
+        self.current_position += n
+        while self.current_position >= len(self.shard(self.current_shard)):
+            self.current_position -= len(self.shard(self.current_shard))
+            self.current_shard = (self.current_shard + 1) % len(self.shards)
+
+class MixtureDataLoader:
+    """Drop-in for DataLoaderLite that draws every row from one of several weighted sources"""
+
+    def __init__(self, B, T, process_rank, num_processes, split, sources, seed=1337):
+        self.B = B
+        self.T = T
+        self.process_rank = process_rank
+        self.num_processes = num_processes
+        self.split = split
+        self.seed = seed
+        assert split in {'train', 'val'}
+        weights = np.array([w for _, w in sources], dtype=np.float64)
+        assert len(sources) > 0 and (weights >= 0).all() and weights.sum() > 0, f"bad mixture weights {sources}"
+        self.weights = weights / weights.sum()
+        self.streams = [ShardStream(root, split) for root, _ in sources]
+        self.reset()
+
+    def reset(self):
+        self.batch_index = 0
+        for stream in self.streams:
+            stream.current_shard, stream.current_position = 0, 0
+
+    def pick_sources(self, num_rows):
+        # the same on every rank: depends only on the seed and the batch index
+        rng = np.random.default_rng([self.seed, self.batch_index])
+        return rng.choice(len(self.streams), size=num_rows, p=self.weights)
+
+    def next_batch(self, B=None, T=None):
+        B = B or self.B
+        T = T or self.T
+        picks = self.pick_sources(B * self.num_processes)
+        # rows drawn from the same source take consecutive windows of its stream
+        row_in_source = np.zeros_like(picks)
+        for s in range(len(self.streams)):
+            mask = picks == s
+            row_in_source[mask] = np.arange(mask.sum())
+        rows = []
+        for row in range(B * self.process_rank, B * (self.process_rank + 1)):
+            rows.append(self.streams[picks[row]].read(row_in_source[row] * T, T + 1))
+        buf = torch.from_numpy(np.stack(rows).astype(np.int64))
+        for s, stream in enumerate(self.streams):
+            stream.advance(int((picks == s).sum()) * T)
+        self.batch_index += 1
+        x = buf[:, :-1].contiguous()
+        y = buf[:, 1:].contiguous()
+        return x, y
+
+    def state_dict(self):
+        return {
+            'batch_index': self.batch_index,
+            'cursors': {s.data_root: (s.current_shard, s.current_position) for s in self.streams},
+        }
+
+    def load_state_dict(self, state):
+        self.batch_index = state['batch_index']
+        for stream in self.streams:
+            # sources that are new to this run start from the beginning
+            stream.current_shard, stream.current_position = state['cursors'].get(stream.data_root, (0, 0))
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mixture", type=str, help="comma separated dir:weight list")
+    parser.add_argument("--split", type=str, default="train", help="train or val")
+    parser.add_argument("--num_batches", type=int, default=100, help="batches to draw")
+    parser.add_argument("-B", type=int, default=16, help="rows per batch")
+    parser.add_argument("-T", type=int, default=1024, help="tokens per row")
+    args = parser.parse_args()
+
+    sources = parse_mixture(args.mixture)
+    loader = MixtureDataLoader(args.B, args.T, 0, 1, args.split, sources)
+    counts = np.zeros(len(sources), dtype=np.int64)
+    for _ in range(args.num_batches):
+        counts += np.bincount(loader.pick_sources(args.B), minlength=len(sources))
+        loader.next_batch()
+    for (root, weight), stream, count in zip(sources, loader.streams, counts):
+        print(f"{root:30s} | weight {weight / sum(w for _, w in sources):.3f} | drawn {count / counts.sum():.3f} of the rows | "
+              f"{len(stream.shards)} shards, at shard {stream.current_shard} position {stream.current_position:,}")
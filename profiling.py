@@ -0,0 +1,109 @@
+"""
+torch.profiler trace capture for a window of training steps.
+
+The line_profiler @profile decorators only give Python line timings. This captures
+operator level time and memory for a few steps of the real training loop:
+
+python train_gpt2.py --profile 5,2,3 --profile_dir log/profile
+
+skips 5 steps (wait), runs 2 steps with the profiler on but discarded (warmup),
+then records 3 steps (active). While recording, every Block and its attention and
+MLP get a record_function range (Block[3], Block[3].attn, Block[3].mlp) so they show
+up by name in the trace. When the window closes we write, per rank:
+
+- trace_rank{r}.json: a Chrome trace, open in chrome://tracing or ui.perfetto.dev
+- memory_rank{r}.html (or .json.gz without matplotlib): the memory timeline
+- summary_rank{r}.txt: the top operators by time and by allocated memory
+
+When --profile is not given nothing here is imported or hooked, the training loop
+only pays one `is not None` check per step.
+"""
+
+import os
+import torch
+from torch.profiler import profile, schedule, record_function, ProfilerActivity
+
+# -----------------------------------------------------------------------------
+
+def add_module_ranges(model):
+    """Wraps the forward of every Block, attention and MLP in a named record_function range"""
+    handles = []
+    stack = []
+    def pre_hook(name):
+        def hook(module, args):
+            rf = record_function(name)
+            rf.__enter__()
+            stack.append(rf)
+        return hook
+    def post_hook(module, args, output):
+        stack.pop().__exit__(None, None, None)
+    for i, block in enumerate(model.transformer.h):
+        for name, module in ((f"Block[{i}]", block), (f"Block[{i}].attn", block.attn), (f"Block[{i}].mlp", block.mlp)):
+            handles.append(module.register_forward_pre_hook(pre_hook(name)))
+            handles.append(module.register_forward_hook(post_hook))
+    return handles
+
+class TrainingProfiler:
+
+    def __init__(self, model, out_dir, wait, warmup, active, rank=0):
+        self.model = model # the raw, unwrapped GPT
+        self.out_dir = out_dir
+        self.rank = rank
+        self.num_steps = wait + warmup + active
+        self.use_cuda = torch.cuda.is_available()
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if self.use_cuda else [])
+        self.prof = profile(
+            activities=activities,
+            schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+            on_trace_ready=self.on_trace_ready,
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=True, # needed for the memory timeline
+        )
+        self.handles = []
+        self.steps = 0
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.handles = add_module_ranges(self.model)
+        self.prof.start()
+
+    def step(self):
+        """Call once at the end of every training step, stops by itself when the window is done"""
+        if self.prof is None:
+            return
+        self.prof.step()
+        self.steps += 1
+        if self.steps >= self.num_steps:
+            self.stop()
+
+    def stop(self):
+        if self.prof is None:
+            return
+        self.prof.stop()
+        self.prof = None
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def on_trace_ready(self, prof):
+        trace_path = os.path.join(self.out_dir, f"trace_rank{self.rank}.json")
+        prof.export_chrome_trace(trace_path)
+        device = f"cuda:{torch.cuda.current_device()}" if self.use_cuda else "cpu"
+        try:
+            import matplotlib # the html memory timeline is rendered with matplotlib
+            memory_path = os.path.join(self.out_dir, f"memory_rank{self.rank}.html")
+        except ImportError:
+            memory_path = os.path.join(self.out_dir, f"memory_rank{self.rank}.json.gz")
+        prof.export_memory_timeline(memory_path, device=device)
+
+        averages = prof.key_averages()
+        time_key = "self_cuda_time_total" if self.use_cuda else "self_cpu_time_total"
+        memory_key = "self_cuda_memory_usage" if self.use_cuda else "self_cpu_memory_usage"
+        summary = (f"top operators by {time_key}\n" + averages.table(sort_by=time_key, row_limit=25) + "\n\n" +
+                   f"top operators by {memory_key}\n" + averages.table(sort_by=memory_key, row_limit=25) + "\n")
+        summary_path = os.path.join(self.out_dir, f"summary_rank{self.rank}.txt")
+        with open(summary_path, "w") as f:
+            f.write(summary)
+        print(summary, flush=True)
+        print(f"profiler: wrote {trace_path}, {memory_path} and {summary_path}", flush=True)
@@ -0,0 +1,121 @@
+"""
+A small inference runtime for the artifacts written by export.py. It needs torch (and
+tiktoken to encode prompts), nothing from the training code.
+
+python runtime.py log/model_19072.pt2 --prompt "Hello, I'm a language model," --max_tokens 32
+python runtime.py log/model_19072.ts --prompt "Hello, I'm a language model," --max_tokens 32
+
+Benchmark against the same InferenceGPT run eagerly, built from the checkpoint the artifact
+was exported from, so the comparison is the export/runtime and not the computation:
+
+python runtime.py log/model_19072.pt2 --bench log/model_19072.pt
+
+- cold start: from launching a fresh python process until the model is ready (imports,
+  loading the weights, building the module), in a subprocess per run
+- first token: forward of the prompt and sampling the first new token
+- steady state: tokens/sec generating the rest (no KV cache in either, so every new
+  token forwards the whole context)
+"""
+
+import sys
+import json
+import time
+import subprocess
+import torch
+
+# -----------------------------------------------------------------------------
+
+def load_artifact(path):
+    """Returns (forward, config): forward maps (B, T) token ids to (B, vocab) next-token logits"""
+    extra_files = {"config.json": ""}
+    if path.endswith(".ts"):
+        forward = torch.jit.load(path, _extra_files=extra_files)
+    else:
+        forward = torch.export.load(path, extra_files=extra_files).module()
+    config = json.loads(extra_files["config.json"])
+    assert config.get("format") == "nanogpt-export-1", f"{path} is not an artifact written by export.py"
+    return forward, config
+
+def load_eager(checkpoint_path):
+    """The exported forward (InferenceGPT, the lm_head only at the last position) run eagerly, for comparison"""
+    from train_gpt2 import GPT, load_checkpoint
+    from export import InferenceGPT
+    model = GPT.from_checkpoint(load_checkpoint(checkpoint_path))
+    model.eval()
+    return InferenceGPT(model).eval(), {"block_size": model.config.block_size}
+
+@torch.no_grad()
+def generate(forward, tokens, max_tokens, block_size, top_k=50, seed=42):
+    """Yields max_tokens sampled tokens, one at a time, continuing the prompt tokens"""
+    rng = torch.Generator().manual_seed(seed)
+    x = torch.tensor([tokens], dtype=torch.long)
+    for _ in range(max_tokens):
+        logits = forward(x[:, -block_size:])
+        probs = torch.softmax(logits.float(), dim=-1)
+        topk_probs, topk_indices = torch.topk(probs, top_k, dim=-1)
+        ix = torch.multinomial(topk_probs, 1, generator=rng)
+        next_token = torch.gather(topk_indices, -1, ix)
+        x = torch.cat((x, next_token), dim=1)
+        yield next_token.item()
+
+def measure(kind, path, prompt_len, max_tokens, t_launch):
+    """Runs in the benchmark subprocess, returns the timings of one cold run"""
+    forward, config = load_artifact(path) if kind == "artifact" else load_eager(path)
+    cold_start = time.time() - t_launch
+    tokens = list(range(1000, 1000 + prompt_len))
+    stream = generate(forward, tokens, max_tokens, config["block_size"])
+    t0 = time.perf_counter()
+    next(stream)
+    first_token = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    num_tokens = sum(1 for _ in stream)
+    return {"cold_start_seconds": cold_start, "first_token_seconds": first_token,
+            "tokens_per_sec": num_tokens / (time.perf_counter() - t0)}
+
+def bench(artifact, checkpoint, runs, prompt_len, max_tokens, num_threads):
+    results = {}
+    for kind, path in [("eager", checkpoint), ("artifact", artifact)]:
+        timings = []
+        for _ in range(runs):
+            cmd = [sys.executable, __file__, path, "--measure", kind, "--launch_time", repr(time.time()),
+                   "--prompt_len", str(prompt_len), "--max_tokens", str(max_tokens)]
+            if num_threads is not None:
+                cmd += ["--num_threads", str(num_threads)]
+            out = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            timings.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        results[kind] = {k: sorted(t[k] for t in timings)[len(timings) // 2] for k in timings[0]} # median
+        print(f"{kind:8s} | cold start {results[kind]['cold_start_seconds']:.2f}s | first token {results[kind]['first_token_seconds'] * 1000:.1f}ms | "
+              f"steady state {results[kind]['tokens_per_sec']:.1f} tok/sec", flush=True)
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="a .pt2 or .ts artifact written by export.py")
+    parser.add_argument("--prompt", type=str, default="Hello, I'm a language model,", help="prompt to continue")
+    parser.add_argument("--max_tokens", type=int, default=32, help="tokens to generate")
+    parser.add_argument("--top_k", type=int, default=50, help="top-k sampling")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch threads")
+    parser.add_argument("--bench", type=str, default=None, help="benchmark against eager InferenceGPT from this checkpoint")
+    parser.add_argument("--runs", type=int, default=3, help="cold runs per side with --bench, the median is reported")
+    parser.add_argument("--prompt_len", type=int, default=64, help="prompt tokens with --bench")
+    parser.add_argument("--measure", type=str, default=None, help=argparse.SUPPRESS) # artifact/eager, one --bench run
+    parser.add_argument("--launch_time", type=float, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    if args.measure is not None:
+        print(json.dumps(measure(args.measure, args.path, args.prompt_len, args.max_tokens, args.launch_time)))
+    elif args.bench is not None:
+        results = bench(args.path, args.bench, args.runs, args.prompt_len, args.max_tokens, args.num_threads)
+        for k in results["eager"]:
+            print(f"{k:20s} artifact / eager: {results['artifact'][k] / results['eager'][k]:.2f}x")
+    else:
+        import tiktoken
+        enc = tiktoken.get_encoding("gpt2")
+        forward, config = load_artifact(args.path)
+        print(args.prompt, end="", flush=True)
+        for token in generate(forward, enc.encode(args.prompt), args.max_tokens, config["block_size"], args.top_k):
+            print(enc.decode([token]), end="", flush=True)
+        print()
@@ -0,0 +1,359 @@
+"""
+A local generation server for our checkpoints, with continuous batching.
+
+HTTP requests are queued and a single scheduler thread runs the model. Every running
+sequence owns a slot of a K/V cache, so every step forwards only the newest token of each
+row (one batch, attending to the row's cache) and samples one token per row with that
+request's own top_k and temperature. New requests are prefilled with their whole prompt
+in the step they join. Rows that hit their max_tokens (or the <|endoftext|> token) are
+evicted right away and queued requests take their place in the next step, so short and
+long requests don't wait on each other.
+
+python serve.py log/model_19072.pt --port 8000 --max_batch 16 --num_threads 16
+python serve.py log/model_19072.pt --unix_socket /tmp/nanogpt.sock
+
+curl -s localhost:8000/generate -d '{"prompt": "Hello, I am a language model,", "max_tokens": 32, "top_k": 50}'
+curl -s localhost:8000/stats
+
+A small load generator to check latency and throughput under concurrency:
+
+python serve.py --client --url http://localhost:8000 --num_requests 64 --concurrency 16
+"""
+
+import os
+import json
+import time
+import queue
+import socket
+import collections
+import threading
+import socketserver
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import torch
+from torch.nn import functional as F
+
+# -----------------------------------------------------------------------------
+EOT = 50256 # <|endoftext|>
+VOCAB = 50257 # the real GPT-2 vocab, our models pad it to 50304
+LATENCY_WINDOW = 1000 # the latency percentiles of /stats are over the last this many requests
+
+class Request:
+
+    def __init__(self, prompt_tokens, max_tokens=64, top_k=50, temperature=1.0, stop_at_eot=True, seed=None):
+        self.prompt_tokens = prompt_tokens
+        self.tokens = list(prompt_tokens)
+        self.max_tokens = max_tokens
+        self.top_k = top_k
+        self.temperature = temperature
+        self.stop_at_eot = stop_at_eot
+        self.rng = torch.Generator().manual_seed(seed) if seed is not None else None
+        self.cache_len = 0 # positions of this request in its slot of the K/V cache, 0 until prefilled
+        self.t_submit = time.time()
+        self.t_start = None # first step in the running batch
+        self.t_done = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def num_generated(self):
+        return len(self.tokens) - len(self.prompt_tokens)
+
+class BatchScheduler:
+
+    def __init__(self, model, device="cpu", max_batch=16, autocast_dtype=None):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.autocast_dtype = autocast_dtype
+        self.block_size = model.config.block_size
+        self.queue = queue.Queue()
+        self.running = [] # row i of the running batch uses slot i of the K/V cache
+        # per layer a (2, max_batch, nkvh, cache_size, hs) K/V cache, grown as the rows get longer
+        self.caches = []
+        self.cache_size = 0
+        # aggregate stats
+        self.t_start = time.time()
+        self.busy_seconds = 0.0
+        self.num_steps = 0
+        self.num_requests = 0
+        self.num_tokens = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def submit(self, request):
+        self.queue.put(request)
+        return request
+
+    def grow_cache(self, size):
+        """Makes room for size positions per slot, doubling up to the context window"""
+        if size <= self.cache_size:
+            return
+        new_size = min(self.block_size, max(size, 2 * self.cache_size, 64))
+        attn = self.model.transformer.h[0].attn
+        shape = (2, self.max_batch, attn.n_kv_head, new_size, attn.n_embd // attn.n_head)
+        dtype = self.autocast_dtype or torch.float32
+        caches = [torch.zeros(shape, dtype=dtype, device=self.device) for _ in self.model.transformer.h]
+        for old, new in zip(self.caches, caches):
+            new[:, :, :, :self.cache_size] = old
+        self.caches, self.cache_size = caches, new_size
+
+    def forward_cached(self, idx, pos, first):
+        """
+        Forwards idx (b, Tc) as rows first..first+b-1 of the running batch, row i continuing
+        at position pos[i]: its K/V are written to its slot of the cache and it attends to
+        everything cached before it. Right padding past a row's real tokens is harmless, it is
+        causally after them and overwritten before it is ever attended to. Returns the
+        (b, Tc, n_embd) output of the last block.
+        """
+        model = self.model
+        b, Tc = idx.size()
+        attn0 = model.transformer.h[0].attn
+        nh, nkvh, C = attn0.n_head, attn0.n_kv_head, attn0.n_embd
+        hs, rep = C // nh, nh // nkvh
+        positions = pos[:, None] + torch.arange(Tc, device=self.device)[None, :] # (b, Tc)
+        L = int(positions.max()) + 1
+        self.grow_cache(L)
+        slots = torch.arange(first, first + b, device=self.device)
+        # query t of row i sees the cached positions up to its own, the same for the rep heads of a group
+        mask = (torch.arange(L, device=self.device)[None, None, :] <= positions[:, :, None]).repeat(1, rep, 1)[:, None]
+        x = model.transformer.wte(idx) + model.transformer.wpe(positions)
+        for block, cache in zip(model.transformer.h, self.caches):
+            attn = block.attn
+            q, k, v = attn.c_attn(block.ln_1(x)).split([C, attn.kv_dim, attn.kv_dim], dim=2)
+            cache[0, slots[:, None], :, positions] = k.view(b, Tc, nkvh, hs).to(cache.dtype)
+            cache[1, slots[:, None], :, positions] = v.view(b, Tc, nkvh, hs).to(cache.dtype)
+            q = q.view(b, Tc, nkvh, rep, hs).permute(0, 2, 3, 1, 4).reshape(b, nkvh, rep * Tc, hs)
+            y = F.scaled_dot_product_attention(q, cache[0, first:first + b, :, :L], cache[1, first:first + b, :, :L], attn_mask=mask)
+            y = y.view(b, nkvh, rep, Tc, hs).permute(0, 3, 1, 2, 4).reshape(b, Tc, C)
+            x = x + attn.c_proj(y)
+            x = x + block.mlp(block.ln_2(x))
+        return x
+
+    @torch.no_grad()
+    def step(self):
+        """Forwards the running batch once and appends one sampled token to every row"""
+        # rows with a cache feed just their last token. The others (new requests, and rows that
+        # outgrew the context window, see evict) are at the end of the batch and get prefilled
+        # with their last block_size tokens from position 0, the same context as a full forward
+        num_cached = sum(1 for r in self.running if r.cache_len > 0)
+        prefill = [r.tokens[-self.block_size:] for r in self.running[num_cached:]]
+        autocast = torch.autocast(device_type="cuda" if str(self.device).startswith("cuda") else "cpu",
+                                  dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None)
+        last = []
+        with autocast:
+            if num_cached > 0:
+                idx = torch.tensor([[r.tokens[-1]] for r in self.running[:num_cached]], device=self.device)
+                pos = torch.tensor([r.cache_len for r in self.running[:num_cached]], device=self.device)
+                last.append(self.forward_cached(idx, pos, 0)[:, -1])
+            if prefill:
+                lengths = torch.tensor([len(t) for t in prefill], device=self.device)
+                idx = torch.zeros((len(prefill), int(lengths.max())), dtype=torch.long)
+                for i, t in enumerate(prefill):
+                    idx[i, :len(t)] = torch.tensor(t)
+                x = self.forward_cached(idx.to(self.device), torch.zeros_like(lengths), num_cached)
+                last.append(x[torch.arange(len(prefill), device=self.device), lengths - 1])
+            # ln_f and the lm_head only at the one position per row we sample from
+            logits = self.model.lm_head(self.model.transformer.ln_f(torch.cat(last))).float()
+        for r in self.running[:num_cached]:
+            r.cache_len += 1
+        for r, t in zip(self.running[num_cached:], prefill):
+            r.cache_len = len(t)
+        logits[:, VOCAB:] = -float("inf") # never sample the padding tokens of the vocab
+        temperature = torch.tensor([max(r.temperature, 1e-5) for r in self.running], device=logits.device)
+        probs = F.softmax(logits / temperature[:, None], dim=-1)
+        # per-row top-k: take the largest k of the batch, then drop the columns past each row's k
+        top_k = torch.tensor([min(r.top_k, VOCAB) for r in self.running], device=logits.device)
+        topk_probs, topk_indices = torch.topk(probs, int(top_k.max()), dim=-1)
+        topk_probs[torch.arange(topk_probs.size(1), device=logits.device)[None, :] >= top_k[:, None]] = 0.0
+        topk_probs = topk_probs.cpu()
+        for i, r in enumerate(self.running):
+            ix = torch.multinomial(topk_probs[i], 1, generator=r.rng)
+            r.tokens.append(topk_indices[i, ix].item())
+
+    def run(self):
+        while True:
+            # admit new requests into the free slots, block only when there is nothing to do
+            while len(self.running) < self.max_batch:
+                try:
+                    request = self.queue.get(block=not self.running)
+                except queue.Empty:
+                    break
+                request.t_start = time.time()
+                self.running.append(request)
+            t0 = time.time()
+            try:
+                self.step()
+            except Exception as e:
+                # fail the running requests rather than leave their clients hanging
+                for r in self.running:
+                    r.error, r.t_done = repr(e), time.time()
+                    r.done.set()
+                self.running = []
+                continue
+            self.busy_seconds += time.time() - t0
+            self.num_steps += 1
+            self.num_tokens += len(self.running)
+            self.evict()
+
+    def evict(self):
+        """Drops the finished rows and moves the cache slots of the others down to stay in order"""
+        kept, refill = [], []
+        for i, r in enumerate(self.running):
+            if r.num_generated >= r.max_tokens or (r.stop_at_eot and r.tokens[-1] == EOT):
+                r.t_done = time.time()
+                self.num_requests += 1
+                self.latencies.append(r.t_done - r.t_submit)
+                r.done.set()
+            elif r.cache_len >= self.block_size:
+                # the cache is full: the next step prefills the last block_size tokens again
+                r.cache_len = 0
+                refill.append(r)
+            else:
+                # rows only ever move to a lower slot, so no slot is overwritten before it was read
+                j = len(kept)
+                if i != j:
+                    for cache in self.caches:
+                        cache[:, j, :, :r.cache_len] = cache[:, i, :, :r.cache_len]
+                kept.append(r)
+        self.running = kept + refill
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+        return {
+            "requests": self.num_requests,
+            "tokens": self.num_tokens,
+            "running": len(self.running),
+            "queued": self.queue.qsize(),
+            "steps": self.num_steps,
+            "mean_batch_size": self.num_tokens / max(1, self.num_steps),
+            "tokens_per_sec": self.num_tokens / max(1e-9, time.time() - self.t_start),
+            "busy_tokens_per_sec": self.num_tokens / max(1e-9, self.busy_seconds),
+            "latency_p50": pct(0.5),
+            "latency_p90": pct(0.9),
+            "latency_p99": pct(0.99),
+        }
+
+# -----------------------------------------------------------------------------
+
+def make_handler(scheduler, enc):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, obj, code=200):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self.send_json(scheduler.stats())
+            else:
+                self.send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            if self.path != "/generate":
+                return self.send_json({"error": "not found"}, 404)
+            try:
+                args = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                prompt_tokens = enc.encode(args["prompt"]) or [EOT]
+                request = Request(prompt_tokens, max_tokens=int(args.get("max_tokens", 64)), top_k=int(args.get("top_k", 50)),
+                                  temperature=float(args.get("temperature", 1.0)), stop_at_eot=bool(args.get("stop_at_eot", True)),
+                                  seed=int(args["seed"]) if args.get("seed") is not None else None)
+                assert request.max_tokens > 0 and request.top_k > 0, "max_tokens and top_k must be positive"
+            except (KeyError, ValueError, TypeError, AssertionError) as e:
+                return self.send_json({"error": f"bad request: {e}"}, 400)
+            scheduler.submit(request)
+            request.done.wait()
+            if request.error is not None:
+                return self.send_json({"error": request.error}, 500)
+            latency = request.t_done - request.t_submit
+            print(f"request: {len(request.prompt_tokens)} prompt tokens, {request.num_generated} generated | "
+                  f"queued {request.t_start - request.t_submit:.2f}s | latency {latency:.2f}s", flush=True)
+            self.send_json({
+                "text": enc.decode(request.tokens[len(request.prompt_tokens):]),
+                "prompt_tokens": len(request.prompt_tokens),
+                "generated_tokens": request.num_generated,
+                "queue_seconds": request.t_start - request.t_submit,
+                "latency_seconds": latency,
+            })
+
+        def log_message(self, format, *args):
+            pass # we print our own line per request
+
+    return Handler
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self) # skip the host/port lookup of HTTPServer
+        self.server_name, self.server_port = "localhost", 0
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+def run_client(args):
+    """Fires num_requests prompts at a running server, concurrency at a time"""
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+    prompts = ["Hello, I'm a language model,", "The meaning of life is", "Once upon a time", "In machine learning, a transformer"]
+    def one(i):
+        body = json.dumps({"prompt": prompts[i % len(prompts)], "max_tokens": 16 + 16 * (i % 4), "top_k": 50, "seed": i}).encode("utf-8")
+        with urllib.request.urlopen(urllib.request.Request(args.url + "/generate", data=body)) as resp:
+            return json.loads(resp.read())
+    t0 = time.time()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(one, range(args.num_requests)))
+    dt = time.time() - t0
+    latencies = sorted(r["latency_seconds"] for r in results)
+    num_tokens = sum(r["generated_tokens"] for r in results)
+    print(f"{len(results)} requests, {num_tokens} tokens in {dt:.2f}s | {num_tokens / dt:.1f} tok/sec | "
+          f"latency p50 {latencies[len(latencies) // 2]:.2f}s max {latencies[-1]:.2f}s")
+    with urllib.request.urlopen(args.url + "/stats") as resp:
+        print("server stats:", json.loads(resp.read()))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint", type=str, nargs="?", default=None, help="a log/model_*.pt checkpoint to serve")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument("--unix_socket", type=str, default=None, help="listen on this unix socket instead of a port")
+    parser.add_argument("-d", "--device", type=str, default="cpu", help="the device to use")
+    parser.add_argument("--max_batch", type=int, default=16, help="maximum number of sequences in the running batch")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch threads")
+    parser.add_argument("--client", action="store_true", help="run the load generator against --url instead of serving")
+    parser.add_argument("--url", type=str, default="http://localhost:8000", help="server to load with --client")
+    parser.add_argument("--num_requests", type=int, default=32, help="requests sent by --client")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent requests of --client")
+    args = parser.parse_args()
+    if args.client:
+        run_client(args)
+        raise SystemExit
+
+    from train_gpt2 import GPT, load_checkpoint, get_best_float_config
+    from eval_harness import get_encoding
+    assert args.checkpoint is not None, "pass a checkpoint to serve"
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    model = GPT.from_checkpoint(load_checkpoint(args.checkpoint))
+    model.to(args.device)
+    model.eval()
+    dtype = get_best_float_config()
+    scheduler = BatchScheduler(model, args.device, args.max_batch, autocast_dtype=dtype if dtype != torch.float32 else None)
+    scheduler.thread.start()
+    handler = make_handler(scheduler, get_encoding())
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = UnixHTTPServer(args.unix_socket, handler)
+        print(f"serving {args.checkpoint} on unix socket {args.unix_socket}", flush=True)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print(f"serving {args.checkpoint} on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
@@ -0,0 +1,236 @@
+"""
+Layer-streaming evaluation: scores the eval_harness tasks with a model that does not fit
+in RAM, holding the weights of only one Block (or the embedding) at a time.
+
+First the weights are split into one file per Block (plus the embedding and the final
+layernorm), tensor by tensor, so not even the conversion needs the whole model in RAM:
+pretrained weights are read from the huggingface safetensors file, our checkpoints are
+memory-mapped. Then all eval rows are tokenized and batched as in eval_harness.py, and a
+group of batches is pushed through the model one layer at a time: embed every batch,
+memory-map block 0, run every batch through it, drop it, block 1, ... and finally the
+classifier. The hidden states of the group stay in RAM between the layers, so the group
+is sized from --ram_cap_mb: the cap minus the baseline RSS, the largest layer file and
+the working memory of one batch. A smaller cap means more groups, i.e. more passes over
+the weights (served from the page cache if it is big enough, from disk otherwise).
+
+python stream_eval.py weights/gpt2-xl --source gpt2-xl --tasks hellaswag --ram_cap_mb 3000
+python stream_eval.py weights/model_19072 --source log/model_19072.pt --ram_cap_mb 1500 --check
+
+--source is only needed the first time, the split weights are reused afterwards. --check
+also scores with the whole model in RAM and asserts the results match (small models only).
+Peak memory is the peak RSS of the process, which includes the mapped pages of the layer
+being evaluated.
+"""
+
+import os
+import json
+import time
+import resource
+import dataclasses
+import torch
+from train_gpt2 import GPT, GPTConfig, Block, load_checkpoint
+from eval_harness import resolve_tasks, build_requests, iterate_batches, completion_losses, score_examples, print_stats
+
+# -----------------------------------------------------------------------------
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kilobytes on Linux
+
+# -----------------------------------------------------------------------------
+# splitting the weights into one file per layer
+
+def layer_keys(config):
+    """{file name: [parameter names in our state_dict, without the transformer. prefix]}"""
+    block = ["ln_1.weight", "ln_1.bias", "attn.c_attn.weight", "attn.c_attn.bias", "attn.c_proj.weight", "attn.c_proj.bias",
+             "ln_2.weight", "ln_2.bias", "mlp.c_fc.weight", "mlp.c_fc.bias", "mlp.c_proj.weight", "mlp.c_proj.bias"]
+    files = {"embed": ["wte.weight", "wpe.weight"]}
+    for i in range(config.n_layer):
+        files[f"block_{i:03d}"] = [f"h.{i}.{k}" for k in block]
+    files["head"] = ["ln_f.weight", "ln_f.bias"] # the classifier is tied to wte
+    return files
+
+def split_weights(get_tensor, config, out_dir):
+    """Writes the tensors returned by get_tensor(name) into one file per layer"""
+    os.makedirs(out_dir, exist_ok=True)
+    for name, keys in layer_keys(config).items():
+        # block files hold the keys of a Block's own state_dict
+        prefix = f"h.{int(name[6:])}." if name.startswith("block") else ""
+        torch.save({k.removeprefix(prefix): get_tensor(k).clone() for k in keys}, os.path.join(out_dir, f"{name}.pt"))
+    with open(os.path.join(out_dir, "config.json"), "w") as f:
+        json.dump(dataclasses.asdict(config), f)
+
+def split_pretrained(model_type, out_dir):
+    # the safetensors file is read one tensor at a time, the HF model is never built
+    from huggingface_hub import hf_hub_download
+    from safetensors import safe_open
+    config = GPT.pretrained_config(model_type)
+    f = safe_open(hf_hub_download(model_type, "model.safetensors"), framework="pt")
+    names = {k.removeprefix("transformer."): k for k in f.keys()}
+    # the openai checkpoints use a "Conv1D" module, we use a vanilla Linear, see GPT.from_pretrained
+    transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
+    def get_tensor(k):
+        t = f.get_tensor(names[k])
+        return t.t() if any(k.endswith(w) for w in transposed) else t
+    split_weights(get_tensor, config, out_dir)
+
+def split_checkpoint(path, out_dir):
+    checkpoint = load_checkpoint(path, mmap=True)
+    state_dict = {k.removeprefix('_orig_mod.').removeprefix('transformer.'): v for k, v in checkpoint['model'].items()}
+    split_weights(state_dict.__getitem__, checkpoint['config'], out_dir)
+
+# -----------------------------------------------------------------------------
+# streaming forward
+
+class LayerStream:
+    """The split weights of a model, every layer memory-mapped on demand"""
+
+    def __init__(self, weights_dir):
+        self.weights_dir = weights_dir
+        with open(os.path.join(weights_dir, "config.json")) as f:
+            self.config = GPTConfig(**json.load(f))
+        self.file_mb = {name: os.path.getsize(os.path.join(weights_dir, f"{name}.pt")) / 2**20 for name in layer_keys(self.config)}
+        self.loads = 0
+
+    def load(self, name):
+        self.loads += 1
+        return torch.load(os.path.join(self.weights_dir, f"{name}.pt"), mmap=True, weights_only=True)
+
+    def block(self, i):
+        with torch.device("meta"): # no memory for the weights, they are assigned from the mapped file
+            block = Block(self.config)
+        block.load_state_dict(self.load(f"block_{i:03d}"), assign=True)
+        return block.eval()
+
+def plan_groups(batches, stream, ram_cap_mb, max_batch_tokens, head_rows_tokens):
+    """Splits the batches into groups whose hidden states fit under the RAM cap"""
+    C, V = stream.config.n_embd, stream.config.vocab_size
+    resident_mb = max(stream.file_mb["embed"] + stream.file_mb["head"], max(stream.file_mb.values()))
+    # in-flight memory of one batch: qkv, attention output, the 4x MLP activations, residuals (fp32)
+    working_mb = max_batch_tokens * C * 4 * 16 / 2**20
+    # the classifier: the logits of a chunk of rows, their shifted fp32 copy, log-softmax and gradients-free temporaries
+    head_mb = head_rows_tokens * V * 4 * 5 / 2**20
+    budget_mb = ram_cap_mb - rss_mb() - resident_mb - max(working_mb, head_mb)
+    assert budget_mb > 0, f"a {ram_cap_mb}MB cap leaves no room for activations: RSS {rss_mb():.0f}MB, largest layer {resident_mb:.0f}MB, working memory {max(working_mb, head_mb):.0f}MB"
+    max_group_tokens = int(budget_mb * 2**20 / (C * 4))
+    groups, group, group_tokens = [], [], 0
+    for batch in batches:
+        tokens = batch[1].numel()
+        if group and group_tokens + tokens > max_group_tokens:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(batch)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups, budget_mb
+
+@torch.no_grad()
+def evaluate_streaming(stream, task_names, ram_cap_mb, limit=None, max_batch_tokens=4096, max_batch_rows=64, head_rows_tokens=128):
+    """evaluate_tasks with one layer resident at a time, returns (stats, report)"""
+    t_start = time.time()
+    config = stream.config
+    rows, examples = build_requests(task_names, limit=limit, block_size=config.block_size)
+    batches = list(iterate_batches(rows, max_batch_tokens, max_batch_rows))
+    groups, budget_mb = plan_groups(batches, stream, ram_cap_mb, max_batch_tokens, head_rows_tokens)
+    print(f"{len(rows)} rows in {len(batches)} batches, {len(groups)} groups under the {ram_cap_mb}MB cap "
+          f"({budget_mb:.0f}MB for hidden states)", flush=True)
+    sum_losses = torch.zeros(len(rows))
+    avg_losses = torch.zeros(len(rows))
+    for g, group in enumerate(groups):
+        t0 = time.time()
+        embed = stream.load("embed")
+        pos = torch.arange(0, max(tokens.size(1) for _, tokens, _ in group), dtype=torch.long)
+        hidden = [embed["wte.weight"][tokens] + embed["wpe.weight"][pos[:tokens.size(1)]] for _, tokens, _ in group]
+        del embed
+        for i in range(config.n_layer):
+            block = stream.block(i)
+            # in place, so only one batch has both its old and new hidden state alive (plan_groups budgets one copy)
+            for j, x in enumerate(hidden):
+                hidden[j] = block(x)
+            del x
+            del block # unmaps the layer
+        embed, head = stream.load("embed"), stream.load("head")
+        wte = embed["wte.weight"]
+        for (batch, tokens, mask), x in zip(group, hidden):
+            x = torch.nn.functional.layer_norm(x, (config.n_embd,), head["ln_f.weight"], head["ln_f.bias"])
+            # the logits of a few rows at a time, they are the largest tensors of the forward
+            rows_per_chunk = max(1, head_rows_tokens // tokens.size(1))
+            for r in range(0, len(batch), rows_per_chunk):
+                logits = x[r:r + rows_per_chunk] @ wte.T
+                sum_loss, avg_loss = completion_losses(tokens[r:r + rows_per_chunk], mask[r:r + rows_per_chunk], logits)
+                sum_losses[batch[r:r + rows_per_chunk]] = sum_loss
+                avg_losses[batch[r:r + rows_per_chunk]] = avg_loss
+        del embed, head, wte, hidden
+        num_tokens = sum(tokens.numel() for _, tokens, _ in group)
+        print(f"group {g + 1}/{len(groups)} | {num_tokens:,} padded tokens | {time.time() - t0:.1f}s | peak RSS {peak_rss_mb():.0f}MB", flush=True)
+
+    stats = {task: {'num_total': 0, 'num_correct': 0, 'num_correct_norm': 0, 'num_tokens': 0, 'seconds': 0.0} for task in task_names}
+    seconds = time.time() - t_start
+    total_tokens = sum(len(r[3]) for r in rows)
+    for task, _, _, tokens, _ in rows:
+        stats[task]['num_tokens'] += len(tokens)
+        stats[task]['seconds'] += seconds * len(tokens) / total_tokens
+    score_examples(stats, task_names, examples, sum_losses, avg_losses)
+    report = {
+        "ram_cap_mb": ram_cap_mb,
+        "peak_rss_mb": peak_rss_mb(),
+        "model_mb": sum(stream.file_mb.values()),
+        "groups": len(groups),
+        "layer_loads": stream.loads,
+        "seconds": seconds,
+        "tokens_per_sec": total_tokens / seconds,
+    }
+    return stats, report
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("weights_dir", type=str, help="directory of the split weights")
+    parser.add_argument("--source", type=str, default=None, help="gpt2/gpt2-medium/... or a log/model_*.pt checkpoint to split into weights_dir first")
+    parser.add_argument("--tasks", type=str, default="hellaswag", help="comma separated tasks, name=path.jsonl for local files")
+    parser.add_argument("--ram_cap_mb", type=float, default=2048, help="RAM the eval may use, sets how many rows go through each layer at once")
+    parser.add_argument("--limit", type=int, default=None, help="only score the first N examples of each task")
+    parser.add_argument("--max_batch_tokens", type=int, default=4096, help="padded tokens per forward of a layer")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch threads")
+    parser.add_argument("--check", action="store_true", help="also evaluate with the whole model in RAM and compare")
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    if args.source is not None:
+        t0 = time.time()
+        if args.source.startswith("gpt2"):
+            split_pretrained(args.source, args.weights_dir)
+        else:
+            split_checkpoint(args.source, args.weights_dir)
+        print(f"split {args.source} into {args.weights_dir} in {time.time() - t0:.1f}s, peak RSS {peak_rss_mb():.0f}MB", flush=True)
+    task_names = resolve_tasks(args.tasks)
+    stream = LayerStream(args.weights_dir)
+    stats, report = evaluate_streaming(stream, task_names, args.ram_cap_mb, args.limit, args.max_batch_tokens)
+    print_stats(stats)
+    print(f"peak RSS {report['peak_rss_mb']:.0f}MB under a {args.ram_cap_mb:.0f}MB cap for a {report['model_mb']:.0f}MB model | "
+          f"{report['groups']} groups, {report['layer_loads']} layer loads | {report['seconds']:.1f}s, {report['tokens_per_sec']:.0f} tok/sec")
+    if report['peak_rss_mb'] > args.ram_cap_mb:
+        print(f"warning: the peak RSS exceeded the cap by {report['peak_rss_mb'] - args.ram_cap_mb:.0f}MB")
+
+    if args.check:
+        from eval_harness import evaluate_tasks
+        model = GPT(stream.config)
+        state_dict = {}
+        for name in layer_keys(stream.config):
+            prefix = f"transformer.h.{int(name[6:])}." if name.startswith("block") else "transformer."
+            state_dict.update({prefix + k: v for k, v in stream.load(name).items()})
+        state_dict["lm_head.weight"] = state_dict["transformer.wte.weight"]
+        model.load_state_dict(state_dict, strict=False) # the causal mask buffers are not saved
+        model.eval()
+        expected = evaluate_tasks(model, task_names, "cpu", limit=args.limit, max_batch_tokens=args.max_batch_tokens)
+        for task in task_names:
+            for k in ("num_total", "num_correct", "num_correct_norm"):
+                assert stats[task][k] == expected[task][k], f"{task} {k}: streaming {stats[task][k]} vs in-RAM {expected[task][k]}"
+        print("matches the in-RAM evaluation")
@@ -0,0 +1,318 @@
+"""
+Tensor parallelism (Megatron style) for the attention and MLP of every Block, so a
+model that does not fit on one GPU can be split over the tp ranks of a node.
+
+Within a tensor-parallel group of size tp:
+- c_attn and c_fc are split column-wise: every rank computes the q, k, v of
+  n_head / tp heads, or 4 * n_embd / tp of the MLP hidden units
+- the attention and MLP c_proj are split row-wise: every rank multiplies its slice of
+  the hidden activations and a single all-reduce sums the partial outputs
+so each Block costs two all-reduces in the forward and two in the backward. Embeddings,
+layernorms and the lm_head stay replicated on every rank.
+
+Composes with data parallelism: the world is split into world_size / tp data-parallel
+replicas, DDP averages the gradients over the dp group, and all the ranks of one tp
+group read the same batches. The tp ranks of a group are consecutive, so they land on
+the same node:
+
+torchrun --standalone --nproc_per_node=8 train_gpt2.py --tensor_parallel 2  # 4 dp x 2 tp
+
+Correctness check against the single-process model on CPU with the gloo backend:
+
+torchrun --standalone --nproc_per_node=2 tensor_parallel.py            # tp=2
+torchrun --standalone --nproc_per_node=4 tensor_parallel.py --tp 2     # 2 dp x 2 tp, with DDP
+"""
+
+import math
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn import functional as F
+from train_gpt2 import sdpa_gqa
+
+# -----------------------------------------------------------------------------
+# the two communication primitives, f and g in the Megatron-LM paper
+
+class _CopyToTensorParallel(torch.autograd.Function):
+    """Identity in the forward, all-reduce of the input gradient in the backward"""
+
+    @staticmethod
+    def forward(ctx, x, group):
+        ctx.group = group
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.clone()
+        dist.all_reduce(grad, group=ctx.group)
+        return grad, None
+
+class _ReduceFromTensorParallel(torch.autograd.Function):
+    """All-reduce of the partial outputs in the forward, identity in the backward"""
+
+    @staticmethod
+    def forward(ctx, x, group):
+        x = x.clone()
+        dist.all_reduce(x, group=group)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad, None
+
+def copy_to_tp(x, group):
+    return _CopyToTensorParallel.apply(x, group)
+
+def reduce_from_tp(x, group):
+    return _ReduceFromTensorParallel.apply(x, group)
+
+# -----------------------------------------------------------------------------
+
+class ColumnParallelLinear(nn.Module):
+    """Holds out_features / tp output rows of the weight and the matching bias"""
+
+    def __init__(self, in_features, out_features, group):
+        super().__init__()
+        self.group = group
+        tp = dist.get_world_size(group)
+        assert out_features % tp == 0
+        self.weight = nn.Parameter(torch.empty(out_features // tp, in_features))
+        self.bias = nn.Parameter(torch.empty(out_features // tp))
+        self.weight.tensor_parallel = self.bias.tensor_parallel = True # sharded, see clip_grad_norm_
+
+    def forward(self, x):
+        return F.linear(copy_to_tp(x, self.group), self.weight, self.bias)
+
+class RowParallelLinear(nn.Module):
+    """Holds in_features / tp input columns of the weight, the bias is replicated"""
+
+    def __init__(self, in_features, out_features, group):
+        super().__init__()
+        self.group = group
+        tp = dist.get_world_size(group)
+        assert in_features % tp == 0
+        self.weight = nn.Parameter(torch.empty(out_features, in_features // tp))
+        self.bias = nn.Parameter(torch.empty(out_features))
+        self.weight.tensor_parallel = True
+
+    def forward(self, x):
+        # the bias is added once, after summing the partial products of all ranks
+        return reduce_from_tp(F.linear(x, self.weight), self.group) + self.bias
+
+class TensorParallelCausalSelfAttention(nn.Module):
+
+    def __init__(self, config, group):
+        super().__init__()
+        tp = dist.get_world_size(group)
+        n_kv_head = config.n_kv_head or config.n_head
+        assert config.n_embd % config.n_head == 0
+        assert config.n_head % tp == 0, f"n_head {config.n_head} must be divisible by the tensor parallel size {tp}"
+        assert n_kv_head % tp == 0, f"n_kv_head {n_kv_head} must be divisible by the tensor parallel size {tp}"
+        self.n_head = config.n_head // tp # local query heads
+        self.n_kv_head = n_kv_head // tp # local key/value heads, shared by the same query heads as in the full model
+        self.head_size = config.n_embd // config.n_head
+        # query, key, value projections for this rank's heads, laid out as [q, k, v]
+        self.c_attn = ColumnParallelLinear(config.n_embd, config.n_embd + 2 * n_kv_head * self.head_size, group)
+        # output projection, summed over the ranks
+        self.c_proj = RowParallelLinear(config.n_embd, config.n_embd, group)
+
+    def forward(self, x):
+        B, T, C = x.size()
+        qkv = self.c_attn(x)
+        kv_dim = self.n_kv_head * self.head_size
+        q, k, v = qkv.split([self.n_head * self.head_size, kv_dim, kv_dim], dim=2)
+        k = k.view(B, T, self.n_kv_head, self.head_size).transpose(1, 2) # (B, local nkvh, T, hs)
+        q = q.view(B, T, self.n_head, self.head_size).transpose(1, 2) # (B, local nh, T, hs)
+        v = v.view(B, T, self.n_kv_head, self.head_size).transpose(1, 2) # (B, local nkvh, T, hs)
+        y = sdpa_gqa(q, k, v) # flash attention
+        y = y.transpose(1, 2).contiguous().view(B, T, self.n_head * self.head_size)
+        return self.c_proj(y)
+
+class TensorParallelMLP(nn.Module):
+
+    def __init__(self, config, group):
+        super().__init__()
+        self.c_fc    = ColumnParallelLinear(config.n_embd, 4 * config.n_embd, group)
+        self.gelu    = nn.GELU(approximate='tanh')
+        self.c_proj  = RowParallelLinear(4 * config.n_embd, config.n_embd, group)
+
+    def forward(self, x):
+        x = self.c_fc(x)
+        x = self.gelu(x)
+        x = self.c_proj(x)
+        return x
+
+# -----------------------------------------------------------------------------
+# converting between the full GPT and its shards
+
+def _split_qkv(config, tensor, tp=1):
+    # (C + 2 * kv_dim, ...) -> q, k, v of shapes (tp, heads // tp, hs, ...), so the heads of
+    # every rank can be sliced out; with tp > 1 the input is the concatenation of the tp shards
+    hs = config.n_embd // config.n_head
+    n_kv_head = config.n_kv_head or config.n_head
+    sizes = [config.n_head // tp * hs, n_kv_head // tp * hs, n_kv_head // tp * hs]
+    rest = tensor.shape[1:]
+    shards = [shard.split(sizes, dim=0) for shard in tensor.chunk(tp, dim=0)]
+    return [torch.stack([shard[i] for shard in shards]).view(tp, -1, hs, *rest) for i in range(3)]
+
+@torch.no_grad()
+def parallelize(model, group):
+    """
+    Replaces the attention and MLP of every Block of a full GPT with the shards of this
+    rank, in place. Build the model with the same seed on every rank (or load the same
+    weights) first, so the shards come from the same full model. Returns the model.
+    """
+    tp, r = dist.get_world_size(group), dist.get_rank(group)
+    config = model.config
+    heads = slice(r * config.n_head // tp, (r + 1) * config.n_head // tp)
+    hidden = slice(r * 4 * config.n_embd // tp, (r + 1) * 4 * config.n_embd // tp)
+    def shard_qkv(tensor):
+        # query heads and kv heads are split in the same proportion, so a rank's kv heads
+        # are exactly the ones its query heads are grouped with
+        q, k, v = _split_qkv(config, tensor)
+        return torch.cat([t[0].chunk(tp, dim=0)[r].reshape(-1, *tensor.shape[1:]) for t in (q, k, v)])
+    for block in model.transformer.h:
+        attn, mlp = block.attn, block.mlp
+        tp_attn = TensorParallelCausalSelfAttention(config, group)
+        tp_attn.c_attn.weight.copy_(shard_qkv(attn.c_attn.weight))
+        tp_attn.c_attn.bias.copy_(shard_qkv(attn.c_attn.bias))
+        c_proj = attn.c_proj.weight.view(config.n_embd, config.n_head, -1)
+        tp_attn.c_proj.weight.copy_(c_proj[:, heads].reshape(config.n_embd, -1))
+        tp_attn.c_proj.bias.copy_(attn.c_proj.bias)
+        tp_mlp = TensorParallelMLP(config, group)
+        tp_mlp.c_fc.weight.copy_(mlp.c_fc.weight[hidden])
+        tp_mlp.c_fc.bias.copy_(mlp.c_fc.bias[hidden])
+        tp_mlp.c_proj.weight.copy_(mlp.c_proj.weight[:, hidden])
+        tp_mlp.c_proj.bias.copy_(mlp.c_proj.bias)
+        block.attn, block.mlp = tp_attn.to(attn.c_attn.weight.device), tp_mlp.to(mlp.c_fc.weight.device)
+    return model
+
+@torch.no_grad()
+def full_state_dict(model, group):
+    """
+    The state dict of the equivalent full GPT, gathered from the shards of all tp ranks,
+    so checkpoints load with GPT.from_checkpoint. A collective: every rank must call it.
+    """
+    config = model.config
+    tp = dist.get_world_size(group)
+    def gather(tensor):
+        shards = [torch.empty_like(tensor) for _ in range(tp)]
+        dist.all_gather(shards, tensor.contiguous(), group=group)
+        return shards
+    state_dict = {}
+    for name, tensor in model.state_dict().items():
+        if ".attn.c_attn." in name:
+            # every shard is [q, k, v] of its heads, interleave them back per q, k, v
+            q, k, v = _split_qkv(config, torch.cat(gather(tensor)), tp)
+            tensor = torch.cat([t.reshape(-1, *tensor.shape[1:]) for t in (q, k, v)])
+        elif name.endswith(".mlp.c_fc.weight") or name.endswith(".mlp.c_fc.bias"):
+            tensor = torch.cat(gather(tensor), dim=0)
+        elif name.endswith(".attn.c_proj.weight") or name.endswith(".mlp.c_proj.weight"):
+            tensor = torch.cat(gather(tensor), dim=1)
+        state_dict[name] = tensor
+    return state_dict
+
+def clip_grad_norm_(parameters, max_norm, group):
+    """
+    torch.nn.utils.clip_grad_norm_ for a tensor-parallel model: the squared norms of the
+    sharded gradients are summed over the tp group, the replicated ones counted once.
+    """
+    parameters = [p for p in parameters if p.grad is not None]
+    device = parameters[0].grad.device
+    sharded = torch.zeros((), device=device)
+    replicated = torch.zeros((), device=device)
+    for p in parameters:
+        if getattr(p, "tensor_parallel", False):
+            sharded += p.grad.detach().float().pow(2).sum()
+        else:
+            replicated += p.grad.detach().float().pow(2).sum()
+    dist.all_reduce(sharded, group=group)
+    total_norm = (sharded + replicated).sqrt()
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    for p in parameters:
+        p.grad.detach().mul_(clip_coef)
+    return total_norm
+
+def init_parallel_groups(tp_size):
+    """
+    Splits the world into tp groups of consecutive ranks and dp groups of ranks with the
+    same position in their tp group. Returns (tp_group, dp_group, tp_rank, dp_rank, dp_size).
+    """
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    assert world_size % tp_size == 0, f"world size {world_size} must be divisible by the tensor parallel size {tp_size}"
+    dp_size = world_size // tp_size
+    tp_group = dp_group = None
+    # every rank has to take part in creating every group
+    for d in range(dp_size):
+        ranks = list(range(d * tp_size, (d + 1) * tp_size))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            tp_group = group
+    for t in range(tp_size):
+        ranks = list(range(t, world_size, tp_size))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            dp_group = group
+    return tp_group, dp_group, rank % tp_size, rank // tp_size, dp_size
+
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    # compares losses, gradient norms and the gathered weights of the tp (x dp) model
+    # against the single-process model, trained side by side for a few steps on CPU
+    import os
+    import argparse
+    from torch.nn.parallel import DistributedDataParallel as DDP
+    from train_gpt2 import GPT, GPTConfig
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tp", type=int, default=None, help="tensor parallel size, defaults to the world size")
+    parser.add_argument("--n_kv_head", type=int, default=None, help="check grouped-query attention with this many kv heads")
+    parser.add_argument("--steps", type=int, default=5, help="optimization steps to compare")
+    args = parser.parse_args()
+
+    dist.init_process_group(backend="gloo")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    tp_group, dp_group, tp_rank, dp_rank, dp_size = init_parallel_groups(args.tp or world_size)
+    torch.set_num_threads(1)
+    config = GPTConfig(block_size=64, vocab_size=512, n_layer=2, n_head=4, n_embd=64, n_kv_head=args.n_kv_head)
+    B, T = 4, 32 # per dp rank
+
+    torch.manual_seed(1337)
+    ref = GPT(config)
+    torch.manual_seed(1337)
+    model = parallelize(GPT(config), tp_group)
+    ddp_model = DDP(model, process_group=dp_group) if dp_size > 1 else model
+    ref_opt = torch.optim.AdamW(ref.parameters(), lr=1e-3)
+    opt = torch.optim.AdamW(model.parameters(), lr=1e-3)
+
+    data_rng = torch.Generator().manual_seed(0)
+    max_diff = 0.0
+    for step in range(args.steps):
+        # the reference sees the global batch, every dp replica its slice of it
+        x = torch.randint(0, config.vocab_size, (B * dp_size, T), generator=data_rng)
+        y = torch.randint(0, config.vocab_size, (B * dp_size, T), generator=data_rng)
+        _, ref_loss = ref(x, y)
+        ref_opt.zero_grad()
+        ref_loss.backward()
+        ref_norm = torch.nn.utils.clip_grad_norm_(ref.parameters(), 1.0)
+        ref_opt.step()
+
+        _, loss = ddp_model(x[dp_rank * B:(dp_rank + 1) * B], y[dp_rank * B:(dp_rank + 1) * B])
+        opt.zero_grad()
+        loss.backward()
+        norm = clip_grad_norm_(model.parameters(), 1.0, tp_group)
+        opt.step()
+        loss = loss.detach().clone()
+        dist.all_reduce(loss, op=dist.ReduceOp.AVG, group=dp_group)
+        diff = max(abs(loss.item() - ref_loss.item()), abs(norm.item() - ref_norm.item()))
+        max_diff = max(max_diff, diff)
+        if rank == 0:
+            print(f"step {step} | loss {loss.item():.6f} vs {ref_loss.item():.6f} | norm {norm.item():.6f} vs {ref_norm.item():.6f}")
+
+    state_dict = full_state_dict(model, tp_group)
+    weight_diff = max((state_dict[k] - v).abs().max().item() for k, v in ref.state_dict().items())
+    if rank == 0:
+        print(f"dp={dp_size} tp={world_size // dp_size} | max loss/norm difference {max_diff:.2e} | max weight difference {weight_diff:.2e}")
+        assert max_diff < 1e-4 and weight_diff < 1e-4, "tensor parallel model diverged from the single process model"
+        print("OK")
+    dist.destroy_process_group()
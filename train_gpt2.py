@@ -2,21 +2,29 @@ import os
 import math
 import time
 import inspect
+import functools
 from dataclasses import dataclass
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from hellaswag import render_example, iterate_examples
-from line_profiler import profile
-from time import sleep
+from eval_harness import evaluate_tasks, completion_losses
+from metrics import MetricsWriter, export_text, truncate_metrics
+try:
+    from line_profiler import profile
+except ImportError:
+    def profile(fn): # line_profiler is only needed when profiling with LINE_PROFILE=1
+        return fn
 
 # -----------------------------------------------------------------------------
+# importing this file has no side effects, the training run itself is set up in main()
 
 def dprint(input):
     print(input, flush=True)
 
+master_process = True # overwritten by main() when training with DDP
 
-@profile
+
+@functools.lru_cache(maxsize=None)
 def get_best_float_config():
     if torch.cuda.is_available():
         # Check for CUDA GPUs
@@ -45,36 +53,48 @@ def get_best_float_config():
         # Default to float32 for other cases
         return torch.float32
 
-# Example usage
-best_dtype = get_best_float_config()
-dprint("The recommended dtype for your hardware is: {best_dtype}")
 
+# scaled_dot_product_attention broadcasts grouped K/V heads itself from torch 2.5 on
+SDPA_HAS_GQA = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 5)
+
+def sdpa_gqa(q, k, v):
+    """Causal attention where the nkvh K/V heads are shared by groups of nh // nkvh query heads"""
+    if k.size(1) == q.size(1):
+        return F.scaled_dot_product_attention(q, k, v, is_causal=True)
+    if SDPA_HAS_GQA:
+        return F.scaled_dot_product_attention(q, k, v, is_causal=True, enable_gqa=True)
+    n_rep = q.size(1) // k.size(1)
+    k, v = k.repeat_interleave(n_rep, dim=1), v.repeat_interleave(n_rep, dim=1)
+    return F.scaled_dot_product_attention(q, k, v, is_causal=True)
 
 class CausalSelfAttention(nn.Module):
 
     def __init__(self, config):
         super().__init__()
         assert config.n_embd % config.n_head == 0
-        # key, query, value projections for all heads, but in a batch
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd)
+        self.n_head = config.n_head
+        self.n_kv_head = config.n_kv_head or config.n_head
+        assert self.n_head % self.n_kv_head == 0, "n_head must be a multiple of n_kv_head"
+        self.n_embd = config.n_embd
+        self.kv_dim = self.n_kv_head * (config.n_embd // config.n_head)
+        # query projections for all heads and key, value projections for the kv heads, but in a batch
+        self.c_attn = nn.Linear(config.n_embd, config.n_embd + 2 * self.kv_dim)
         # output projection
         self.c_proj = nn.Linear(config.n_embd, config.n_embd)
         self.c_proj.NANOGPT_SCALE_INIT = 1
-        # regularization
-        self.n_head = config.n_head
-        self.n_embd = config.n_embd
 
     def forward(self, x):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
         # nh is "number of heads", hs is "head size", and C (number of channels) = nh * hs
         # e.g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs=C=768 channels in the Transformer
+        # with grouped-query attention there are only nkvh <= nh key and value heads
         qkv = self.c_attn(x)
-        q, k, v = qkv.split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+        q, k, v = qkv.split([self.n_embd, self.kv_dim, self.kv_dim], dim=2)
+        k = k.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2) # (B, nkvh, T, hs)
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        y = F.scaled_dot_product_attention(q, k, v, is_causal=True) # flash attention
+        v = v.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2) # (B, nkvh, T, hs)
+        y = sdpa_gqa(q, k, v) # flash attention
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
         # output projection
         y = self.c_proj(y)
@@ -116,6 +136,7 @@ class GPTConfig:
     n_layer: int = 12 # number of layers
     n_head: int = 12 # number of heads
     n_embd: int = 768 # embedding dimension
+    n_kv_head: int = None # number of key/value heads: None means n_head (MHA), 1 is multi-query attention
 
 class GPT(nn.Module):
 
@@ -168,13 +189,9 @@ class GPT(nn.Module):
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
         return logits, loss
 
-    @classmethod
-    def from_pretrained(cls, model_type):
-        """Loads pretrained GPT-2 model weights from huggingface"""
-        assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
-        from transformers import GPT2LMHeadModel
-        dprint("loading weights from pretrained gpt: %s" % model_type)
-
+    @staticmethod
+    def pretrained_config(model_type):
+        """The GPTConfig of the OpenAI checkpoint model_type"""
         # n_layer, n_head and n_embd are determined from model_type
         config_args = {
             'gpt2':         dict(n_layer=12, n_head=12, n_embd=768),  # 124M params
@@ -184,8 +201,17 @@ class GPT(nn.Module):
         }[model_type]
         config_args['vocab_size'] = 50257 # always 50257 for GPT model checkpoints
         config_args['block_size'] = 1024 # always 1024 for GPT model checkpoints
+        return GPTConfig(**config_args)
+
+    @classmethod
+    def from_pretrained(cls, model_type):
+        """Loads pretrained GPT-2 model weights from huggingface"""
+        assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
+        from transformers import GPT2LMHeadModel
+        dprint("loading weights from pretrained gpt: %s" % model_type)
+
         # create a from-scratch initialized minGPT model
-        config = GPTConfig(**config_args)
+        config = GPT.pretrained_config(model_type)
         model = GPT(config)
         sd = model.state_dict()
         sd_keys = sd.keys()
@@ -217,8 +243,37 @@ class GPT(nn.Module):
 
         return model
 
-    def configure_optimizers(self, weight_decay, learning_rate, device_type):
-        dprint(f"Configuring optimizer with weight_decay={weight_decay}, learning_rate={learning_rate}, device_type={device_type}")
+    @classmethod
+    def from_checkpoint(cls, checkpoint):
+        """Builds a model from a checkpoint dict written by the training loop (see load_checkpoint)"""
+        model = cls(checkpoint['config'])
+        # strip the prefix torch.compile adds to the parameter names
+        state_dict = {k.removeprefix('_orig_mod.'): v for k, v in checkpoint['model'].items()}
+        model.load_state_dict(state_dict)
+        return model
+
+    @staticmethod
+    @torch.no_grad()
+    def pool_kv_heads(state_dict, config, n_kv_head):
+        """
+        Converts the state dict of a multi-head model to grouped-query attention with
+        n_kv_head key/value heads by mean-pooling the K and V projections of every group
+        of consecutive heads. Returns the new state dict and config, fine-tune afterwards.
+        """
+        from dataclasses import replace
+        assert (config.n_kv_head or config.n_head) == config.n_head, "the model already uses grouped-query attention"
+        assert config.n_head % n_kv_head == 0, "n_head must be a multiple of n_kv_head"
+        C, hs = config.n_embd, config.n_embd // config.n_head
+        group = config.n_head // n_kv_head
+        state_dict = dict(state_dict)
+        for name in [k for k in state_dict if k.endswith('.attn.c_attn.weight') or k.endswith('.attn.c_attn.bias')]:
+            q, k, v = state_dict[name].split(C, dim=0)
+            pool = lambda t: t.view(n_kv_head, group, hs, *t.shape[1:]).mean(dim=1).reshape(n_kv_head * hs, *t.shape[1:])
+            state_dict[name] = torch.cat([q, pool(k), pool(v)], dim=0)
+        return state_dict, replace(config, n_kv_head=n_kv_head)
+
+    def configure_optimizers(self, weight_decay, learning_rate, device_type, optimizer_type="adamw"):
+        dprint(f"Configuring optimizer with weight_decay={weight_decay}, learning_rate={learning_rate}, device_type={device_type}, optimizer_type={optimizer_type}")
         
         # start with all of the candidate parameters (that require grad)
         param_dict = {pn: p for pn, p in self.named_parameters()}
@@ -251,6 +306,14 @@ class GPT(nn.Module):
             dprint(f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} parameters")
             dprint(f"num non-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} parameters")
         
+        if optimizer_type == "adamw8bit":
+            # 8-bit block-wise quantized moments, ~2 instead of 8 bytes of state per parameter
+            from adamw8bit import AdamW8bit
+            optimizer = AdamW8bit(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8)
+            dprint(f"Created AdamW8bit optimizer with learning rate {learning_rate}, betas=(0.9, 0.95), eps=1e-8")
+            return optimizer
+        assert optimizer_type == "adamw", f"unknown optimizer {optimizer_type}"
+
         # Create AdamW optimizer and use the fused version if it is available
         fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
         dprint(f"Fused AdamW available: {fused_available}")
@@ -267,8 +330,19 @@ class GPT(nn.Module):
         dprint("Optimizer configuration complete")
         return optimizer
 
+def load_checkpoint(path, map_location="cpu", mmap=False):
+    """Loads a log/model_*.pt checkpoint or eval snapshot, normalizing the config to a GPTConfig"""
+    import __main__
+    # checkpoints written by `python train_gpt2.py` pickle the config as __main__.GPTConfig
+    if not hasattr(__main__, "GPTConfig"):
+        __main__.GPTConfig = GPTConfig
+    # mmap=True maps the tensors from the file instead of reading them into RAM
+    checkpoint = torch.load(path, map_location=map_location, weights_only=False, mmap=mmap)
+    if isinstance(checkpoint['config'], dict):
+        checkpoint['config'] = GPTConfig(**checkpoint['config'])
+    return checkpoint
+
 # -----------------------------------------------------------------------------
-import tiktoken
 import numpy as np
 
 @profile
@@ -280,14 +354,13 @@ def load_tokens(filename):
 
 
 class DataLoaderLite:
-    def __init__(self, B, T, process_rank, num_processes, split):
+    def __init__(self, B, T, process_rank, num_processes, split, data_root="edu_fineweb10B", teacher_dir=None):
         self.B = B
         self.T = T
         self.process_rank = process_rank
         self.num_processes = num_processes
         assert split in {'train', 'val'}
 
-        data_root = "edu_fineweb10B"
         shards = os.listdir(data_root)
         shards = [s for s in shards if split in s]
         shards = sorted(shards)
@@ -297,6 +370,12 @@ class DataLoaderLite:
         
         if master_process:
             dprint(f"found {len(shards)} shards for split {split}")
+
+        # distillation: the teacher's top-k logits for every position, see distill.py
+        self.teacher = None
+        if teacher_dir is not None:
+            from distill import TeacherTopK
+            self.teacher = TeacherTopK(teacher_dir, shards)
         
         self.reset()
 
@@ -308,50 +387,65 @@ class DataLoaderLite:
         self.tokens = load_tokens(self.shards[self.current_shard])
         dprint(f"Loaded tokens from shard: {self.shards[self.current_shard]}")
         
-        self.current_position = self.B * self.T * self.process_rank
+        # global cursor: where the batch of the whole world starts, every rank reads its
+        # slice of it at an offset of process_rank micro batches
+        self.current_position = 0
         dprint(f"Set current_position to {self.current_position}")
+        self.buffer_offset = 0 # offset of self.tokens[0] in the stream of all shards
 
-    def next_batch(self):
-        B, T = self.B, self.T
+    def next_batch(self, B=None, T=None):
+        # B and T can change from call to call (see the batch warmup in optimize), the world
+        # always consumes the next B * T * num_processes tokens, so none are skipped or repeated
+        B = B or self.B
+        T = T or self.T
         dprint(f"Starting next_batch with B={B}, T={T}, current_position={self.current_position}")
 
-        while True:
-            if self.current_position + B * T + 1 > len(self.tokens):
-                dprint("Current position exceeds token length, loading next shard")
-                
-                self.current_shard = (self.current_shard + 1) % len(self.shards)
-                dprint(f"Set current_shard to {self.current_shard}")
-                
-                self.tokens = load_tokens(self.shards[self.current_shard])
-                dprint(f"Loaded tokens from shard: {self.shards[self.current_shard]}")
-                
-                self.current_position = B * T * self.process_rank
-                dprint(f"Reset current_position to {self.current_position}")
-                continue
-
-            buf = self.tokens[self.current_position : self.current_position + B * T + 1]
-            dprint(f"Buffer extracted from current_position: {self.current_position}, buffer length: {len(buf)}")
+        while self.current_position + B * T * self.num_processes + 1 > len(self.tokens):
+            dprint("Current position exceeds token length, loading next shard")
+            
+            self.current_shard = (self.current_shard + 1) % len(self.shards)
+            dprint(f"Set current_shard to {self.current_shard}")
+            
+            # carry the unread tail of this shard over into the next one
+            self.tokens = torch.cat([self.tokens[self.current_position:], load_tokens(self.shards[self.current_shard])])
+            self.buffer_offset += self.current_position
+            dprint(f"Loaded tokens from shard: {self.shards[self.current_shard]}")
+            
+            self.current_position = 0
+            dprint(f"Reset current_position to {self.current_position}")
 
-            if len(buf) < B * T + 1:
-                dprint("Buffer length insufficient, moving to next shard")
-                
-                self.current_shard = (self.current_shard + 1) % len(self.shards)
-                dprint(f"Set current_shard to {self.current_shard}")
-                
-                self.tokens = load_tokens(self.shards[self.current_shard])
-                dprint(f"Loaded tokens from shard: {self.shards[self.current_shard]}")
-                
-                self.current_position = B * T * self.process_rank
-                dprint(f"Reset current_position to {self.current_position}")
-                continue
+        start = self.current_position + B * T * self.process_rank
+        buf = self.tokens[start : start + B * T + 1]
+        dprint(f"Buffer extracted from position: {start}, buffer length: {len(buf)}")
 
-            x = buf[:-1].view(B, T)
-            y = buf[1:].view(B, T)
-            dprint(f"Prepared batch: x shape {x.shape}, y shape {y.shape}")
-            
-            self.current_position += B * T * self.num_processes
-            dprint(f"Updated current_position to {self.current_position}")
-            return x, y
+        x = buf[:-1].view(B, T)
+        y = buf[1:].view(B, T)
+        dprint(f"Prepared batch: x shape {x.shape}, y shape {y.shape}")
+        
+        self.current_position += B * T * self.num_processes
+        dprint(f"Updated current_position to {self.current_position}")
+        if self.teacher is not None:
+            # the teacher's logits at the positions of x, i.e. its prediction of y
+            indices, logits = self.teacher.read(self.buffer_offset + start, B * T)
+            return x, y, (indices.view(B, T, -1), logits.view(B, T, -1))
+        return x, y
+
+    def state_dict(self):
+        # how far the whole world got into the stream of all shards: independent of the
+        # rank and the number of ranks, so a run can resume with a different world size
+        return {'stream_offset': self.buffer_offset + self.current_position}
+
+    def load_state_dict(self, state):
+        lengths = [len(np.load(shard, mmap_mode="r")) for shard in self.shards]
+        position = state['stream_offset'] % sum(lengths)
+        self.current_shard = 0
+        while position >= lengths[self.current_shard]:
+            position -= lengths[self.current_shard]
+            self.current_shard += 1
+        self.tokens = load_tokens(self.shards[self.current_shard])
+        self.current_position = position
+        self.buffer_offset = state['stream_offset'] - position
+        dprint(f"Resumed at shard {self.current_shard}, position {self.current_position}")
 
 
 
@@ -361,19 +455,7 @@ class DataLoaderLite:
 
 @profile
 def get_most_likely_row(tokens, mask, logits):
-    # evaluate the autoregressive loss at all positions
-    shift_logits = (logits[..., :-1, :]).contiguous()
-    shift_tokens = (tokens[..., 1:]).contiguous()
-    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
-    flat_shift_tokens = shift_tokens.view(-1)
-    shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
-    shift_losses = shift_losses.view(tokens.size(0), -1)
-    # now get the average loss just for the completion region (where mask == 1), in each row
-    shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
-    masked_shift_losses = shift_losses * shift_mask
-    # sum and divide by the number of 1s in the mask
-    sum_loss = masked_shift_losses.sum(dim=1)
-    avg_loss = sum_loss / shift_mask.sum(dim=1)
+    _, avg_loss = completion_losses(tokens, mask, logits)
     # now we have a loss for each of the 4 completions
     # the one with the lowest loss should be the most likely
     pred_norm = avg_loss.argmin().item()
@@ -384,53 +466,14 @@ def get_most_likely_row(tokens, mask, logits):
 # python train_gpt2.py
 # DDP launch for e.g. 8 GPUs:
 # torchrun --standalone --nproc_per_node=8 train_gpt2.py
+# 4 data parallel replicas of a model split over 2 GPUs each (see tensor_parallel.py):
+# torchrun --standalone --nproc_per_node=8 train_gpt2.py --tensor_parallel 2
 
 # run the training loop
-from torch.distributed import init_process_group, destroy_process_group
+from torch.distributed import init_process_group, destroy_process_group, PrefixStore, TCPStore
 from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.distributed as dist
 
-# set up DDP (distributed data parallel).
-# torchrun command sets the env variables RANK, LOCAL_RANK, and WORLD_SIZE
-ddp = int(os.environ.get('RANK', -1)) != -1 # is this a ddp run?
-if ddp:
-    # use of DDP atm demands CUDA, we set the device appropriately according to rank
-    assert torch.cuda.is_available(), "for now i think we need CUDA for DDP"
-    init_process_group(backend='nccl')
-    ddp_rank = int(os.environ['RANK'])
-    ddp_local_rank = int(os.environ['LOCAL_RANK'])
-    ddp_world_size = int(os.environ['WORLD_SIZE'])
-    device = f'cuda:{ddp_local_rank}'
-    torch.cuda.set_device(device)
-    master_process = ddp_rank == 0 # this process will do logging, checkpointing etc.
-else:
-    # vanilla, non-DDP run
-    ddp_rank = 0
-    ddp_local_rank = 0
-    ddp_world_size = 1
-    master_process = True
-    # attempt to autodetect device
-    device = "cpu"
-    if torch.cuda.is_available():
-        device = "cuda"
-    elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
-        device = "mps"
-    dprint(f"using device: {device}")
-
-# added after video, pytorch can be serious about it's device vs. device_type distinction
-device_type = "cuda" if device.startswith("cuda") else "cpu"
-
-torch.manual_seed(1337)
-if torch.cuda.is_available():
-    torch.cuda.manual_seed(1337)
-
-enc = tiktoken.get_encoding("gpt2")
-
-
-import torch
-import math
-from line_profiler import profile
-
 @profile
 def optimize_training_params(model, min_micro_batch_size=1, min_seq_length=64, max_seq_length=2048):
     def get_gpu_memory():
@@ -490,56 +533,58 @@ def optimize_training_params(model, min_micro_batch_size=1, min_seq_length=64, m
     }
 
 
-model = GPT(GPTConfig(vocab_size=50304))
-try:
-    params = optimize_training_params(model)
-    dprint(f"Optimized parameters: {params}")
-except ValueError as e:
-    dprint(f"Error: {e}")
-    exit;
-
-# After getting the optimized parameters
-B = params["micro_batch_size"]
-T = params["sequence_length"]
-grad_accum_steps = params["gradient_accumulation_steps"]
-actual_batch_size = params["actual_batch_size"]
-
-dprint(f"Micro batch size: {B}")
-dprint(f"Sequence length: {T}")
-dprint(f"Gradient accumulation steps: {grad_accum_steps}")
-dprint(f"Actual batch size: {actual_batch_size}")
-
-assert actual_batch_size == B * T * grad_accum_steps * ddp_world_size, "Inconsistency in batch size calculation"
-
-if master_process:
-    dprint(f"Effective total batch size: {actual_batch_size}")
-    dprint(f"=> gradient accumulation steps: {grad_accum_steps}")
-
-train_loader = DataLoaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="train")
-val_loader = DataLoaderLite(B=B, T=T, process_rank=ddp_rank, num_processes=ddp_world_size, split="val")
-
-# ... rest of your training loop ...
-
-torch.set_float32_matmul_precision('high')
-
 
-# create model
-# model = GPT.from_pretrained("gpt2") # or init from OpenAI GPT-2
-model.to(device)
 use_compile = False # torch.compile interferes with HellaSwag eval and Generation. TODO fix
-if use_compile:
-    model = torch.compile(model)
-if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
-raw_model = model.module if ddp else model # always contains the "raw" unwrapped model
+async_eval = False # publish weight snapshots to a separate eval process instead of evaluating inline, see eval_worker.py
+val_loss_steps = 20
+print_every = 10 # steps between the printed step lines (they sync on the loss), metrics.bin gets every step
+profile_schedule = None # (wait, warmup, active) steps to capture with torch.profiler, see profiling.py
+profile_dir = "log/profile"
 
 max_lr = 6e-4
 min_lr = max_lr * 0.1
 warmup_steps = 715
 max_steps = 19073 # 19,073 steps is ~1 epoch, if data is 10B tokens and batch size 0.5M tokens
+tokens_per_step = 524288 # the target total batch size in tokens, overwritten by main()
+
+# sequence length and batch size warmup: start at short sequences and/or few micro steps
+# and ramp up to the target T and grad_accum_steps over the first tokens of training
+seq_len_warmup_tokens = 0 # 0 disables
+min_seq_len = 64 # T ramps from here to the target in multiples of min_seq_len
+batch_warmup_tokens = 0 # 0 disables, grad_accum_steps ramps from 1 to the target
+target_loss = None # report the tokens it took to first reach this val loss
+optimizer_type = "adamw" # or "adamw8bit" for 8-bit optimizer states, see adamw8bit.py
+distill_alpha = 0.0 # weight of the KL term against cached teacher logits, 0 disables, see distill.py
+distill_temperature = 1.0
+log_dir = "log"
+data_root = "edu_fineweb10B" # the train/val shards, or data_mixture to sample from several directories, see mixture.py
+data_mixture = None
+checkpoint_every = 0 # steps between the resume checkpoints in log_dir/latest.pt, 0 disables
+resume_checkpoint = None # the latest.pt we resume from, set by main() with --resume
+
+def build_batch_schedule(B, T, grad_accum_steps, world_size):
+    """
+    The (T, grad_accum_steps) of every step, until the token budget of max_steps steps at
+    the target batch size is used up. Warmup steps are smaller, so there are more of them.
+    """
+    budget = max_steps * B * T * grad_accum_steps * world_size
+    schedule = []
+    tokens = 0
+    while tokens < budget:
+        step_T, step_accum = T, grad_accum_steps
+        if tokens < seq_len_warmup_tokens:
+            step_T = int(min_seq_len + (T - min_seq_len) * tokens / seq_len_warmup_tokens) // min_seq_len * min_seq_len
+            step_T = min(T, max(min_seq_len, step_T))
+        if tokens < batch_warmup_tokens:
+            step_accum = max(1, int(1 + (grad_accum_steps - 1) * tokens / batch_warmup_tokens))
+        schedule.append((step_T, step_accum))
+        tokens += B * step_T * step_accum * world_size
+    return schedule
 
 @profile
-def get_lr(it):
+def get_lr(tokens):
+    # the schedule is defined in tokens, so it does not depend on the batch size of a step
+    it = tokens / tokens_per_step # progress in steps of the target batch size
     # 1) linear warmup for warmup_iters steps
     if it < warmup_steps:
         return max_lr * (it+1) / warmup_steps
@@ -561,25 +606,75 @@ def optimize():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     logger = logging.getLogger(__name__)
 
-    optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device_type=device_type)
-    dprint(f"Optimizer configured with weight_decay=0.1, learning_rate=6e-4, device_type={device_type}")
+    optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, device_type=device_type, optimizer_type=optimizer_type)
+    dprint(f"Optimizer configured with weight_decay=0.1, learning_rate=6e-4, device_type={device_type}, optimizer_type={optimizer_type}")
 
     # create the log directory we will write checkpoints to and log to
-    log_dir = "log"
     os.makedirs(log_dir, exist_ok=True)
-    log_file = os.path.join(log_dir, f"log.txt")
+    log_file = os.path.join(log_dir, f"log.txt") # text export of metrics_file, see metrics.py
+    metrics_file = os.path.join(log_dir, f"metrics.bin")
     dprint(f"Log directory created: {log_dir}")
-    with open(log_file, "w") as f: # open for writing to clear the file
-        pass
-    dprint(f"Log file cleared: {log_file}")
-
-    for step in range(max_steps):
-        dprint(f"Starting step {step}/{max_steps}")
+    if master_process:
+        # truncate to clear the previous run, unless we continue it: then only the records after
+        # the checkpoint go, those steps are run (and logged) again
+        if resume_checkpoint is not None:
+            dropped = truncate_metrics(metrics_file, resume_checkpoint['step'])
+            dprint(f"Dropped {dropped} metrics records after step {resume_checkpoint['step']}")
+        metrics = MetricsWriter(metrics_file, truncate=resume_checkpoint is None)
+        dprint(f"Metrics file {'appended to' if resume_checkpoint is not None else 'cleared'}: {metrics_file}")
+    tokens_seen = 0
+    start_step = 0
+    reached_target = False
+    if resume_checkpoint is not None:
+        # the model weights and the loader position were restored by main(), the optimizer state is
+        # replicated on every rank so any world size can load it
+        optimizer.load_state_dict(resume_checkpoint['optimizer'])
+        tokens_seen = resume_checkpoint['tokens_seen']
+        reached_target = resume_checkpoint['reached_target']
+        start_step = resume_checkpoint['step'] + 1
+        # the step sizes of the seq-len and batch warmup depend on the world size, so the schedule
+        # we have now only continues the run if it took the same tokens to get to start_step
+        tokens = sum(train_loader.B * step_T * step_accum * dp_world_size for step_T, step_accum in batch_schedule[:start_step])
+        assert tokens == tokens_seen, (f"with {dp_world_size} ranks the batch schedule is at {tokens:,} tokens after step {start_step - 1}, "
+                                       f"the checkpoint at {tokens_seen:,}: resume with the same world size until the warmup is over")
+        dprint(f"Resuming at step {start_step} after {tokens_seen:,} tokens (checkpoint of step {resume_checkpoint['step']})")
+
+    if async_eval and master_process:
+        from eval_worker import launch_eval_worker, publish_snapshot, finish_snapshots
+        snapshot_dir = os.path.join(log_dir, "snapshots")
+        eval_worker = launch_eval_worker(snapshot_dir, metrics_file, B=B, T=T, val_batches=val_loss_steps * dp_world_size,
+                                         data_root=data_root, data_mixture=data_mixture)
+        snapshot_thread = None
+        dprint(f"Launched eval worker (pid {eval_worker.pid}) watching {snapshot_dir}")
+
+    if tp_size > 1:
+        from tensor_parallel import full_state_dict, clip_grad_norm_ as tp_clip_grad_norm_
+    if distill_alpha > 0:
+        from distill import distill_loss
+
+    profiler = None
+    if profile_schedule is not None:
+        from profiling import TrainingProfiler
+        profiler = TrainingProfiler(raw_model, profile_dir, *profile_schedule, rank=ddp_rank)
+        profiler.start()
+        dprint(f"Profiling steps with (wait, warmup, active) = {profile_schedule}, writing to {profile_dir}")
+
+    num_steps = len(batch_schedule)
+    for step in range(start_step, num_steps):
+        dprint(f"Starting step {step}/{num_steps}")
         t0 = time.time()
-        last_step = (step == max_steps - 1)
+        last_step = (step == num_steps - 1)
+        step_T, step_accum = batch_schedule[step]
+
+        # once in a while hand a snapshot of the weights to the eval worker and keep training
+        if async_eval and (step % 250 == 0 or last_step):
+            if master_process:
+                dprint(f"Publishing weight snapshot for step {step}")
+                checkpoint = step > 0 and (step % 5000 == 0 or last_step)
+                snapshot_thread = publish_snapshot(raw_model, step, snapshot_dir, checkpoint=checkpoint, pending=snapshot_thread)
 
         # once in a while evaluate our validation loss
-        if step % 250 == 0 or last_step:
+        if (step % 250 == 0 or last_step) and (not async_eval):
             dprint("Evaluating validation loss")
             model.eval()
             dprint("Setting model to evaluation mode")
@@ -589,7 +684,6 @@ def optimize():
             with torch.no_grad():
                 dprint("Starting no_grad context")
                 val_loss_accum = 0.0
-                val_loss_steps = 20
                 dprint(f"Initialized validation loss accumulator: {val_loss_accum}, steps: {val_loss_steps}")
                 
                 for i in range(val_loss_steps):
@@ -613,61 +707,61 @@ def optimize():
                 dprint("Running in DDP mode, reducing validation loss across processes")
                 dist.all_reduce(val_loss_accum, op=dist.ReduceOp.AVG)
             
+            save_checkpoint = step > 0 and (step % 5000 == 0 or last_step)
+            if save_checkpoint:
+                # with tensor parallelism every rank has to help gather the full weights
+                model_state = full_state_dict(raw_model, tp_group) if tp_size > 1 else raw_model.state_dict()
+
             if master_process:
                 dprint(f"Validation loss: {val_loss_accum.item():.4f}")
-                with open(log_file, "a") as f:
-                    dprint("Writing validation loss to log file")
-                    f.write(f"{step} val {val_loss_accum.item():.4f}\n")
+                metrics.log(step, "val", val_loss_accum, tokens=tokens_seen)
+                if target_loss is not None and not reached_target and val_loss_accum.item() <= target_loss:
+                    reached_target = True
+                    dprint(f"reached the target val loss {target_loss} after {tokens_seen:,} tokens ({step} steps)")
                 
-                if step > 0 and (step % 5000 == 0 or last_step):
+                if save_checkpoint:
                     dprint("Saving model checkpoint")
                     checkpoint_path = os.path.join(log_dir, f"model_{step:05d}.pt")
                     dprint(f"Checkpoint path: {checkpoint_path}")
                     checkpoint = {
-                        'model': raw_model.state_dict(),
+                        'model': model_state,
                         'config': raw_model.config,
                         'step': step,
                         'val_loss': val_loss_accum.item()
                     }
+                    checkpoint['train_loader'] = train_loader.state_dict() # where the data loader is at
                     dprint("Checkpoint dictionary created")
                     torch.save(checkpoint, checkpoint_path)
                     dprint(f"Checkpoint saved to {checkpoint_path}")
 
 
         # once in a while evaluate hellaswag
-        if (step % 250 == 0 or last_step) and (not use_compile):
+        if (step % 250 == 0 or last_step) and (not use_compile) and (not async_eval):
             dprint("Evaluating HellaSwag")
-            num_correct_norm = 0
-            num_total = 0
-            for i, example in enumerate(iterate_examples("val")):
-                if i % ddp_world_size != ddp_rank:
-                    continue
-                logger.debug(f"Processing HellaSwag example {i}")
-                _, tokens, mask, label = render_example(example)
-                tokens = tokens.to(device)
-                mask = mask.to(device)
-                with torch.no_grad():
-                    with torch.autocast(device_type=device_type, dtype=best_dtype):
-                        logits, loss = model(tokens)
-                    pred_norm = get_most_likely_row(tokens, mask, logits)
-                num_total += 1
-                num_correct_norm += int(pred_norm == label)
+            model.eval()
+            stats = evaluate_tasks(model, ["hellaswag"], device, autocast_dtype=best_dtype, rank=dp_rank, world_size=dp_world_size)
+            num_total = stats["hellaswag"]["num_total"]
+            num_correct_norm = stats["hellaswag"]["num_correct_norm"]
             if ddp:
                 logger.debug("Reducing HellaSwag results across processes")
                 num_total = torch.tensor(num_total, dtype=torch.long, device=device)
                 num_correct_norm = torch.tensor(num_correct_norm, dtype=torch.long, device=device)
-                dist.all_reduce(num_total, op=dist.ReduceOp.SUM)
-                dist.all_reduce(num_correct_norm, op=dist.ReduceOp.SUM)
+                dist.all_reduce(num_total, op=dist.ReduceOp.SUM, group=dp_group)
+                dist.all_reduce(num_correct_norm, op=dist.ReduceOp.SUM, group=dp_group)
                 num_total = num_total.item()
                 num_correct_norm = num_correct_norm.item()
             acc_norm = num_correct_norm / num_total
             if master_process:
                 dprint(f"HellaSwag accuracy: {num_correct_norm}/{num_total}={acc_norm:.4f}")
-                with open(log_file, "a") as f:
-                    f.write(f"{step} hella {acc_norm:.4f}\n")
+                metrics.log(step, "hella", acc_norm, tokens=tokens_seen)
+
+        # refresh the text log once in a while, it is cheap to regenerate from the metrics file
+        if (step % 250 == 0 or last_step) and master_process:
+            metrics.flush()
+            export_text(metrics_file, log_file)
 
         # once in a while generate from the model (except step 0, which is noise)
-        if ((step > 0 and step % 250 == 0) or last_step) and (not use_compile):
+        if ((step > 0 and step % 250 == 0) or last_step) and (not use_compile) and (not async_eval):
             dprint("Generating text from the model")
             model.eval()
             num_return_sequences = 4
@@ -677,7 +771,7 @@ def optimize():
             tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)
             xgen = tokens.to(device)
             sample_rng = torch.Generator(device=device)
-            sample_rng.manual_seed(42 + ddp_rank)
+            sample_rng.manual_seed(42 + dp_rank) # the ranks of a tp group must sample the same tokens
             while xgen.size(1) < max_length:
                 logger.debug(f"Generating token {xgen.size(1)}/{max_length}")
                 with torch.no_grad():
@@ -699,38 +793,287 @@ def optimize():
         model.train()
         optimizer.zero_grad()
         loss_accum = 0.0
-        for micro_step in range(grad_accum_steps):
-            logger.debug(f"Micro-step {micro_step+1}/{grad_accum_steps}")
-            x, y = train_loader.next_batch()
+        kl_accum = 0.0
+        for micro_step in range(step_accum):
+            logger.debug(f"Micro-step {micro_step+1}/{step_accum}")
+            if distill_alpha > 0:
+                x, y, (teacher_indices, teacher_logits) = train_loader.next_batch(T=step_T)
+                teacher_indices, teacher_logits = teacher_indices.to(device), teacher_logits.to(device)
+            else:
+                x, y = train_loader.next_batch(T=step_T)
             x, y = x.to(device), y.to(device)
             if ddp:
-                model.require_backward_grad_sync = (micro_step == grad_accum_steps - 1)
+                model.require_backward_grad_sync = (micro_step == step_accum - 1)
             with torch.autocast(device_type=device_type, dtype=best_dtype):
                 logits, loss = model(x, y)
-            loss = loss / grad_accum_steps
+            if distill_alpha > 0:
+                kl = distill_loss(logits, teacher_indices, teacher_logits, distill_temperature)
+                kl_accum += kl.detach() / step_accum
+                loss = (1 - distill_alpha) * loss + distill_alpha * kl
+            loss = loss / step_accum
             loss_accum += loss.detach()
             loss.backward()
-            logger.debug(f"Micro-step loss: {loss.item():.6f}")
+            if logger.isEnabledFor(logging.DEBUG): # don't sync on the loss unless someone reads it
+                logger.debug(f"Micro-step loss: {loss.item():.6f}")
         if ddp:
             logger.debug("Reducing loss across processes")
             dist.all_reduce(loss_accum, op=dist.ReduceOp.AVG)
-        norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-        lr = get_lr(step)
+            if distill_alpha > 0:
+                dist.all_reduce(kl_accum, op=dist.ReduceOp.AVG)
+        if tp_size > 1:
+            norm = tp_clip_grad_norm_(model.parameters(), 1.0, tp_group)
+        else:
+            norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        lr = get_lr(tokens_seen)
         for param_group in optimizer.param_groups:
             param_group['lr'] = lr
         optimizer.step()
         if device_type == "cuda":
             torch.cuda.synchronize()
         t1 = time.time()
+        comm_seconds, comm_bytes = comm_stats.reset() if comm_stats is not None else (float("nan"), 0)
         dt = t1 - t0
-        tokens_processed = train_loader.B * train_loader.T * grad_accum_steps * ddp_world_size
+        tokens_processed = train_loader.B * step_T * step_accum * dp_world_size
         tokens_per_sec = tokens_processed / dt
+        tokens_seen += tokens_processed
+        if master_process and (step % print_every == 0 or last_step):
+            comm = f" | comm: {comm_seconds*1000:.2f}ms {comm_bytes/1e6:.1f}MB" if comm_stats is not None else ""
+            kl = f" | kl: {kl_accum.item():.4f}" if distill_alpha > 0 else ""
+            dprint(f"step {step:5d} | loss: {loss_accum.item():.6f}{kl} | lr {lr:.4e} | norm: {norm:.4f} | dt: {dt*1000:.2f}ms | tok/sec: {tokens_per_sec:.2f}{comm}")
         if master_process:
-            dprint(f"step {step:5d} | loss: {loss_accum.item():.6f} | lr {lr:.4e} | norm: {norm:.4f} | dt: {dt*1000:.2f}ms | tok/sec: {tokens_per_sec:.2f}")
-            with open(log_file, "a") as f:
-                f.write(f"{step} train {loss_accum.item():.6f}\n")
+            # the tensors go to the writer as they are, its flush thread converts them
+            metrics.log(step, "train", loss_accum, tokens=tokens_seen, tokens_per_sec=tokens_per_sec, lr=lr, grad_norm=norm, dt=dt,
+                        comm_seconds=comm_seconds, comm_bytes=comm_bytes)
+            if distill_alpha > 0:
+                metrics.log(step, "kl", kl_accum, tokens=tokens_seen)
+        if checkpoint_every > 0 and ((step + 1) % checkpoint_every == 0 or last_step) and master_process:
+            # everything needed to continue after this step, with any number of ranks
+            checkpoint = {
+                'model': raw_model.state_dict(),
+                'config': raw_model.config,
+                'optimizer': optimizer.state_dict(),
+                'step': step,
+                'tokens_seen': tokens_seen,
+                'reached_target': reached_target,
+                'total_batch_size': tokens_per_step,
+                'train_loader': train_loader.state_dict(),
+            }
+            latest_path = os.path.join(log_dir, "latest.pt")
+            torch.save(checkpoint, latest_path + ".tmp")
+            os.replace(latest_path + ".tmp", latest_path) # a rank killed mid-write never leaves a torn checkpoint
+            metrics.flush() # the records up to the checkpoint survive a kill, the steps after it are run again
+            dprint(f"Saved resume checkpoint {latest_path} after step {step}")
+        if profiler is not None:
+            profiler.step()
+    if profiler is not None:
+        profiler.stop()
+    if async_eval and master_process:
+        finish_snapshots(snapshot_dir, pending=snapshot_thread)
+        dprint("Waiting for the eval worker to drain the remaining snapshots")
+        eval_worker.wait()
+    if master_process:
+        metrics.close()
+        export_text(metrics_file, log_file)
     if ddp:
         destroy_process_group()
 
+def main():
+    global ddp, ddp_rank, ddp_local_rank, ddp_world_size, master_process, device, device_type, best_dtype, enc
+    global model, raw_model, train_loader, val_loader, B, T, grad_accum_steps
+    global max_steps, use_compile, async_eval, profile_schedule, profile_dir, print_every
+    global tp_size, tp_group, dp_group, dp_rank, dp_world_size, comm_stats
+    global tokens_per_step, batch_schedule, seq_len_warmup_tokens, min_seq_len, batch_warmup_tokens, target_loss
+    global optimizer_type, distill_alpha, distill_temperature, log_dir, checkpoint_every, resume_checkpoint, data_root, data_mixture
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_root", type=str, default=data_root, help="directory with the train/val token shards")
+    parser.add_argument("--data_mixture", type=str, default=None, help="dir:weight,dir:weight,... to sample from instead of --data_root, see mixture.py")
+    parser.add_argument("--n_layer", type=int, default=12, help="number of layers")
+    parser.add_argument("--n_head", type=int, default=12, help="number of heads")
+    parser.add_argument("--n_embd", type=int, default=768, help="embedding dimension")
+    parser.add_argument("--n_kv_head", type=int, default=None, help="key/value heads for grouped-query attention, defaults to n_head")
+    parser.add_argument("--micro_batch_size", type=int, default=None, help="B, skips optimize_training_params if given with --seq_len")
+    parser.add_argument("--seq_len", type=int, default=None, help="T, skips optimize_training_params if given with --micro_batch_size")
+    parser.add_argument("--grad_accum_steps", type=int, default=1, help="only used together with --micro_batch_size/--seq_len")
+    parser.add_argument("--total_batch_size", type=int, default=None, help="tokens per step, sets grad_accum_steps from the world size (elastic runs)")
+    parser.add_argument("--max_steps", type=int, default=max_steps, help="number of optimization steps")
+    parser.add_argument("--print_every", type=int, default=print_every, help="steps between the printed step lines, 1 prints every step")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the model")
+    parser.add_argument("--async_eval", action="store_true", help="evaluate snapshots in a separate process, see eval_worker.py")
+    parser.add_argument("--profile", type=str, default=None, help="wait,warmup,active steps to capture with torch.profiler")
+    parser.add_argument("--profile_dir", type=str, default=profile_dir, help="where the profiler writes traces and summaries")
+    parser.add_argument("--tensor_parallel", type=int, default=1, help="split every Block over this many ranks, see tensor_parallel.py")
+    parser.add_argument("--comm_hook", type=str, default=None, help="DDP gradient sync: allreduce, fp16, bf16 or powersgd, see comm_hooks.py")
+    parser.add_argument("--powersgd_rank", type=int, default=4, help="rank of the PowerSGD gradient approximation")
+    parser.add_argument("--bucket_cap_mb", type=float, default=25, help="size of the DDP all-reduce buckets")
+    parser.add_argument("--seq_len_warmup_tokens", type=int, default=seq_len_warmup_tokens, help="ramp T up from --min_seq_len over this many tokens")
+    parser.add_argument("--min_seq_len", type=int, default=min_seq_len, help="T at the start of the sequence length warmup")
+    parser.add_argument("--batch_warmup_tokens", type=int, default=batch_warmup_tokens, help="ramp grad_accum_steps up from 1 over this many tokens")
+    parser.add_argument("--target_loss", type=float, default=target_loss, help="report the tokens it took to reach this val loss")
+    parser.add_argument("--teacher_dir", type=str, default=None, help="teacher top-k logits of the train shards written by distill.py")
+    parser.add_argument("--distill_alpha", type=float, default=0.5, help="weight of the KL term with --teacher_dir, the cross-entropy gets 1 - alpha")
+    parser.add_argument("--distill_temperature", type=float, default=distill_temperature, help="softmax temperature of the KL term")
+    parser.add_argument("--log_dir", type=str, default=log_dir, help="where to write metrics and checkpoints")
+    parser.add_argument("--checkpoint_every", type=int, default=checkpoint_every, help="steps between resume checkpoints (log_dir/latest.pt)")
+    parser.add_argument("--resume", action="store_true", help="continue from log_dir/latest.pt if it exists, e.g. after an elastic restart")
+    parser.add_argument("--optimizer", type=str, default=optimizer_type, choices=["adamw", "adamw8bit"], help="adamw8bit stores the moments in 8 bits")
+    args = parser.parse_args()
+    if args.profile is not None:
+        profile_schedule = tuple(int(n) for n in args.profile.split(","))
+        profile_dir = args.profile_dir
+    max_steps = args.max_steps
+    print_every = args.print_every
+    seq_len_warmup_tokens, min_seq_len = args.seq_len_warmup_tokens, args.min_seq_len
+    batch_warmup_tokens, target_loss = args.batch_warmup_tokens, args.target_loss
+    optimizer_type = args.optimizer
+    distill_alpha = args.distill_alpha if args.teacher_dir is not None else 0.0
+    distill_temperature = args.distill_temperature
+    log_dir, checkpoint_every = args.log_dir, args.checkpoint_every
+    data_root, data_mixture = args.data_root, args.data_mixture
+    use_compile = use_compile or args.compile
+    async_eval = async_eval or args.async_eval
+
+    # set up DDP (distributed data parallel).
+    # torchrun command sets the env variables RANK, LOCAL_RANK, and WORLD_SIZE
+    ddp = int(os.environ.get('RANK', -1)) != -1 # is this a ddp run?
+    if ddp:
+        # nccl on GPUs, we set the device appropriately according to rank; gloo on CPU (e.g. to check correctness)
+        store = None
+        if os.environ.get('TORCHELASTIC_USE_AGENT_STORE') == str(True):
+            # a group restarted by torchrun reuses the agent's store, give every restart its own keys,
+            # otherwise the new ranks can pick up the address of a worker that was killed
+            agent_store = TCPStore(os.environ['MASTER_ADDR'], int(os.environ['MASTER_PORT']), is_master=False)
+            store = PrefixStore(f"restart_{os.environ.get('TORCHELASTIC_RESTART_COUNT', 0)}", agent_store)
+        init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo', store=store,
+                           rank=int(os.environ['RANK']), world_size=int(os.environ['WORLD_SIZE']))
+        ddp_rank = int(os.environ['RANK'])
+        ddp_local_rank = int(os.environ['LOCAL_RANK'])
+        ddp_world_size = int(os.environ['WORLD_SIZE'])
+        device = f'cuda:{ddp_local_rank}' if torch.cuda.is_available() else 'cpu'
+        if torch.cuda.is_available():
+            torch.cuda.set_device(device)
+        master_process = ddp_rank == 0 # this process will do logging, checkpointing etc.
+    else:
+        # vanilla, non-DDP run
+        ddp_rank = 0
+        ddp_local_rank = 0
+        ddp_world_size = 1
+        master_process = True
+        # attempt to autodetect device
+        device = "cpu"
+        if torch.cuda.is_available():
+            device = "cuda"
+        elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+            device = "mps"
+        dprint(f"using device: {device}")
+
+    # added after video, pytorch can be serious about it's device vs. device_type distinction
+    device_type = "cuda" if device.startswith("cuda") else "cpu"
+
+    # tensor parallelism: the ranks of a tp group share one copy of the model and read the
+    # same data, DDP runs over the dp groups of ranks that hold the same shards
+    tp_size = args.tensor_parallel
+    if tp_size > 1:
+        assert ddp, "tensor parallelism needs a torchrun launch"
+        assert not async_eval, "the eval worker snapshots full weights, it does not support tensor parallelism yet"
+        assert args.checkpoint_every == 0, "resume checkpoints hold the full weights, they do not support tensor parallelism yet"
+        from tensor_parallel import init_parallel_groups, parallelize
+        tp_group, dp_group, tp_rank, dp_rank, dp_world_size = init_parallel_groups(tp_size)
+    else:
+        tp_group, dp_group, dp_rank, dp_world_size = None, None, ddp_rank, ddp_world_size
 
-optimize()
\ No newline at end of file
+    best_dtype = get_best_float_config()
+    dprint(f"The recommended dtype for your hardware is: {best_dtype}")
+
+    torch.manual_seed(1337)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed(1337)
+
+    import tiktoken
+    enc = tiktoken.get_encoding("gpt2")
+
+    model = GPT(GPTConfig(vocab_size=50304, n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd, n_kv_head=args.n_kv_head))
+    if args.micro_batch_size is not None and args.seq_len is not None:
+        params = {
+            "micro_batch_size": args.micro_batch_size,
+            "sequence_length": args.seq_len,
+            "gradient_accumulation_steps": args.grad_accum_steps,
+        }
+    else:
+        try:
+            params = optimize_training_params(model)
+            dprint(f"Optimized parameters: {params}")
+        except ValueError as e:
+            dprint(f"Error: {e}")
+            raise SystemExit("pass --micro_batch_size and --seq_len to train without a GPU")
+
+    # After getting the optimized parameters
+    B = params["micro_batch_size"]
+    T = params["sequence_length"]
+    grad_accum_steps = params["gradient_accumulation_steps"]
+
+    # elastic restarts: torchrun restarts every worker after a failure or a membership change,
+    # we continue from the last resume checkpoint with whatever world size we got
+    latest_path = os.path.join(args.log_dir, "latest.pt")
+    if args.resume and os.path.exists(latest_path):
+        resume_checkpoint = load_checkpoint(latest_path)
+        model.load_state_dict(resume_checkpoint.pop('model'))
+        args.total_batch_size = args.total_batch_size or resume_checkpoint['total_batch_size']
+        assert args.total_batch_size == resume_checkpoint['total_batch_size'], "the global batch size changed, cannot resume"
+        dprint(f"Loaded {latest_path} (step {resume_checkpoint['step']}), restart {os.environ.get('TORCHELASTIC_RESTART_COUNT', 0)}, world size {dp_world_size}")
+    if args.total_batch_size is not None:
+        # keep the global batch constant whatever the number of ranks
+        assert args.total_batch_size % (B * T * dp_world_size) == 0, f"total_batch_size {args.total_batch_size} is not divisible by B * T * world size = {B * T * dp_world_size}"
+        grad_accum_steps = args.total_batch_size // (B * T * dp_world_size)
+    actual_batch_size = B * T * grad_accum_steps * dp_world_size
+    tokens_per_step = actual_batch_size
+    batch_schedule = build_batch_schedule(B, T, grad_accum_steps, dp_world_size)
+    if seq_len_warmup_tokens > 0 or batch_warmup_tokens > 0:
+        dprint(f"batch warmup: {len(batch_schedule)} steps for the token budget of {max_steps} steps, first step (T, grad_accum_steps) = {batch_schedule[0]}")
+
+    dprint(f"Micro batch size: {B}")
+    dprint(f"Sequence length: {T}")
+    dprint(f"Gradient accumulation steps: {grad_accum_steps}")
+    dprint(f"Actual batch size: {actual_batch_size}")
+
+    if master_process:
+        dprint(f"Effective total batch size: {actual_batch_size}")
+        dprint(f"=> gradient accumulation steps: {grad_accum_steps}")
+
+    if args.data_mixture is not None:
+        assert args.teacher_dir is None, "distillation reads the teacher logits alongside DataLoaderLite, not the mixture loader"
+        from mixture import MixtureDataLoader, parse_mixture
+        sources = parse_mixture(args.data_mixture)
+        dprint(f"data mixture: {sources}")
+        train_loader = MixtureDataLoader(B=B, T=T, process_rank=dp_rank, num_processes=dp_world_size, split="train", sources=sources)
+        val_loader = MixtureDataLoader(B=B, T=T, process_rank=dp_rank, num_processes=dp_world_size, split="val", sources=sources)
+    else:
+        train_loader = DataLoaderLite(B=B, T=T, process_rank=dp_rank, num_processes=dp_world_size, split="train", data_root=args.data_root, teacher_dir=args.teacher_dir)
+        val_loader = DataLoaderLite(B=B, T=T, process_rank=dp_rank, num_processes=dp_world_size, split="val", data_root=args.data_root)
+    if resume_checkpoint is not None:
+        # the position of the whole world, re-partitioned over the ranks we have now
+        train_loader.load_state_dict(resume_checkpoint['train_loader'])
+
+    torch.set_float32_matmul_precision('high')
+
+    # create model
+    # model = GPT.from_pretrained("gpt2") # or init from OpenAI GPT-2
+    if tp_size > 1:
+        # every rank built the same full model from the same seed, keep only this rank's shards
+        parallelize(model, tp_group)
+    model.to(device)
+    if use_compile:
+        model = torch.compile(model)
+    if ddp:
+        model = DDP(model, device_ids=[ddp_local_rank] if device_type == "cuda" else None, process_group=dp_group,
+                    bucket_cap_mb=args.bucket_cap_mb)
+    comm_stats = None
+    if ddp and args.comm_hook is not None:
+        from comm_hooks import register_comm_hook
+        comm_stats = register_comm_hook(model, args.comm_hook, process_group=dp_group, powersgd_rank=args.powersgd_rank)
+    raw_model = model.module if ddp else model # always contains the "raw" unwrapped model
+
+    optimize()
+
+if __name__ == "__main__":
+    main()